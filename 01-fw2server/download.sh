@@ -32,6 +32,7 @@ echo "Flywheel Session ID: $fw_seshid"
 echo "BIDS Subject ID: $new_subid"
 echo "Experiment Type: $EXPERIMENT_TYPE"
 echo "Config File: $CONFIG_FILE"
+echo "Download Mode: ${FW_DOWNLOAD_MODE:-tar}"
 echo "=================================================="
 
 # check if scan-config.json file exists
@@ -68,6 +69,14 @@ module load python/3.9.0
 
 echo "($(date)) [INFO] Now starting MRI file download" | tee -a "${log_file}"
 
+# 'fused' downloads per acquisition and extracts straight into the step-02 work dir
+download_mode="${FW_DOWNLOAD_MODE:-tar}"
+extract_dir_flag=""
+if [ "${download_mode}" = "fused" ]; then
+  download_mode="acquisitions"
+  extract_dir_flag="--extract_dir /scratch/users/${USER}/${subject}/dcm2niix_work_dir/${subject}"
+fi
+
 python3 "${SCRIPTS_DIR}"/"${JOB_NAME}"/fw-downloader.py \
   --user "${USER}" \
   --fw_subject_id "${fw_subid}" \
@@ -75,7 +84,14 @@ python3 "${SCRIPTS_DIR}"/"${JOB_NAME}"/fw-downloader.py \
   --fw_group_id "${FW_GROUP_ID}" \
   --fw_project_id "${FW_PROJECT_ID}" \
   --fw_instance_url "${FW_URL}" \
-  --fw_api_key_file "${FW_CLI_API_KEY_FILE}"
+  --fw_api_key_file "${FW_CLI_API_KEY_FILE}" \
+  --mode "${download_mode}" \
+  --workers "${FW_DOWNLOAD_WORKERS:-4}" \
+  ${extract_dir_flag}
+if [ $? -ne 0 ]; then
+  echo "($(date)) [ERROR] Flywheel download failed for subject ${fw_subid}" | tee -a "${log_file}"
+  exit 1
+fi
 echo "($(date)) [INFO] Flywheel download complete" | tee -a "${log_file}"
 
 echo "${fw_subid}" >> "${processed_file}"
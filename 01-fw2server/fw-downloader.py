@@ -16,13 +16,113 @@ Arguments:
     --fw_instance_url: URL/server address of Flywheel Instance (e.g., cni.flywheel.io)
     --fw_group_id: Flywheel group ID (i.e., parent dir of all project IDs, fw://surname)
     --fw_api_key_file: Path to text file containing your Flywheel CLI API key (defaults to user's HOME directory)
+    --mode: 'tar' (one `fw download` of the whole session) or 'acquisitions' (per-file, resumable)
+    --workers: Number of files downloaded concurrently in acquisitions mode
+    --retries: Attempts per file in acquisitions mode before giving up
+    --fw_api_url: Flywheel API base URL (defaults to https://<fw_instance_url>/api)
+    --extract_dir: Acquisitions mode only: extract the DICOMs here as they arrive (fused download)
+
+In acquisitions mode the session's acquisitions are listed through the
+Flywheel API and their files are fetched concurrently into
+/scratch/users/<user>/fw_<session>/dicoms/<session>/<acquisition>/. Each file
+is written to <name>.part and resumed with an HTTP Range request if the
+transfer is interrupted; once complete its size and hash are checked against
+the API before it is renamed into place. Files already present with the
+expected size are skipped, so a rerun only fetches what is missing.
+
+With --extract_dir (fused mode) nothing is saved under fw_<session>: each
+archive is received into memory (spilling to a local temp file above
+512 MB), verified, and its DICOMs are extracted straight into the step-02
+work dir with screenshot series dropped (02-dcm2niix/dicom_extract.py).
+Extracted archives are recorded in fw_<session>/dicoms/<session>_extracted.json
+so a rerun skips them.
 """
 
 import argparse
+import hashlib
+import http.client
+import json
 import os
 import logging
+import re
 import subprocess
-from typing import Tuple
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import BinaryIO, List, NamedTuple, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "02-dcm2niix"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "toolbox"))
+
+import dicom_extract
+import sidecar_io
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class RemoteFile(NamedTuple):
+    acquisition_id: str
+    acquisition_dir: str
+    name: str
+    size: int
+    hash: Optional[str]
+
+
+class DownloadResult(NamedTuple):
+    name: str
+    bytes: int
+    seconds: float
+    skipped: bool
+
+
+def parse_fw_hash(fw_hash: Optional[str]) -> Optional[Tuple[str, str]]:
+    """Split a Flywheel file hash ('v0-sha384-<hex>') into (algorithm, hexdigest)."""
+    if not fw_hash:
+        return None
+    match = re.fullmatch(r"v0-(\w+)-([0-9a-fA-F]+)", fw_hash)
+    if match and match.group(1) in hashlib.algorithms_available:
+        return match.group(1), match.group(2).lower()
+    return None
+
+
+def stream_digest(fileobj: BinaryIO, algorithm: str) -> str:
+    digest = hashlib.new(algorithm)
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FusedState:
+    """Files already extracted by a fused download, keyed by acquisition and hash."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self._done = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._done = {}
+
+    @staticmethod
+    def _key(remote: RemoteFile) -> str:
+        return f"{remote.acquisition_id}/{remote.name}"
+
+    def is_done(self, remote: RemoteFile) -> bool:
+        return self._done.get(self._key(remote)) == [remote.size, remote.hash]
+
+    def mark_done(self, remote: RemoteFile) -> None:
+        with self._lock:
+            self._done[self._key(remote)] = [remote.size, remote.hash]
+            sidecar_io.write_json(self.path, self._done)
 
 
 class FlywheelDownloader:
@@ -37,6 +137,14 @@ class FlywheelDownloader:
         fw_instance_url: str,
         fw_group_id: str,
         fw_api_key_file: str = "flywheel_api_key.txt",
+        mode: str = "tar",
+        workers: int = 4,
+        retries: int = 3,
+        fw_api_url: Optional[str] = None,
+        timeout: float = 60.0,
+        retry_delay: float = 2.0,
+        extract_dir: Optional[str] = None,
+        spool_max_bytes: int = 512 * 1024 ** 2,
     ):
         self.user = user
         self.fw_subject_id = fw_subject_id
@@ -45,6 +153,14 @@ class FlywheelDownloader:
         self.fw_instance_url = fw_instance_url
         self.fw_group_id = fw_group_id
         self.fw_api_key_file = fw_api_key_file
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.retries = max(1, retries)
+        self.fw_api_url = (fw_api_url or f"https://{fw_instance_url}/api").rstrip("/")
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.extract_dir = extract_dir
+        self.spool_max_bytes = spool_max_bytes
         self.logger = self._setup_logger()
 
     def _setup_logger(self) -> logging.Logger:
@@ -132,12 +248,218 @@ class FlywheelDownloader:
             self.logger.error(f"{data_type} download failed: {str(e)}")
             return False
 
+    def _api_request(self, path: str, data: Optional[dict] = None,
+                     headers: Optional[dict] = None) -> urllib.request.Request:
+        request = urllib.request.Request(
+            f"{self.fw_api_url}/{path.lstrip('/')}",
+            data=json.dumps(data).encode() if data is not None else None,
+            headers={"Authorization": f"scitran-user {self._get_api_key()}", **(headers or {})},
+        )
+        if data is not None:
+            request.add_header("Content-Type", "application/json")
+        return request
+
+    def _api_json(self, path: str, data: Optional[dict] = None):
+        with urllib.request.urlopen(self._api_request(path, data), timeout=self.timeout) as response:
+            return json.load(response)
+
+    def list_acquisition_files(self, data_type: str) -> List[RemoteFile]:
+        """Files of the given type in every acquisition of the session."""
+        session = self._api_json(
+            "lookup",
+            {"path": [self.fw_group_id, self.fw_project_id, self.fw_subject_id, self.fw_session_id]},
+        )
+        acquisitions = self._api_json(f"sessions/{session['_id']}/acquisitions")
+
+        files = []
+        seen_dirs = set()
+        for acq in acquisitions:
+            acq_dir = re.sub(r"[^\w.-]+", "_", acq.get("label") or acq["_id"])
+            if acq_dir in seen_dirs:
+                acq_dir = f"{acq_dir}_{acq['_id']}"
+            seen_dirs.add(acq_dir)
+            for f in acq.get("files", []):
+                if f.get("type") != data_type:
+                    continue
+                files.append(RemoteFile(acq["_id"], acq_dir, f["name"], int(f.get("size", 0)), f.get("hash")))
+        return files
+
+    def _fetch(self, remote: RemoteFile, out: BinaryIO) -> int:
+        """Append the missing bytes of remote to out, resuming from its current length."""
+        offset = out.seek(0, os.SEEK_END)
+        if offset > remote.size:
+            offset = 0
+        if remote.size and offset == remote.size:
+            return 0
+
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        path = f"acquisitions/{remote.acquisition_id}/files/{urllib.parse.quote(remote.name)}"
+        written = 0
+        with urllib.request.urlopen(self._api_request(path, headers=headers), timeout=self.timeout) as response:
+            if offset and response.status != 206:
+                self.logger.warning(f"Server ignored resume request for {remote.name}, restarting")
+                offset = 0
+            out.seek(offset)
+            out.truncate()
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                out.write(chunk)
+                written += len(chunk)
+        return written
+
+    def _verify(self, remote: RemoteFile, fileobj: BinaryIO) -> bool:
+        size = fileobj.seek(0, os.SEEK_END)
+        if remote.size and size != remote.size:
+            self.logger.warning(f"{remote.name}: size {size} does not match expected {remote.size}")
+            return False
+        expected = parse_fw_hash(remote.hash)
+        if expected is not None:
+            algorithm, hexdigest = expected
+            if stream_digest(fileobj, algorithm) != hexdigest:
+                self.logger.warning(f"{remote.name}: {algorithm} checksum mismatch")
+                return False
+        return True
+
+    def _download_into(self, remote: RemoteFile, out: BinaryIO) -> int:
+        """
+        Fill out with the verified contents of remote, resuming interrupted
+        transfers and retrying with backoff. Returns the bytes transferred.
+        """
+        transferred = 0
+        for attempt in range(1, self.retries + 1):
+            try:
+                transferred += self._fetch(remote, out)
+                received = out.seek(0, os.SEEK_END)
+                if received < remote.size:
+                    # keep what was received; the next attempt resumes from here
+                    raise ConnectionError(f"transfer ended after {received} of {remote.size} bytes")
+                if self._verify(remote, out):
+                    return transferred
+                out.seek(0)
+                out.truncate()
+            except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+                self.logger.warning(
+                    f"{remote.name}: attempt {attempt}/{self.retries} failed: {e}"
+                )
+            if attempt < self.retries:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+        raise RuntimeError(f"Failed to download {remote.name} after {self.retries} attempts")
+
+    def _log_transfer(self, action: str, remote: RemoteFile, transferred: int, elapsed: float) -> None:
+        rate = transferred / 1024 ** 2 / elapsed if elapsed > 0 else 0.0
+        self.logger.info(
+            f"{action} {remote.acquisition_dir}/{remote.name}: "
+            f"{transferred / 1024 ** 2:.1f} MB in {elapsed:.1f}s ({rate:.1f} MB/s)"
+        )
+
+    def download_file(self, remote: RemoteFile, output_dir: str) -> DownloadResult:
+        """
+        Download one file to output_dir/<acquisition>/, resuming from a previous
+        .part file. An existing file is only skipped if it passes _verify.
+        """
+        acq_dir = os.path.join(output_dir, remote.acquisition_dir)
+        os.makedirs(acq_dir, exist_ok=True)
+        final_path = os.path.join(acq_dir, remote.name)
+        part_path = f"{final_path}.part"
+
+        if os.path.exists(final_path):
+            # a file of the right size may still be truncated or corrupt; check its hash too
+            with open(final_path, "rb") as existing:
+                if self._verify(remote, existing):
+                    return DownloadResult(remote.name, 0, 0.0, True)
+            self.logger.warning(f"{remote.name}: existing file failed verification, downloading again")
+            os.remove(final_path)
+
+        start = time.perf_counter()
+        with open(part_path, "r+b" if os.path.exists(part_path) else "w+b") as out:
+            transferred = self._download_into(remote, out)
+        os.replace(part_path, final_path)
+        elapsed = time.perf_counter() - start
+        self._log_transfer("Downloaded", remote, transferred, elapsed)
+        return DownloadResult(remote.name, transferred, elapsed, False)
+
+    def extract_file(self, remote: RemoteFile, extract_dir: str, state: "FusedState") -> DownloadResult:
+        """
+        Download one .dicom.zip into memory and extract its DICOMs straight into
+        extract_dir; the archive itself never touches scratch.
+        """
+        if state.is_done(remote):
+            return DownloadResult(remote.name, 0, 0.0, True)
+
+        start = time.perf_counter()
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_max_bytes) as out:
+            transferred = self._download_into(remote, out)
+            out.seek(0)
+            dicom_extract.extract_zip(out, Path(extract_dir), f"{remote.acquisition_dir}/{remote.name}")
+        state.mark_done(remote)
+        elapsed = time.perf_counter() - start
+        self._log_transfer("Downloaded and extracted", remote, transferred, elapsed)
+        return DownloadResult(remote.name, transferred, elapsed, False)
+
+    def download_acquisitions(self, data_type: str, output_dir: str, extract_dir: Optional[str] = None) -> bool:
+        """
+        Download every data_type file of the session concurrently. With
+        extract_dir set, each archive is extracted there as it arrives
+        instead of being saved under output_dir.
+        """
+        session_dir = os.path.join(output_dir, self.fw_session_id)
+        try:
+            files = self.list_acquisition_files(data_type)
+        except (urllib.error.URLError, KeyError, ValueError) as e:
+            self.logger.error(f"Listing acquisitions of session {self.fw_session_id} failed: {e}")
+            return False
+        if not files:
+            self.logger.error(f"No {data_type} files found in session {self.fw_session_id}")
+            return False
+
+        total_size = sum(f.size for f in files)
+        target = extract_dir or session_dir
+        self.logger.info(
+            f"Downloading {len(files)} {data_type} files ({total_size / 1024 ** 2:.1f} MB) "
+            f"{'and extracting into' if extract_dir else 'to'} {target} with {self.workers} workers"
+        )
+
+        if extract_dir:
+            os.makedirs(extract_dir, exist_ok=True)
+            state = FusedState(os.path.join(output_dir, f"{self.fw_session_id}_extracted.json"))
+            task = lambda f: self.extract_file(f, extract_dir, state)
+        else:
+            task = lambda f: self.download_file(f, session_dir)
+
+        start = time.perf_counter()
+        results, failed = [], []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(task, f): f for f in files}
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except RuntimeError as e:
+                    self.logger.error(str(e))
+                    failed.append(futures[future].name)
+                except (zipfile.BadZipFile, OSError) as e:
+                    # one bad file (corrupt archive, disk full, permissions) must not abort the summary
+                    self.logger.error(f"{futures[future].name}: {e}")
+                    failed.append(futures[future].name)
+
+        elapsed = time.perf_counter() - start
+        transferred = sum(r.bytes for r in results)
+        skipped = sum(r.skipped for r in results)
+        rate = transferred / 1024 ** 2 / elapsed if elapsed > 0 else 0.0
+        self.logger.info(
+            f"Transferred {transferred / 1024 ** 2:.1f} MB in {elapsed:.1f}s ({rate:.1f} MB/s); "
+            f"{len(results) - skipped} downloaded, {skipped} already complete, {len(failed)} failed"
+        )
+        return not failed
+
     def run(self) -> bool:
-        self.login_to_fw()
         _, dir_dicom = self.make_directories()
-        self.download("dicom", dir_dicom)
-        self.logger.info("Flywheel Downloader workflow completed successfully!")
-        return True
+        if self.mode == "acquisitions":
+            success = self.download_acquisitions("dicom", dir_dicom, self.extract_dir)
+        else:
+            self.login_to_fw()
+            success = self.download("dicom", dir_dicom)
+        if success:
+            self.logger.info("Flywheel Downloader workflow completed successfully!")
+        return success
 
 
 def parse_arguments() -> argparse.Namespace:
@@ -174,12 +496,49 @@ def parse_arguments() -> argparse.Namespace:
         default="flywheel_api_key.txt",
         help="Filename with Flywheel CLI API key within user HOME dir",
     )
+    parser.add_argument(
+        "--mode",
+        action="store",
+        choices=["tar", "acquisitions"],
+        default="tar",
+        help="'tar': one fw download of the session; 'acquisitions': resumable per-file download",
+    )
+    parser.add_argument(
+        "--workers",
+        action="store",
+        type=int,
+        default=4,
+        help="Number of files downloaded concurrently in acquisitions mode",
+    )
+    parser.add_argument(
+        "--retries",
+        action="store",
+        type=int,
+        default=3,
+        help="Attempts per file in acquisitions mode",
+    )
+    parser.add_argument(
+        "--fw_api_url",
+        action="store",
+        default=None,
+        help="Flywheel API base URL (defaults to https://<fw_instance_url>/api)",
+    )
+    parser.add_argument(
+        "--extract_dir",
+        action="store",
+        default=None,
+        help="Acquisitions mode only: extract each archive into this directory as it downloads "
+        "(e.g., /scratch/users/<user>/sub-<subid>/dcm2niix_work_dir/sub-<subid>) instead of saving the zips",
+    )
     return parser.parse_args()
 
 
 def main():
     args = parse_arguments()
 
+    if args.extract_dir and args.mode != "acquisitions":
+        raise ValueError("--extract_dir requires --mode acquisitions")
+
     if args.user is None:
         raise ValueError(
             "SUNet ID user argument not defined, please do so with the --user flag!"
@@ -223,6 +582,11 @@ def main():
         fw_instance_url=args.fw_instance_url,
         fw_group_id=args.fw_group_id,
         fw_api_key_file=args.fw_api_key_file,
+        mode=args.mode,
+        workers=args.workers,
+        retries=args.retries,
+        fw_api_url=args.fw_api_url,
+        extract_dir=args.extract_dir,
     )
 
     success = fw_downloader.run()
@@ -19,10 +19,14 @@ Arguments:
     --grouping: Heudiconv grouping strategy (default: 'studyUID', use 'all' for merged sessions)
 """
 
-import argparse, os, shutil, tarfile, subprocess
-from glob import glob
+import argparse, os, shutil, subprocess, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+import dcm_heuristic
+import dicom_extract
+import dicom_manifest
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Convert DICOM tarball to BIDS.')
@@ -39,10 +43,79 @@ def parse_args():
                         help="Heudiconv grouping strategy. Use 'all' to bypass the 'Conflicting study identifiers found' assertion when working with manually merged sessions. Default: 'all'")
     parser.add_argument("--skip-tar", action="store_true", default=False,
                         help="Skip tar extraction step. Use this flag when working with manually configured scan directories that don't need tar extraction.")
+    parser.add_argument("--heudiconv_workers", action="store", type=int, default=0,
+                        help="Number of exam sessions converted concurrently in the --skip-tar multi-exam path (default/0: all sessions at once)")
+    parser.add_argument("--extract_workers", action="store", type=int, default=0,
+                        help="Number of .dicom.zip archives extracted concurrently (default/0: SLURM_CPUS_PER_TASK or CPU count)")
+    parser.add_argument("--scan_config", action="store", default=None,
+                        help="Path to scan-config.json used to classify series (default: scan-config.json at the repo root)")
+    parser.add_argument("--experiment_type", action="store", default=None,
+                        help="Experiment type in scan-config.json restricting the expected sequences (default: all sequences)")
+    parser.add_argument("--heuristic_verbose", action="store_true", default=False,
+                        help="Print every sequence the heuristic sees and where it is assigned")
     return parser.parse_args()
 
+def configure_heuristic(args):
+    """
+    Export the heuristic settings for dcm_heuristic, both to this process and,
+    via SINGULARITYENV_, to the heudiconv container (which runs with --cleanenv).
+    """
+    settings = {
+        'HEURISTIC_SCAN_CONFIG': str(Path(args.scan_config).resolve()) if args.scan_config else '',
+        'HEURISTIC_TASK_ID': args.task_id,
+        'HEURISTIC_EXPERIMENT_TYPE': args.experiment_type or '',
+        'HEURISTIC_VERBOSE': '1' if args.heuristic_verbose else '0',
+    }
+    for name, value in settings.items():
+        os.environ[name] = value
+        os.environ[f"SINGULARITYENV_{name}"] = value
+
+def heudiconv_files(container_root, series_dirs):
+    """heudiconv --files argument restricting conversion to the given series directories."""
+    return "--files " + " ".join(f"{container_root}/{d}" for d in sorted(series_dirs))
+
+def run_session_heudiconv(args, session_id, series_dirs, scratch_work_dir, bids_dir, heu_file):
+    """
+    Run heudiconv for one exam session of a merged multi-exam subject.
+
+    The session sees only its own series: each series directory is bind-mounted
+    read-only onto an empty mount point in a per-session view, so no DICOMs are
+    moved. heudiconv's conversion cache (--conv-outdir) is private to the
+    session, so concurrent sessions never share .heudiconv state.
+
+    Returns:
+        (session_id, return code, combined stdout/stderr, elapsed seconds)
+    """
+    session_view = scratch_work_dir / f"view_{session_id}"
+    session_cache = scratch_work_dir / f"heudiconv_cache_{session_id}"
+    for d in (session_view, session_cache):
+        if d.exists():
+            shutil.rmtree(d)
+        d.mkdir(parents=True)
+
+    binds = [f"-B {session_view}:/indir", f"-B {bids_dir}:/outdir", f"-B {session_cache}:/convdir"]
+    for series_dir in series_dirs:
+        (session_view / series_dir.name).mkdir()
+        binds.append(f"-B {series_dir}:/indir/{series_dir.name}:ro")
+
+    cmd = (
+        f"singularity run --cleanenv "
+        f"{' '.join(binds)} "
+        f"-e {args.sing_image_path} "
+        f"{heudiconv_files('/indir', [d.name for d in series_dirs])} "
+        f"-o /outdir/ --conv-outdir /convdir -f {heu_file} -s {args.subid} -ss {session_id} "
+        f"-c dcm2niix -b notop --overwrite "
+        f"--grouping {args.grouping}"
+    )
+    start = time.perf_counter()
+    result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return session_id, result.returncode, result.stdout, time.perf_counter() - start
+
 def main():
     args = parse_args()
+    configure_heuristic(args)
+    if args.extract_workers <= 0:
+        args.extract_workers = dicom_extract.default_workers()
 
     if args.user is None:
         raise ValueError(
@@ -62,6 +135,8 @@ def main():
     # Source and target DICOM tar
     tar_input = scratch_base / f"fw_{args.exam_num}" / "dicoms" / f"{args.exam_num}.tar"
     tar_target = scratch_work_dir / f"sub-{args.subid}.tar"
+    # Per-acquisition download (fw-downloader.py --mode acquisitions)
+    acq_download_dir = scratch_base / f"fw_{args.exam_num}" / "dicoms" / f"{args.exam_num}"
 
     # Make needed dirs
     dicom_extract_dir = scratch_work_dir / f"sub-{args.subid}"
@@ -102,71 +177,69 @@ def main():
             exam_zip_count = sum(1 for zf in all_zip_files if exam_id in str(zf))
             print(f"  - Exam {exam_id}: {exam_zip_count} .zip files")
 
-        # Unzip ALL found zip files
-        print(f"[INFO] Unzipping all files to {dicom_extract_dir}")
-        for zf in all_zip_files:
-            subprocess.run(['unzip', '-qq', str(zf), '-d', str(dicom_extract_dir)], check=True)
+        # Unzip ALL found zip files (screenshot series are skipped while extracting)
+        print(f"[INFO] Unzipping all files to {dicom_extract_dir} ({args.extract_workers} workers)")
+        start = time.perf_counter()
+        stats = dicom_extract.extract_zip_files(all_zip_files, dicom_extract_dir, workers=args.extract_workers)
+        dicom_extract.log_summary(stats, time.perf_counter() - start)
+    elif not tar_input.exists() and not acq_download_dir.is_dir() and any(dicom_extract_dir.iterdir()):
+        # Fused download (fw-downloader.py --extract_dir) already extracted the DICOMs here
+        print(f"[INFO] DICOMs already extracted into {dicom_extract_dir} by the download step, skipping extraction")
+    elif not tar_input.exists() and acq_download_dir.is_dir():
+        # Acquisitions were downloaded individually; extract their zips in place
+        acq_zip_files = sorted(acq_download_dir.glob("*/*.zip"))
+        if not acq_zip_files:
+            raise FileNotFoundError(f"No .zip files found under {acq_download_dir}")
+        print(f"[INFO] Found {len(acq_zip_files)} downloaded acquisition archive(s) in {acq_download_dir}")
+        print(f"[INFO] Unzipping all files to {dicom_extract_dir} ({args.extract_workers} workers)")
+        start = time.perf_counter()
+        stats = dicom_extract.extract_zip_files(acq_zip_files, dicom_extract_dir, workers=args.extract_workers)
+        dicom_extract.log_summary(stats, time.perf_counter() - start)
     else:
-        # Untar
-        print(f"[INFO] Extracting {tar_input} -> {untar_dir}")
-        shutil.move(str(tar_input), scratch_sub_dir / f"{args.exam_num}.tar")
-        with tarfile.open(scratch_sub_dir / f"{args.exam_num}.tar") as tar:
-            tar.extractall(path=untar_dir)
-
-        # Unzip DICOMs from single exam session
-        flywheel_base_path = untar_dir / "scitran" / args.fw_group_id / args.fw_project_id
-        subject_dirs = glob(f"{flywheel_base_path}/*/{args.exam_num}")
-        if not subject_dirs:
-            raise FileNotFoundError(f"No matching subject folder found under {flywheel_base_path}/*/{args.exam_num}")
-        subject_dir = Path(subject_dirs[0])
-
-        print(f"[INFO] Unzipping all zip files from {subject_dir}")
-        for zf in subject_dir.glob("**/*.zip"):
-            subprocess.run(['unzip', '-qq', str(zf), '-d', str(dicom_extract_dir)], check=True)
-
-    # Delete screenshots
-    for pattern in ["*2000*.dicom", "*4000*.dicom", "*_200*.dicom"]:
-        for f in dicom_extract_dir.glob(pattern):
-            print(f"[INFO] Removing {f}")
-            if f.is_file():
-                f.unlink()
-            elif f.is_dir():
-                shutil.rmtree(f)
-
-    print(f"[INFO] Screenshot DICOMs deleted from {dicom_extract_dir}")
-
-    # Validate DICOM files exist before running heudiconv
-    # Check for DICOM files with various extensions (case-insensitive)
-    # Note: Using multiple patterns for Python 3.9+ compatibility
-    # (glob's case_sensitive parameter was added in Python 3.12)
-    dicom_patterns = ["**/*.dcm", "**/*.DCM", "**/*.dicom", "**/*.DICOM"]
-    dicom_files = []
-    for pattern in dicom_patterns:
-        dicom_files.extend(dicom_extract_dir.glob(pattern))
-    
-    if not dicom_files:
+        # Stream the exam's DICOM zips straight out of the tar; nothing is untarred to
+        # scratch and screenshot series are dropped before they are written
+        tar_path = scratch_sub_dir / f"{args.exam_num}.tar"
+        shutil.move(str(tar_input), tar_path)
+        member_glob = f"scitran/{args.fw_group_id}/{args.fw_project_id}/*/{args.exam_num}/*.zip"
+        print(f"[INFO] Extracting DICOMs from {tar_path} -> {dicom_extract_dir} ({args.extract_workers} workers)")
+        start = time.perf_counter()
+        stats = dicom_extract.extract_tar_dicoms(tar_path, dicom_extract_dir, member_glob,
+                                                 workers=args.extract_workers)
+        dicom_extract.log_summary(stats, time.perf_counter() - start)
+
+    # Pre-scan DICOM headers into a series manifest (reused on reruns for unchanged series)
+    manifest_path = dicom_manifest.manifest_path_for(dicom_extract_dir)
+    manifest = dicom_manifest.build_manifest(dicom_extract_dir, manifest_path, workers=args.extract_workers)
+    series = manifest["series"]
+
+    if not series:
         raise FileNotFoundError(
             f"No DICOM files found in {dicom_extract_dir}. "
             f"Please verify the ZIP files were extracted correctly. "
-            f"Searched for patterns: {', '.join(dicom_patterns)}"
+            f"Searched for extensions: {', '.join(dicom_manifest.DICOM_SUFFIXES)}"
         )
-    
-    print(f"[INFO] Found {len(dicom_files)} DICOM files in {dicom_extract_dir}")
-    
+
+    print(f"[INFO] Found {sum(s['n_files'] for s in series)} DICOM files in {dicom_extract_dir}")
+
     # Log directory structure for debugging
-    # Build a directory-to-file-count mapping in a single pass
-    dir_file_counts = {}
-    for f in dicom_files:
-        parent_dir = f.parent
-        dir_file_counts[parent_dir] = dir_file_counts.get(parent_dir, 0) + 1
-
-    dicom_dirs = list(dir_file_counts.keys())
-    print(f"[INFO] DICOM files are organized in {len(dicom_dirs)} directories:")
-    for d in sorted(dicom_dirs)[:5]:  # Show first 5 directories
-        file_count = dir_file_counts[d]
-        print(f"  - {d.name}: {file_count} files")
-    if len(dicom_dirs) > 5:
-        print(f"  ... and {len(dicom_dirs) - 5} more directories")
+    print(f"[INFO] DICOM files are organized in {len(series)} directories:")
+    for s in sorted(series, key=lambda s: s['dcm_dir'])[:5]:  # Show first 5 directories
+        print(f"  - {s['dcm_dir']}: {s['n_files']} files")
+    if len(series) > 5:
+        print(f"  ... and {len(series) - 5} more directories")
+
+    # Classify series with the heuristic up front; heudiconv only gets the series it keeps
+    kept_dirs = set()
+    for s in series:
+        keys = dcm_heuristic.classify_series(s['series_description'], s['series_number'])
+        status = f"-> {', '.join(keys)}" if keys else "-> skipped"
+        print(f"[INFO] Series {s['series_number']} '{s['series_description']}' "
+              f"({s['dim1']}x{s['dim2']}x{s['dim3']}x{s['dim4']}) {status}")
+        if keys:
+            kept_dirs.add(Path(s['dcm_dir']).parts[0])
+    if not kept_dirs:
+        raise FileNotFoundError(f"No series in {manifest_path} matched the heuristic {heu_file}")
+    print(f"[INFO] Passing {len(kept_dirs)} of {len(series)} series to heudiconv")
 
     # Clear heudiconv cache to avoid using stale file paths
     # This is especially important when manually curating directories
@@ -188,39 +261,41 @@ def main():
         exam_ids = sorted(set([d.name.split('_')[0] for d in exam_dirs]))
 
         if len(exam_ids) > 1:
+            heudiconv_workers = args.heudiconv_workers if args.heudiconv_workers > 0 else len(exam_ids)
             print(f"[INFO] Detected {len(exam_ids)} exam sessions: {', '.join(exam_ids)}")
             print(f"[INFO] Processing each exam as a separate session to avoid sequence deduplication")
 
+            print(f"[INFO] Converting {len(exam_ids)} sessions concurrently ({heudiconv_workers} workers)")
+
+            sessions = {}
             for session_num, exam_id in enumerate(exam_ids, start=1):
                 session_id = f"ses-{session_num:02d}"
-                print(f"\n[INFO] Processing exam {exam_id} as {session_id}")
-
-                # Create session-specific work directory
-                session_work_dir = scratch_work_dir / f"session_{exam_id}"
-                session_work_dir.mkdir(parents=True, exist_ok=True)
-
-                # Move only this exam's DICOMs to session work dir
-                for dicom_dir in dicom_extract_dir.glob(f"{exam_id}_*"):
-                    if dicom_dir.is_dir():
-                        target = session_work_dir / dicom_dir.name
-                        if not target.exists():
-                            shutil.move(str(dicom_dir), str(session_work_dir))
-
-                # Run heudiconv for this session
-                cmd = (
-                    f"singularity run --cleanenv "
-                    f"-B {session_work_dir}:/indir -B {bids_dir}:/outdir "
-                    f"-e {args.sing_image_path} "
-                    f"-d /indir/{{subject}}_*.dicom/*.dcm "
-                    f"-o /outdir/ -f {heu_file} -s {args.subid} -ss {session_id} -c dcm2niix -b notop --overwrite "
-                    f"--grouping {args.grouping}"
-                )
-                subprocess.run(cmd, shell=True, check=True)
-
-                # Move DICOMs back for cleanup
-                for dicom_dir in session_work_dir.glob(f"{exam_id}_*"):
-                    if dicom_dir.is_dir():
-                        shutil.move(str(dicom_dir), str(dicom_extract_dir))
+                print(f"[INFO] Exam {exam_id} -> {session_id}")
+                series_dirs = [d for d in exam_dirs if d.name.startswith(f"{exam_id}_") and d.name in kept_dirs]
+                if not series_dirs:
+                    print(f"[WARNING] No series of exam {exam_id} matched the heuristic, skipping {session_id}")
+                    continue
+                sessions[session_id] = series_dirs
+
+            with ThreadPoolExecutor(max_workers=heudiconv_workers) as pool:
+                futures = {
+                    pool.submit(run_session_heudiconv, args, session_id, series_dirs, scratch_work_dir,
+                                bids_dir, heu_file): session_id
+                    for session_id, series_dirs in sessions.items()
+                }
+                failed = []
+                for future in as_completed(futures):
+                    session_id, returncode, output, elapsed = future.result()
+                    for line in output.splitlines():
+                        print(f"[{session_id}] {line}")
+                    if returncode != 0:
+                        print(f"[ERROR] heudiconv failed for {session_id} (exit code {returncode})")
+                        failed.append(session_id)
+                    else:
+                        print(f"[INFO] heudiconv finished {session_id} in {elapsed:.0f}s")
+
+            if failed:
+                raise RuntimeError(f"heudiconv failed for session(s): {', '.join(sorted(failed))}")
         else:
             print(f"[INFO] Single exam session detected, processing normally")
             print(f"[INFO] Running heudiconv for sub-{args.subid} as ses-01")
@@ -229,7 +304,7 @@ def main():
                 f"singularity run --cleanenv "
                 f"-B {dicoms_dir}:/indir -B {bids_dir}:/outdir "
                 f"-e {args.sing_image_path} "
-                f"-d /indir/sub-{{subject}}/*.dicom/*.dcm "
+                f"{heudiconv_files(f'/indir/sub-{args.subid}', kept_dirs)} "
                 f"-o /outdir/ -f {heu_file} -s {args.subid} -ss ses-01 -c dcm2niix -b notop --overwrite "
                 f"--grouping {args.grouping}"
             )
@@ -242,7 +317,7 @@ def main():
             f"singularity run --cleanenv "
             f"-B {dicoms_dir}:/indir -B {bids_dir}:/outdir "
             f"-e {args.sing_image_path} "
-            f"-d /indir/sub-{{subject}}/*.dicom/*.dcm "
+            f"{heudiconv_files(f'/indir/sub-{args.subid}', kept_dirs)} "
             f"-o /outdir/ -f {heu_file} -s {args.subid} -ss ses-01 -c dcm2niix -b notop --overwrite "
             f"--grouping {args.grouping}"
         )
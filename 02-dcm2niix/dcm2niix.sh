@@ -32,6 +32,12 @@ for arg in "$@"; do
   fi
 done
 
+# Print the heuristic's per-sequence assignments when debug mode is on
+heuristic_verbose_flag=""
+if [ "${DEBUG:-0}" = "1" ]; then
+  heuristic_verbose_flag="--heuristic_verbose"
+fi
+
 subject="sub-${new_subid}"
 
 # logging setup
@@ -61,6 +67,10 @@ python3 "${SCRIPTS_DIR}"/"${JOB_NAME}"/dcm2niix.py \
   --sing_image_path "${SINGULARITY_IMAGE_DIR}"/"${HEUDICONV_IMAGE}" \
   --scripts_dir "${SCRIPTS_DIR}"/${JOB_NAME} \
   --grouping "${grouping}" \
+  --extract_workers "${DCM2NIIX_WORKERS:-0}" \
+  --scan_config "${CONFIG_FILE}" \
+  --experiment_type "${EXPERIMENT_TYPE}" \
+  ${heuristic_verbose_flag} \
   ${skip_tar_flag}
 echo "($(date)) [INFO] Raw dicom to BIDS conversion complete" | tee -a "${log_file}"
 
@@ -1,4 +1,26 @@
-"""Heuristic file for heudiconv."""
+"""Heuristic file for heudiconv.
+
+Series are classified with the table compiled from scan-config.json
+(toolbox/series_table.py), the same table the metadata QC uses. The config
+path, BOLD task label, experiment type and verbosity are read from the
+environment so the heuristic behaves the same on the host (dcm2niix.py) and
+inside the heudiconv container (via SINGULARITYENV_):
+
+    HEURISTIC_SCAN_CONFIG      path to scan-config.json (default: <repo>/scan-config.json)
+    HEURISTIC_TASK_ID          task label of the BOLD files (default: amass)
+    HEURISTIC_EXPERIMENT_TYPE  experiment type in scan-config.json (default: all sequences)
+    HEURISTIC_VERBOSE          set to 1 to print every sequence and its assignment
+"""
+
+import os
+import sys
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR / 'toolbox'))
+
+import series_table
+
 
 def create_key(template, outtype=('nii.gz',), annotation_classes=None):
     """Key template."""
@@ -7,6 +29,41 @@ def create_key(template, outtype=('nii.gz',), annotation_classes=None):
     return template, outtype, annotation_classes
 
 
+# scan-config.json sequence type -> heuristic key name
+SEQUENCE_KEYS = {
+    't1': 't1w',
+    't2': 't2',
+    'mt': 'mtlc',
+    'test': 'func_test',
+    'pe1': 'fmap',
+}
+
+
+DEFAULT_TASK_ID = 'amass'
+
+
+def task_id():
+    return os.environ.get('HEURISTIC_TASK_ID') or DEFAULT_TASK_ID
+
+
+def is_verbose():
+    return os.environ.get('HEURISTIC_VERBOSE', '0') not in ('', '0')
+
+
+def load_series_table():
+    """Compiled series table for HEURISTIC_SCAN_CONFIG (cached until the file changes)."""
+    config_path = os.environ.get('HEURISTIC_SCAN_CONFIG') or REPO_DIR / 'scan-config.json'
+    return series_table.load_table(config_path, os.environ.get('HEURISTIC_EXPERIMENT_TYPE'))
+
+
+def classify_series(series_description, series_number=None):
+    """Names of the heuristic keys a series is assigned to (empty if it is dropped)."""
+    rule = load_series_table().classify(series_description, series_number)
+    if rule is None or rule.sequence_type not in SEQUENCE_KEYS:
+        return []
+    return [SEQUENCE_KEYS[rule.sequence_type]]
+
+
 def infotodict(seqinfo):
     """Create information dict for each image.
 
@@ -23,7 +80,8 @@ def infotodict(seqinfo):
     t1w = create_key('sub-{subject}/{session}/anat/sub-{subject}_{session}_T1w')
     t2 = create_key('sub-{subject}/{session}/anat/sub-{subject}_{session}_inplaneT2')
     mtlc = create_key('sub-{subject}/{session}/anat/sub-{subject}_{session}_mt-lc')
-    func_test = create_key('sub-{subject}/{session}/func/sub-{subject}_{session}_task-amass_run-{item:02d}_dir-PA_bold')
+    func_test = create_key('sub-{subject}/{session}/func/sub-{subject}_{session}_task-' + task_id() +
+                           '_run-{item:02d}_dir-PA_bold')
     fmap = create_key('sub-{subject}/{session}/fmap/sub-{subject}_{session}_run-{item:02d}_dir-AP_epi')
 
     info = {
@@ -33,12 +91,13 @@ def infotodict(seqinfo):
         func_test: [],
         fmap: []
     }
+    keys = {'t1w': t1w, 't2': t2, 'mtlc': mtlc, 'func_test': func_test, 'fmap': fmap}
 
-    # Debug: print all seqinfo to understand what we're getting
-    # This will help identify why some series are being skipped
-    print(f"\n[HEURISTIC DEBUG] Processing {len(seqinfo)} sequences:")
-    for idx, s in enumerate(seqinfo):
-        print(f"  [{idx}] series_id={s.series_id}, dcm_dir={s.dcm_dir_name}, desc={s.series_description}, dim4={s.dim4}")
+    verbose = is_verbose()
+    if verbose:
+        print(f"\n[HEURISTIC DEBUG] Processing {len(seqinfo)} sequences:")
+        for idx, s in enumerate(seqinfo):
+            print(f"  [{idx}] series_id={s.series_id}, dcm_dir={s.dcm_dir_name}, desc={s.series_description}, dim4={s.dim4}")
 
     for s in seqinfo:
         """
@@ -66,24 +125,18 @@ def infotodict(seqinfo):
         * image_type
         """
 
-        if ('T1' in s.series_description):
-            info[t1w].append(s.series_id)
-        if ('T2' in s.series_description):
-            info[t2].append(s.series_id)
-        if ('Xing2018' in s.series_description):
-            info[mtlc].append(s.series_id)
-        if ('test' in s.series_description):
-            info[func_test].append(s.series_id)
-        if ('CAL' in s.series_description):
-            info[fmap].append(s.series_id)
-
-    # Debug: print what we collected
-    print(f"\n[HEURISTIC DEBUG] Collected sequences:")
-    print(f"  T1w: {info[t1w]}")
-    print(f"  inplaneT2: {info[t2]}")
-    print(f"  mt-lc: {info[mtlc]}")
-    print(f"  func_test: {info[func_test]}")
-    print(f"  fmap: {info[fmap]}")
-    print()
+        # series_id is "<series number>-<protocol name>"
+        series_number = s.series_id.split('-', 1)[0]
+        for name in classify_series(s.series_description, series_number):
+            info[keys[name]].append(s.series_id)
+
+    if verbose:
+        print(f"\n[HEURISTIC DEBUG] Collected sequences:")
+        print(f"  T1w: {info[t1w]}")
+        print(f"  inplaneT2: {info[t2]}")
+        print(f"  mt-lc: {info[mtlc]}")
+        print(f"  func_test: {info[func_test]}")
+        print(f"  fmap: {info[fmap]}")
+        print()
 
     return info
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming DICOM extraction from Flywheel exam exports.
+
+Flywheel exports an exam as a .tar holding one `<series>.dicom.zip` per
+acquisition. Rather than untarring everything to scratch, unzipping each
+archive with `unzip` and deleting the screenshot series afterwards, the inner
+zips are read straight out of the tar and only the DICOMs heudiconv needs are
+written. Screenshot series (SCREENSHOT_PATTERNS) are dropped before anything
+touches the disk. The zips are extracted on a thread pool: zlib inflation
+and file writes release the GIL, so throughput scales with cores and disk
+bandwidth. Each archive's file count, bytes and wall time are logged as it
+completes.
+
+For an uncompressed tar every worker reads its zip through its own file handle
+as a seekable window onto the tar, so no archive is buffered in memory. For a
+compressed tar the members have to be read in order, so each zip is read into
+memory by the main thread and handed to a worker.
+
+@Description: Extract Flywheel .dicom.zip archives for heudiconv
+@Dependencies: Python 3.9+
+@Usage: Imported by dcm2niix.py
+"""
+
+import io
+import os
+import shutil
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Iterable, List, NamedTuple
+
+# Scanner screenshot / screen-save series, matched against the series directory inside each zip
+SCREENSHOT_PATTERNS = ("*2000*.dicom", "*4000*.dicom", "*_200*.dicom")
+
+COPY_BUFSIZE = 1024 * 1024
+
+
+class ExtractStats(NamedTuple):
+    archive: str
+    files: int
+    bytes: int
+    skipped: int
+    seconds: float
+
+
+def default_workers() -> int:
+    return int(os.environ.get('SLURM_CPUS_PER_TASK') or os.cpu_count() or 1)
+
+
+def is_screenshot(series_name: str) -> bool:
+    return any(fnmatch(series_name, pattern) for pattern in SCREENSHOT_PATTERNS)
+
+
+class _TarSlice(io.RawIOBase):
+    """Read-only, seekable view of one member's bytes inside an uncompressed tar."""
+
+    def __init__(self, path: Path, offset: int, size: int):
+        self._f = open(path, 'rb')
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._size
+        self._pos = max(0, min(pos, self._size))
+        return self._pos
+
+    def readinto(self, buf):
+        n = min(len(buf), self._size - self._pos)
+        if n <= 0:
+            return 0
+        self._f.seek(self._offset + self._pos)
+        n = self._f.readinto(memoryview(buf)[:n])
+        self._pos += n
+        return n
+
+    def close(self):
+        self._f.close()
+        super().close()
+
+
+def extract_zip(fileobj: BinaryIO, dest_dir: Path, archive: str) -> ExtractStats:
+    """
+    Extract one Flywheel .dicom.zip into dest_dir, skipping screenshot series.
+
+    Args:
+        fileobj: Seekable binary file object (or path) holding the zip
+        dest_dir: Directory the series directories are written into
+        archive: Name used in log messages
+
+    Returns:
+        ExtractStats for this archive
+    """
+    start = time.perf_counter()
+    files = nbytes = skipped = 0
+    skipped_series = set()
+    with zipfile.ZipFile(fileobj) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            parts = PurePosixPath(info.filename).parts
+            if not parts or info.filename.startswith('/') or '..' in parts:
+                print(f"[WARNING] Ignoring unsafe path {info.filename} in {archive}")
+                continue
+            if is_screenshot(parts[0]):
+                skipped += 1
+                skipped_series.add(parts[0])
+                continue
+            target = dest_dir.joinpath(*parts)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with zf.open(info) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+            files += 1
+            nbytes += info.file_size
+    for series in sorted(skipped_series):
+        print(f"[INFO] Skipping screenshot series {series}")
+    stats = ExtractStats(archive, files, nbytes, skipped, time.perf_counter() - start)
+    print(f"[INFO] Extracted {PurePosixPath(archive).name}: {files} files, "
+          f"{nbytes / 1024 ** 2:.1f} MB in {stats.seconds:.2f}s")
+    return stats
+
+
+def _extract_slice(tar_path: Path, member: tarfile.TarInfo, dest_dir: Path) -> ExtractStats:
+    with io.BufferedReader(_TarSlice(tar_path, member.offset_data, member.size), COPY_BUFSIZE) as f:
+        return extract_zip(f, dest_dir, member.name)
+
+
+def extract_tar_dicoms(tar_path: Path, dest_dir: Path, member_glob: str = '*.zip',
+                       workers: int = 1) -> List[ExtractStats]:
+    """
+    Extract the DICOMs of every zip in a Flywheel tar whose path matches member_glob.
+
+    Args:
+        tar_path: Flywheel exam tar (uncompressed tars are read without buffering)
+        dest_dir: Directory the series directories are written into
+        member_glob: fnmatch pattern selecting the zips inside the tar
+        workers: Number of zips extracted concurrently
+
+    Returns:
+        ExtractStats per extracted zip
+
+    Raises:
+        FileNotFoundError: if no member matches member_glob
+    """
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    workers = max(1, workers)
+
+    try:
+        tar = tarfile.open(tar_path, 'r:')
+        seekable = True
+    except tarfile.ReadError:
+        tar = tarfile.open(tar_path, 'r:*')
+        seekable = False
+
+    with tar, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for member in tar:
+            name = member.name[2:] if member.name.startswith('./') else member.name
+            if not member.isfile() or not fnmatch(name, member_glob):
+                continue
+            if seekable:
+                futures.append(pool.submit(_extract_slice, Path(tar_path), member, dest_dir))
+            else:
+                # bound memory use to roughly 2 archives per worker
+                while sum(not f.done() for f in futures) >= 2 * workers:
+                    next(f for f in futures if not f.done()).result()
+                data = tar.extractfile(member).read()
+                futures.append(pool.submit(extract_zip, io.BytesIO(data), dest_dir, member.name))
+        if not futures:
+            raise FileNotFoundError(f"No archives matching {member_glob} found in {tar_path}")
+        return [f.result() for f in futures]
+
+
+def extract_zip_files(zip_paths: Iterable[Path], dest_dir: Path, workers: int = 1) -> List[ExtractStats]:
+    """
+    Extract already-unpacked .dicom.zip archives (e.g. the --skip-tar layout) concurrently.
+
+    Args:
+        zip_paths: Archives to extract
+        dest_dir: Directory the series directories are written into
+        workers: Number of archives extracted concurrently
+
+    Returns:
+        ExtractStats per archive
+    """
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(extract_zip, str(zp), dest_dir, str(zp)) for zp in zip_paths]
+        return [f.result() for f in futures]
+
+
+def log_summary(stats: List[ExtractStats], elapsed: float) -> None:
+    """Print totals and aggregate throughput for one extraction phase."""
+    total_files = sum(s.files for s in stats)
+    total_bytes = sum(s.bytes for s in stats)
+    total_skipped = sum(s.skipped for s in stats)
+    rate = total_bytes / 1024 ** 2 / elapsed if elapsed > 0 else 0.0
+    print(f"[INFO] Extracted {total_files} DICOM files ({total_bytes / 1024 ** 2:.1f} MB) from {len(stats)} archives "
+          f"in {elapsed:.1f}s ({rate:.1f} MB/s); skipped {total_skipped} screenshot files")
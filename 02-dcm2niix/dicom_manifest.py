@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DICOM header pre-scan and series manifest for heudiconv.
+
+Reads only the leading header bytes of every extracted DICOM (everything up to
+group 0x0028, i.e. before any pixel data) and condenses them into one entry
+per series directory: series number, description, protocol, dimensions, TR/TE
+and the file list. The manifest is written next to the subject's scratch dir
+(`series_manifest.json`) and reused on reruns: a series directory whose file
+count, total size and newest mtime are unchanged is not re-read.
+
+dcm2niix.py uses the manifest to classify series with the heuristic before
+heudiconv runs, so heudiconv is only handed the series the heuristic keeps.
+
+@Description: Build a series manifest from DICOM headers without pydicom
+@Dependencies: Python 3.9+
+@Usage: Imported by dcm2niix.py, or run directly to inspect a DICOM directory
+
+Usage:
+    python3 dicom_manifest.py DICOM_DIR [--manifest PATH] [--workers N]
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'toolbox'))
+import sidecar_io  # noqa: E402
+
+MANIFEST_VERSION = 1
+MANIFEST_FILENAME = 'series_manifest.json'
+
+DICOM_SUFFIXES = ('.dcm', '.dicom')
+HEADER_CHUNK = 16 * 1024
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# Explicit VRs that use a 2-byte reserved field and a 4-byte length
+LONG_VRS = {'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'SQ', 'SV', 'UC', 'UN', 'UR', 'UT', 'UV'}
+
+IMPLICIT_VR_LE = '1.2.840.10008.1.2'
+EXPLICIT_VR_BE = '1.2.840.10008.1.2.2'
+DEFLATED_LE = '1.2.840.10008.1.2.1.99'
+
+# Attributes kept from each header; parsing stops after STOP_GROUP
+TAGS = {
+    (0x0008, 0x0008): 'image_type',
+    (0x0008, 0x103E): 'series_description',
+    (0x0018, 0x0080): 'repetition_time',
+    (0x0018, 0x0081): 'echo_time',
+    (0x0018, 0x1030): 'protocol_name',
+    (0x0020, 0x000D): 'study_uid',
+    (0x0020, 0x000E): 'series_uid',
+    (0x0020, 0x0011): 'series_number',
+    (0x0020, 0x0013): 'instance_number',
+    (0x0020, 0x1041): 'slice_location',
+    (0x0028, 0x0010): 'rows',
+    (0x0028, 0x0011): 'columns',
+}
+US_TAGS = {(0x0028, 0x0010), (0x0028, 0x0011)}
+STOP_GROUP = 0x0028
+
+
+class DicomHeaderError(ValueError):
+    """Raised when a file does not contain a readable DICOM header."""
+
+
+class _NeedMore(Exception):
+    """Internal: the header extends past the bytes read so far."""
+
+
+def _need(data: bytes, end: int) -> None:
+    if end > len(data):
+        raise _NeedMore()
+
+
+def _read_element(data: bytes, pos: int, endian: str, explicit: bool):
+    """Return (group, element, vr, value offset, length) for the element at pos."""
+    _need(data, pos + 8)
+    group, elem = struct.unpack_from(endian + 'HH', data, pos)
+    if group == 0xFFFE:  # item / delimitation tags never carry a VR
+        return group, elem, None, pos + 8, struct.unpack_from(endian + 'I', data, pos + 4)[0]
+    if not explicit:
+        return group, elem, None, pos + 8, struct.unpack_from(endian + 'I', data, pos + 4)[0]
+    vr = data[pos + 4:pos + 6].decode('ascii', errors='replace')
+    if vr in LONG_VRS:
+        _need(data, pos + 12)
+        return group, elem, vr, pos + 12, struct.unpack_from(endian + 'I', data, pos + 8)[0]
+    return group, elem, vr, pos + 8, struct.unpack_from(endian + 'H', data, pos + 6)[0]
+
+
+def _skip_sequence(data: bytes, pos: int, endian: str, explicit: bool) -> int:
+    """Skip an undefined-length sequence; pos points just past the SQ header."""
+    while True:
+        group, elem, _, pos, length = _read_element(data, pos, endian, explicit)
+        if (group, elem) == (0xFFFE, 0xE0DD):
+            return pos
+        if (group, elem) != (0xFFFE, 0xE000):
+            raise DicomHeaderError("Malformed sequence")
+        pos = _skip_item(data, pos, endian, explicit) if length == UNDEFINED_LENGTH else pos + length
+
+
+def _skip_item(data: bytes, pos: int, endian: str, explicit: bool) -> int:
+    """Skip an undefined-length sequence item."""
+    while True:
+        group, elem, _, pos, length = _read_element(data, pos, endian, explicit)
+        if (group, elem) == (0xFFFE, 0xE00D):
+            return pos
+        pos = _skip_sequence(data, pos, endian, explicit) if length == UNDEFINED_LENGTH else pos + length
+
+
+def _decode(tag, raw: bytes, endian: str):
+    if tag in US_TAGS:
+        return struct.unpack_from(endian + 'H', raw)[0] if len(raw) >= 2 else None
+    return raw.decode('ascii', errors='replace').strip('\x00 ')
+
+
+def _parse(data: bytes, complete: bool) -> Dict:
+    endian, explicit = '<', True
+    header = {}
+    try:
+        if data[128:132] == b'DICM':
+            # file meta information (group 0002) is always explicit VR little endian
+            pos = 132
+            syntax = None
+            while True:
+                group, elem, _, value_pos, length = _read_element(data, pos, '<', True)
+                if group != 0x0002:
+                    break
+                _need(data, value_pos + length)
+                if elem == 0x0010:
+                    syntax = data[value_pos:value_pos + length].decode('ascii', errors='replace').strip('\x00 ')
+                pos = value_pos + length
+        else:
+            # no preamble: bare dataset, which is implicit VR little endian by default
+            pos = 0
+            syntax = IMPLICIT_VR_LE
+
+        if syntax == DEFLATED_LE:
+            raise DicomHeaderError("Deflated transfer syntax is not supported")
+        if syntax == IMPLICIT_VR_LE:
+            explicit = False
+        elif syntax == EXPLICIT_VR_BE:
+            endian = '>'
+
+        while True:
+            group, elem, vr, value_pos, length = _read_element(data, pos, endian, explicit)
+            if group > STOP_GROUP:
+                break
+            if length == UNDEFINED_LENGTH:
+                pos = _skip_sequence(data, value_pos, endian, explicit)
+                continue
+            tag = (group, elem)
+            if tag in TAGS:
+                _need(data, value_pos + length)
+                header[TAGS[tag]] = _decode(tag, data[value_pos:value_pos + length], endian)
+            pos = value_pos + length
+    except _NeedMore:
+        if not complete:
+            raise
+    return header
+
+
+def read_dicom_header(path) -> Dict:
+    """
+    Read the series-level attributes of one DICOM file without touching its pixel data.
+
+    Returns:
+        dict with any of the keys in TAGS that are present
+
+    Raises:
+        DicomHeaderError: if the file cannot be parsed
+    """
+    with open(path, 'rb') as f:
+        data = f.read(HEADER_CHUNK)
+        while True:
+            try:
+                header = _parse(data, complete=False)
+                break
+            except _NeedMore:
+                more = f.read(len(data))
+                if not more:
+                    header = _parse(data, complete=True)
+                    break
+                data += more
+            except struct.error as e:
+                raise DicomHeaderError(f"Could not parse DICOM header of {path}: {e}") from e
+    if 'series_number' not in header and 'series_uid' not in header:
+        raise DicomHeaderError(f"No series information in {path}")
+    return header
+
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(str(value).split('\\')[0])
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value) -> Optional[int]:
+    number = _to_float(value)
+    return int(number) if number is not None else None
+
+
+def _dicom_files(series_dir: Path) -> List[os.DirEntry]:
+    return sorted((e for e in os.scandir(series_dir) if e.is_file() and e.name.lower().endswith(DICOM_SUFFIXES)),
+                  key=lambda e: e.name)
+
+
+def _signature(entries: List[os.DirEntry]) -> List[int]:
+    stats = [e.stat() for e in entries]
+    return [len(stats), sum(s.st_size for s in stats), max((s.st_mtime_ns for s in stats), default=0)]
+
+
+def scan_series(series_dir: Path, root: Path, entries: List[os.DirEntry], pool: ThreadPoolExecutor) -> Optional[Dict]:
+    """Read the headers of one series directory in parallel and summarise them."""
+    headers = []
+    for entry, result in zip(entries, pool.map(_safe_read, [e.path for e in entries])):
+        if result is not None:
+            headers.append((entry.name, result))
+    if not headers:
+        return None
+
+    first = headers[0][1]
+    slice_locations = {h.get('slice_location') for _, h in headers if h.get('slice_location')}
+    n_files = len(headers)
+    dim3 = len(slice_locations) or n_files
+    tr_ms = _to_float(first.get('repetition_time'))
+    return {
+        'dcm_dir': str(series_dir.relative_to(root)),
+        'series_number': _to_int(first.get('series_number')),
+        'series_description': first.get('series_description', ''),
+        'protocol_name': first.get('protocol_name', ''),
+        'series_uid': first.get('series_uid', ''),
+        'study_uid': first.get('study_uid', ''),
+        'image_type': first.get('image_type', ''),
+        'dim1': first.get('rows'),
+        'dim2': first.get('columns'),
+        'dim3': dim3,
+        'dim4': max(n_files // dim3, 1),
+        'tr': tr_ms / 1000.0 if tr_ms is not None else None,
+        'te': _to_float(first.get('echo_time')),
+        'n_files': n_files,
+        'files': [name for name, _ in headers],
+    }
+
+
+def _safe_read(path: str) -> Optional[Dict]:
+    try:
+        return read_dicom_header(path)
+    except (OSError, DicomHeaderError) as e:
+        print(f"[WARNING] Skipping unreadable DICOM {path}: {e}")
+        return None
+
+
+def manifest_path_for(dicom_dir: Path) -> Path:
+    """
+    Manifest location for an extracted DICOM dir: the subject's scratch dir,
+    two levels up (<scratch>/sub-XXX/dcm2niix_work_dir/sub-XXX).
+    """
+    return Path(dicom_dir).parent.parent / MANIFEST_FILENAME
+
+
+def load_manifest(manifest_path: Path) -> Dict:
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest if manifest.get('version') == MANIFEST_VERSION else {}
+
+
+def build_manifest(dicom_dir: Path, manifest_path: Path, workers: int = 1) -> Dict:
+    """
+    Scan every series directory under dicom_dir and write the series manifest.
+
+    Series whose directory signature (file count, total bytes, newest mtime)
+    matches the previous manifest are reused without reading any headers.
+
+    Returns:
+        manifest dict: {'version', 'dicom_dir', 'series': [...]}
+    """
+    dicom_dir = Path(dicom_dir)
+    previous = {s['dcm_dir']: s for s in load_manifest(manifest_path).get('series', [])}
+
+    series_dirs = sorted({Path(dirpath) for dirpath, _, filenames in os.walk(dicom_dir)
+                          if any(n.lower().endswith(DICOM_SUFFIXES) for n in filenames)})
+    series = []
+    reused = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for series_dir in series_dirs:
+            entries = _dicom_files(series_dir)
+            signature = _signature(entries)
+            prior = previous.get(str(series_dir.relative_to(dicom_dir)))
+            if prior is not None and prior.get('signature') == signature:
+                series.append(prior)
+                reused += 1
+                continue
+            entry = scan_series(series_dir, dicom_dir, entries, pool)
+            if entry is not None:
+                entry['signature'] = signature
+                series.append(entry)
+
+    series.sort(key=lambda s: (s['series_number'] if s['series_number'] is not None else -1, s['dcm_dir']))
+    manifest = {'version': MANIFEST_VERSION, 'dicom_dir': str(dicom_dir), 'series': series}
+
+    sidecar_io.write_json(manifest_path, manifest)
+    print(f"[INFO] Series manifest: {len(series)} series ({reused} reused from previous scan) -> {manifest_path}")
+    return manifest
+
+
+def print_manifest(manifest: Dict) -> None:
+    print(f"{'series':>6s}  {'description':40s} {'dims':>16s} {'TR':>6s} {'files':>6s}  dcm_dir")
+    for s in manifest['series']:
+        dims = f"{s['dim1']}x{s['dim2']}x{s['dim3']}x{s['dim4']}"
+        tr = f"{s['tr']:.3f}" if s['tr'] is not None else 'n/a'
+        number = s['series_number'] if s['series_number'] is not None else '?'
+        print(f"{number:>6}  {s['series_description'][:40]:40s} {dims:>16s} {tr:>6s} {s['n_files']:>6d}  {s['dcm_dir']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a DICOM series manifest from header bytes only')
+    parser.add_argument('dicom_dir', help='Directory containing extracted series directories')
+    parser.add_argument('--manifest', default=None,
+                        help=f'Manifest path (default: <dicom_dir>/../../{MANIFEST_FILENAME}, '
+                             'the one dcm2niix.py reuses)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Header read threads')
+    args = parser.parse_args()
+
+    dicom_dir = Path(args.dicom_dir)
+    manifest_path = Path(args.manifest) if args.manifest else manifest_path_for(dicom_dir)
+    if not dicom_dir.is_dir():
+        print(f"[ERROR] Not a directory: {dicom_dir}", file=sys.stderr)
+        sys.exit(1)
+    print_manifest(build_manifest(dicom_dir, manifest_path, workers=args.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parallel run-level scheduler for step 03 (prep for fMRIPrep)
+
+Plans every BOLD and fieldmap trimming job for one or more subjects and runs
+them on a bounded process pool, instead of walking the runs of each subject in
+a serial shell loop. The `fmap_mapping` ownership rule from prepare_fmri.sh is
+kept: the first run (in run order) that uses a fieldmap also produces that
+fieldmap's synthetic PA image from its BOLD, and the fieldmap itself is only
+trimmed once that owning BOLD run succeeded. Every other job is independent,
+so a subject's 8 runs trim concurrently on one node.
+
+Once all jobs of a subject have finished the driver writes the trimmed
+fieldmap/BOLD sidecars with their updated metadata in one pass
+(update_fmap_metadata.py, through toolbox/sidecar_io.py, so unchanged
+sidecars are not rewritten), applies the configured file permissions and
+records the subject in the processed-subjects file.
+
+@Description: Fan out per-run trimming for prepare_fmri.sh across a process pool
+@Dependencies: Python 3.9+
+@Usage: Called by prepare_fmri.sh, both per SLURM array task and in --local mode
+
+Arguments:
+    --subjects: Comma-separated subject IDs without "sub-" prefix
+    --raw-dir: Raw BIDS directory (DIRECTORIES_RAW_DIR)
+    --trim-dir: Output directory for trimmed data (DIRECTORIES_TRIM_DIR)
+    --task-id: Original task identifier
+    --new-task-id: New task identifier (if renaming)
+    --runs: Comma-separated list of run numbers
+    --fmap-mapping: JSON string of BOLD run:fieldmap mapping
+    --n-dummy: Number of dummy volumes to remove
+    --expected-bold-vols / --expected-bold-vols-after-trimming / --expected-fmap-vols: validation values
+    --workers: Maximum number of concurrent trimming jobs (default: SLURM_CPUS_PER_TASK or CPU count)
+    --log-dir: Directory for per-subject processing logs
+    --processed-file: File to append completed subject IDs to
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import trim_volumes
+import update_fmap_metadata
+from trim_volumes import Extract, nifti_header, nifti_index
+import sidecar_io  # noqa: E402  (toolbox/ is on sys.path via trim_volumes)
+
+
+class TrimTask(NamedTuple):
+    subject_id: str
+    label: str
+    input_path: Path
+    expected_vols: int
+    extracts: Tuple[Extract, ...]
+    sidecars: Tuple[Tuple[Path, Path], ...]  # (source, destination) written at finalize once the trim succeeded
+
+
+class SubjectPlan:
+    """All trimming jobs of one subject plus the bookkeeping needed to finalize it."""
+
+    def __init__(self, subject_id: str, logger: logging.Logger):
+        self.subject_id = subject_id
+        self.logger = logger
+        self.bold_tasks: List[TrimTask] = []
+        self.dependents: Dict[str, TrimTask] = {}  # BOLD task label -> fieldmap task it unlocks
+        self.outputs: List[Path] = []
+        self.sidecars: Dict[Path, Path] = {}  # destination -> source, for trims that succeeded
+        self.outstanding = 0
+        self.failures: List[str] = []
+
+
+def setup_logging() -> logging.Logger:
+    """Configure logging"""
+    logging.basicConfig(
+        format='(%(asctime)s) [%(levelname)s] %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    return logging.getLogger('prepare_runs')
+
+
+def subject_logger(subject_id: str, log_dir: Optional[Path]) -> logging.Logger:
+    """Logger that also appends to the subject's processing log, like `tee -a` in the shell steps."""
+    logger = logging.getLogger(f'prepare_runs.sub-{subject_id}')
+    if log_dir is not None and not logger.handlers:
+        log_dir.mkdir(parents=True, exist_ok=True)
+        handler = logging.FileHandler(log_dir / f'sub-{subject_id}_processing.log')
+        handler.setFormatter(logging.Formatter('(%(asctime)s) [%(levelname)s] %(message)s',
+                                               datefmt='%Y-%m-%d %H:%M:%S'))
+        logger.addHandler(handler)
+    return logger
+
+
+def default_workers() -> int:
+    return int(os.environ.get('SLURM_CPUS_PER_TASK') or os.cpu_count() or 1)
+
+
+def _chmod_tree(path: Path, mode: int) -> None:
+    if not path.exists():
+        return
+    path.chmod(mode)
+    for child in path.iterdir():
+        child.chmod(mode)
+
+
+def prepare_subject_dirs(args: argparse.Namespace, subject_id: str, logger: logging.Logger) -> None:
+    """Set raw permissions, create bids_trimmed dirs and copy the anatomical/scans files."""
+    subject = f'sub-{subject_id}'
+    raw_subject = args.raw_dir / subject
+    trim_subject = args.trim_dir / subject
+
+    logger.info("Setting directory permissions")
+    for dir_name in ('func', 'fmap', 'anat'):
+        _chmod_tree(raw_subject / dir_name, args.dir_permissions)
+
+    logger.info("Making new bids_trimmed subject directories")
+    for dir_name in ('anat', 'fmap', 'func'):
+        (trim_subject / dir_name).mkdir(parents=True, exist_ok=True)
+
+    for src, dst in [
+        (raw_subject / f'{subject}_scans.tsv', trim_subject / f'{subject}_scans.tsv'),
+        (raw_subject / 'anat' / f'{subject}_T1w.nii.gz', trim_subject / 'anat' / f'{subject}_T1w.nii.gz'),
+        (raw_subject / 'anat' / f'{subject}_T1w.json', trim_subject / 'anat' / f'{subject}_T1w.json'),
+    ]:
+        try:
+            if dst.suffix == '.json':
+                sidecar_io.copy_json(src, dst)
+            else:
+                shutil.copyfile(src, dst)
+        except OSError as e:
+            logger.warning(f"Could not copy {src}: {e}")
+
+
+def plan_subject(args: argparse.Namespace, subject_id: str, index: nifti_index.HeaderIndex,
+                 logger: logging.Logger) -> SubjectPlan:
+    """Build the BOLD/fieldmap jobs for one subject, honoring the first-run-per-fieldmap rule."""
+    plan = SubjectPlan(subject_id, logger)
+    subject = f'sub-{subject_id}'
+    raw_subject = args.raw_dir / subject
+    trim_subject = args.trim_dir / subject
+    remain_fmap_vols = args.expected_fmap_vols - args.n_dummy
+
+    owned_fmaps = set()
+    for run in args.runs:
+        matches = sorted((raw_subject / 'func').glob(f'*run-{run}_dir-PA_bold.nii.gz'))
+        if not matches:
+            plan.failures.append(f"run {run}: raw BOLD not found")
+            logger.error(f"No raw BOLD file found for run {run} in {raw_subject / 'func'}")
+            continue
+        old_bold = matches[0]
+        detected_task_id = old_bold.name.split('_task-', 1)[1].split('_run-', 1)[0]
+        old_bold_json = old_bold.with_name(old_bold.name[:-len('.nii.gz')] + '.json')
+        new_bold = trim_subject / 'func' / f'{subject}_task-{args.new_task_id}_run-{run}_dir-PA_bold.nii.gz'
+        new_bold_json = new_bold.with_name(new_bold.name[:-len('.nii.gz')] + '.json')
+
+        extracts = [Extract(new_bold, args.n_dummy, args.expected_bold_vols_after_trimming)]
+        sidecars = [(old_bold_json, new_bold_json)]
+        plan.outputs += [new_bold, new_bold_json]
+
+        run_fmap = args.fmap_mapping.get(run, '')
+        fmap_task = None
+        if run_fmap and run_fmap not in owned_fmaps:
+            # first run using this fieldmap: it provides the synthetic PA image and unlocks the fieldmap trim
+            owned_fmaps.add(run_fmap)
+            fmap_prefix = f'{subject}_acq-{args.new_task_id}_run-{run_fmap}'
+            fieldmap_input = raw_subject / 'fmap' / f'{subject}_run-{run_fmap}_dir-AP_epi.nii.gz'
+            fieldmap_output = trim_subject / 'fmap' / f'{fmap_prefix}_dir-AP_epi.nii.gz'
+            new_epi = trim_subject / 'fmap' / f'{fmap_prefix}_dir-PA_epi.nii.gz'
+
+            try:
+                fmap_vols = index.nvols(fieldmap_input)
+            except (OSError, ValueError) as e:
+                fmap_vols = None
+                logger.error(f"Could not read fieldmap run {run_fmap}: {e}")
+            if fmap_vols == args.expected_fmap_vols:
+                logger.info(f"Volume validation passed for fieldmap run {run_fmap}: {fmap_vols} volumes")
+                extracts.append(Extract(new_epi, args.n_dummy, remain_fmap_vols))
+                fmap_task = TrimTask(
+                    subject_id=subject_id,
+                    label=f'fieldmap run {run_fmap}',
+                    input_path=fieldmap_input,
+                    expected_vols=args.expected_fmap_vols,
+                    extracts=(Extract(fieldmap_output, args.n_dummy, remain_fmap_vols),),
+                    sidecars=((old_bold_json, new_epi.with_name(f'{fmap_prefix}_dir-PA_epi.json')),
+                              (old_bold_json, fieldmap_output.with_name(f'{fmap_prefix}_dir-AP_epi.json'))),
+                )
+                plan.outputs += [new_epi, fieldmap_output] + [dst for _, dst in fmap_task.sidecars]
+            else:
+                if fmap_vols is not None:
+                    logger.error(f"Unexpected number of volumes in fieldmap run {run_fmap}")
+                    logger.error(f"Expected {args.expected_fmap_vols} volumes but found {fmap_vols}")
+                plan.failures.append(f"fieldmap run {run_fmap}: validation failed")
+
+        bold_task = TrimTask(
+            subject_id=subject_id,
+            label=f'BOLD run {run} (task-{detected_task_id})',
+            input_path=old_bold,
+            expected_vols=args.expected_bold_vols,
+            extracts=tuple(extracts),
+            sidecars=tuple(sidecars),
+        )
+        plan.bold_tasks.append(bold_task)
+        if fmap_task is not None:
+            plan.dependents[bold_task.label] = fmap_task
+    return plan
+
+
+def run_task(task: TrimTask, threads: int, level: int) -> Tuple[Dict[str, int], Optional[str]]:
+    """Worker: trim one input. Returns (volume counts, error message)."""
+    try:
+        with nifti_index.open_index() as index:
+            counts = trim_volumes.trim_volumes(task.input_path, list(task.extracts),
+                                               expected_vols=task.expected_vols,
+                                               threads=threads, level=level, index=index)
+    except (trim_volumes.TrimError, nifti_header.NiftiHeaderError, OSError) as e:
+        return {}, str(e)
+    return counts, None
+
+
+def finalize_subject(args: argparse.Namespace, plan: SubjectPlan) -> bool:
+    """
+    Update sidecar metadata and set permissions; if every job succeeded, mark
+    the subject as processed. Returns True on failures.
+    """
+    logger = plan.logger
+    logger.info("Starting metadata update")
+    update_fmap_metadata.update_subject_metadata(
+        bids_dir=args.trim_dir,
+        subject_id=plan.subject_id,
+        new_task_id=args.new_task_id,
+        run_ids=args.runs,
+        fmap_mapping=args.fmap_mapping,
+        logger=logger,
+        sources=plan.sidecars,
+        mode=args.file_permissions,
+    )
+    logger.info("Metadata update complete")
+
+    for path in plan.outputs:
+        if path.exists():
+            path.chmod(args.file_permissions)
+
+    logger.info("......................................")
+    logger.info("Final volume summary:")
+    logger.info(f"  Original BOLD volumes: {args.expected_bold_vols}")
+    logger.info(f"  Retained BOLD volumes: {args.expected_bold_vols_after_trimming}")
+    logger.info(f"  Original fieldmap volumes: {args.expected_fmap_vols}")
+    logger.info(f"  Retained fieldmap volumes: {args.expected_fmap_vols - args.n_dummy}")
+    logger.info(f"  Dummy volumes removed: {args.n_dummy}")
+    logger.info("......................................")
+
+    if plan.failures:
+        # not marked as processed, so a rerun picks the subject up again
+        logger.error(f"{len(plan.failures)} job(s) failed for sub-{plan.subject_id}:")
+        for failure in plan.failures:
+            logger.error(f"  - {failure}")
+        logger.error(f"Processing incomplete for subject {plan.subject_id}; not marking as processed")
+        return True
+
+    if args.processed_file is not None:
+        with args.processed_file.open('a') as f:
+            f.write(f"{plan.subject_id}\n")
+    logger.info(f"Successfully completed processing for subject {plan.subject_id}")
+    logger.info("-> DOUBLE CHECK FILES AND THEN PROCEED TO FMRIPREP!")
+    return False
+
+
+def run_plans(args: argparse.Namespace, plans: List[SubjectPlan]) -> int:
+    """Execute all planned jobs on a bounded pool, unlocking fieldmap jobs as their owning run finishes."""
+    total_tasks = sum(len(p.bold_tasks) + len(p.dependents) for p in plans)
+    workers = max(1, min(args.workers, total_tasks or 1))
+    threads = max(1, args.workers // workers)
+    logging.getLogger('prepare_runs').info(
+        f"Scheduling {total_tasks} trimming job(s) for {len(plans)} subject(s) on {workers} worker(s)")
+
+    failed_subjects = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+
+        def submit(plan: SubjectPlan, task: TrimTask) -> None:
+            plan.outstanding += 1
+            plan.logger.info(f"Trimming {task.label} for sub-{plan.subject_id}")
+            pending[pool.submit(run_task, task, threads, args.level)] = (plan, task)
+
+        for plan in plans:
+            for task in plan.bold_tasks:
+                submit(plan, task)
+            if plan.outstanding == 0:
+                failed_subjects += finalize_subject(args, plan)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                plan, task = pending.pop(future)
+                plan.outstanding -= 1
+                counts, error = future.result()
+                if error is None:
+                    for output, nvols in counts.items():
+                        plan.logger.info(f"Volume validation passed for {Path(output).name}: {nvols} volumes")
+                    plan.sidecars.update((dst, src) for src, dst in task.sidecars)
+                    if task.label in plan.dependents:
+                        submit(plan, plan.dependents[task.label])
+                else:
+                    plan.logger.error(f"Failed to trim {task.label}: {error}")
+                    plan.failures.append(f"{task.label}: {error}")
+                    if task.label in plan.dependents:
+                        plan.failures.append(f"{plan.dependents[task.label].label}: skipped")
+
+                if plan.outstanding == 0:
+                    failed_subjects += finalize_subject(args, plan)
+    return failed_subjects
+
+
+def _octal(value: str) -> int:
+    return int(str(value), 8)
+
+
+def parse_args() -> argparse.Namespace:
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description='Trim BOLD/fieldmap runs for one or more subjects in parallel')
+    parser.add_argument('--subjects', required=True, help='Comma-separated subject IDs (e.g., 101,102)')
+    parser.add_argument('--raw-dir', type=Path, default=env('RAW_DIR'), help='Raw BIDS directory')
+    parser.add_argument('--trim-dir', type=Path, default=env('TRIM_DIR'), help='Trimmed output directory')
+    parser.add_argument('--task-id', default=env('task_id'), help='Original task ID')
+    parser.add_argument('--new-task-id', default=env('new_task_id'), help='New task ID')
+    parser.add_argument('--runs', required=True, help='Comma-separated list of run numbers')
+    parser.add_argument('--fmap-mapping', required=True, type=json.loads,
+                        help='JSON string of BOLD run -> fieldmap mapping')
+    parser.add_argument('--n-dummy', type=int, default=env('n_dummy'), help='Dummy volumes to remove')
+    parser.add_argument('--expected-bold-vols', type=int, default=env('EXPECTED_BOLD_VOLS'))
+    parser.add_argument('--expected-bold-vols-after-trimming', type=int,
+                        default=env('EXPECTED_BOLD_VOLS_AFTER_TRIMMING'))
+    parser.add_argument('--expected-fmap-vols', type=int, default=env('EXPECTED_FMAP_VOLS'))
+    parser.add_argument('--dir-permissions', type=_octal, default=env('DIR_PERMISSIONS', '775'))
+    parser.add_argument('--file-permissions', type=_octal, default=env('FILE_PERMISSIONS', '775'))
+    parser.add_argument('--workers', type=int, default=default_workers(),
+                        help='Maximum concurrent trimming jobs (default: SLURM_CPUS_PER_TASK or CPU count)')
+    parser.add_argument('--level', type=int, default=6, choices=range(1, 10), metavar='1-9',
+                        help='gzip compression level (default: 6)')
+    parser.add_argument('--log-dir', type=Path, default=None, help='Directory for per-subject processing logs')
+    parser.add_argument('--processed-file', type=Path, default=None,
+                        help='Append each completed subject ID to this file')
+    args = parser.parse_args()
+
+    for name in ('raw_dir', 'trim_dir', 'task_id', 'new_task_id', 'n_dummy', 'expected_bold_vols',
+                 'expected_bold_vols_after_trimming', 'expected_fmap_vols'):
+        if getattr(args, name) is None:
+            parser.error(f"--{name.replace('_', '-')} is required (or source load_config.sh first)")
+    # values taken from the environment arrive as strings
+    for name in ('n_dummy', 'expected_bold_vols', 'expected_bold_vols_after_trimming', 'expected_fmap_vols'):
+        setattr(args, name, int(getattr(args, name)))
+    for name in ('dir_permissions', 'file_permissions'):
+        if isinstance(getattr(args, name), str):
+            setattr(args, name, _octal(getattr(args, name)))
+    args.raw_dir = Path(args.raw_dir)
+    args.trim_dir = Path(args.trim_dir)
+    args.runs = [r.strip() for r in args.runs.split(',') if r.strip()]
+    args.subjects = [s.strip() for s in args.subjects.split(',') if s.strip()]
+    return args
+
+
+def main():
+    args = parse_args()
+    setup_logging()
+
+    plans = []
+    with nifti_index.open_index() as index:
+        for subject_id in args.subjects:
+            logger = subject_logger(subject_id, args.log_dir)
+            logger.info(f"Processing subject {subject_id}")
+            prepare_subject_dirs(args, subject_id, logger)
+            plans.append(plan_subject(args, subject_id, index, logger))
+
+    failed_subjects = run_plans(args, plans)
+    sys.exit(1 if failed_subjects else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Single-pass dummy-volume trimming for 4D NIfTI images
+
+Streams a raw 4D image exactly once and writes one or more sub-ranges of its
+volume axis (e.g. the trimmed task BOLD and the synthetic PA fieldmap taken
+from the same BOLD run) from that one read. NIfTI stores each volume as a
+contiguous block after the header, so slicing the volume axis is a matter of
+forwarding whole volume buffers to the right outputs; no voxel data is
+re-ordered or copied. Output headers are the input header with dim4 patched,
+which is what `fslroi <in> <out> <tmin> <tsize>` produces.
+
+Compression runs on one background thread per output (or through `pigz` when
+it is installed), so the reader and all compressors work in parallel. The
+volume count of every output is recorded in the header index, so downstream
+validation does not need to re-open the files.
+
+@Description: Replace repeated fslroi/fslnvols calls in prepare_fmri.sh
+@Dependencies: Python 3.9+ (pigz optional)
+@Usage: Called by prepare_fmri.sh as part of the preprocessing pipeline
+
+Arguments:
+    --input: Raw 4D NIfTI image (.nii or .nii.gz)
+    --expected-vols: Expected number of volumes in the input (validated before any data is read)
+    --extract: OUTPUT:START:COUNT, may be repeated (0-based START, like fslroi)
+    --threads: Compression threads, split across the outputs, when pigz is available (default: SLURM_CPUS_PER_TASK or CPU count)
+    --level: gzip compression level 1-9 (default: 6)
+    --counts-json: Optional path to write {output: volumes} after a successful run
+"""
+
+import argparse
+import gzip
+import logging
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'toolbox'))
+import nifti_header  # noqa: E402
+import nifti_index  # noqa: E402
+import sidecar_io  # noqa: E402
+
+# dim[4] lives at byte 48 in both NIfTI-1 (int16 dim[8] @ 40) and NIfTI-2 (int64 dim[8] @ 16)
+DIM4_OFFSET = 48
+
+# number of in-flight volume buffers shared by all outputs
+BUFFER_POOL_SIZE = 8
+
+
+class TrimError(RuntimeError):
+    """Raised when an input fails validation or cannot be trimmed."""
+
+
+class Extract(NamedTuple):
+    output: Path
+    start: int
+    count: int
+
+
+def setup_logging() -> logging.Logger:
+    """Configure logging"""
+    logging.basicConfig(
+        format='(%(asctime)s) [%(levelname)s] %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    return logging.getLogger('trim_volumes')
+
+
+def parse_extract(spec: str) -> Extract:
+    """Parse an OUTPUT:START:COUNT extraction spec."""
+    try:
+        output, start, count = spec.rsplit(':', 2)
+        extract = Extract(Path(output), int(start), int(count))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected OUTPUT:START:COUNT, got '{spec}'")
+    if extract.start < 0 or extract.count < 1:
+        raise argparse.ArgumentTypeError(f"START must be >= 0 and COUNT >= 1 in '{spec}'")
+    return extract
+
+
+def default_threads() -> int:
+    return int(os.environ.get('SLURM_CPUS_PER_TASK') or os.cpu_count() or 1)
+
+
+class _BufferPool:
+    """Fixed set of volume-sized buffers handed out to the reader and returned once every output wrote them."""
+
+    def __init__(self, size: int, count: int):
+        self._free = queue.Queue()
+        for _ in range(count):
+            self._free.put(bytearray(size))
+        self._refs = {}
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        return self._free.get()
+
+    def share(self, buf: bytearray, consumers: int) -> None:
+        if consumers == 0:
+            self._free.put(buf)
+            return
+        with self._lock:
+            self._refs[id(buf)] = consumers
+
+    def release(self, buf: bytearray) -> None:
+        with self._lock:
+            self._refs[id(buf)] -= 1
+            done = self._refs[id(buf)] == 0
+        if done:
+            self._free.put(buf)
+
+
+class _VolumeWriter(threading.Thread):
+    """Writes one output image on a background thread, compressing with pigz or gzip."""
+
+    def __init__(self, extract: Extract, header_bytes: bytes, pool: _BufferPool,
+                 threads: int, level: int):
+        super().__init__(daemon=True)
+        self.extract = extract
+        self.header_bytes = header_bytes
+        self.pool = pool
+        self.threads = threads
+        self.level = level
+        self.queue = queue.Queue()
+        self.error: Optional[BaseException] = None
+        self.tmp_path = extract.output.with_name(f'.{extract.output.name}.tmp')
+
+    def _open(self):
+        """Return (stream, finalizer) for the temporary output file."""
+        if not str(self.extract.output).endswith('.gz'):
+            f = open(self.tmp_path, 'wb')
+            return f, f.close
+
+        pigz = shutil.which('pigz')
+        if pigz and self.threads > 1:
+            raw = open(self.tmp_path, 'wb')
+            proc = subprocess.Popen([pigz, '-c', f'-{self.level}', '-p', str(self.threads)],
+                                    stdin=subprocess.PIPE, stdout=raw)
+
+            def _finish():
+                proc.stdin.close()
+                rc = proc.wait()
+                raw.close()
+                if rc != 0:
+                    raise TrimError(f"pigz exited with status {rc} for {self.extract.output}")
+            return proc.stdin, _finish
+
+        f = gzip.open(self.tmp_path, 'wb', compresslevel=self.level)
+        return f, f.close
+
+    def run(self):
+        stream = None
+        finish = None
+        try:
+            stream, finish = self._open()
+            stream.write(self.header_bytes)
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                buf, nbytes = item
+                try:
+                    stream.write(memoryview(buf)[:nbytes])
+                finally:
+                    self.pool.release(buf)
+        except BaseException as e:  # surfaced to the reader through finish()
+            self.error = e
+            # keep draining so the reader never blocks on a full pool
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                self.pool.release(item[0])
+        finally:
+            if finish is not None:
+                try:
+                    finish()
+                except BaseException as e:
+                    self.error = self.error or e
+
+    def finish(self) -> None:
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            self.tmp_path.unlink(missing_ok=True)
+            raise TrimError(f"Failed to write {self.extract.output}: {self.error}")
+        os.replace(self.tmp_path, self.extract.output)
+
+    def abort(self) -> None:
+        self.queue.put(None)
+        self.join()
+        self.tmp_path.unlink(missing_ok=True)
+
+
+def _volume_nbytes(header: Dict) -> int:
+    dim = header['dim']
+    if dim[0] > 4 and any(d > 1 for d in dim[5:dim[0] + 1]):
+        raise TrimError("Images with more than 4 dimensions are not supported")
+    nvox = 1
+    for d in dim[1:4]:
+        nvox *= max(int(d), 1)
+    nbits = nvox * header['bitpix']
+    if nbits % 8:
+        raise TrimError(f"Unsupported bitpix {header['bitpix']}")
+    return nbits // 8
+
+
+def _patch_dim4(header_bytes: bytes, header: Dict, nvols: int) -> bytes:
+    patched = bytearray(header_bytes)
+    endian = '<' if header['endian'] == 'little' else '>'
+    if header['nifti_version'] == 1:
+        struct.pack_into(endian + 'h', patched, DIM4_OFFSET, nvols)
+    else:
+        struct.pack_into(endian + 'q', patched, DIM4_OFFSET, nvols)
+    if header['dim'][0] < 4:
+        ndim_fmt = 'h' if header['nifti_version'] == 1 else 'q'
+        struct.pack_into(endian + ndim_fmt, patched, 40 if header['nifti_version'] == 1 else 16, 4)
+    return bytes(patched)
+
+
+def trim_volumes(input_path: Path, extracts: List[Extract], expected_vols: Optional[int] = None,
+                 threads: int = 1, level: int = 6, index: Optional[nifti_index.HeaderIndex] = None,
+                 logger: Optional[logging.Logger] = None) -> Dict[str, int]:
+    """
+    Stream input_path once and write every requested volume range.
+
+    Args:
+        input_path: Raw 4D NIfTI image
+        extracts: Output ranges, each (output path, 0-based start volume, number of volumes)
+        expected_vols: If given, fail before reading any voxel data when dim4 differs
+        threads: Compression threads, split across the outputs (used when pigz is available)
+        level: gzip compression level
+        index: Header index to record the output volume counts in
+        logger: Logger for progress messages
+
+    Returns:
+        dict mapping each output path to the number of volumes written
+
+    Raises:
+        TrimError: on validation failure or if any output could not be written
+    """
+    logger = logger or logging.getLogger('trim_volumes')
+    opener = gzip.open if str(input_path).endswith('.gz') else open
+
+    with opener(input_path, 'rb') as f:
+        header, header_bytes = nifti_header.read_header_from_stream(f, str(input_path))
+        total_vols = nifti_header.get_nvols(header)
+
+        if expected_vols is not None and total_vols != expected_vols:
+            raise TrimError(f"Expected {expected_vols} volumes but found {total_vols} in {input_path}")
+        logger.info(f"Volume validation passed for {input_path.name}: {total_vols} volumes")
+
+        for extract in extracts:
+            if extract.start + extract.count > total_vols:
+                raise TrimError(
+                    f"Cannot extract volumes {extract.start}-{extract.start + extract.count - 1} "
+                    f"from {input_path} ({total_vols} volumes)")
+
+        # header + extensions up to the start of voxel data are copied verbatim
+        extension_nbytes = int(header['vox_offset']) - len(header_bytes)
+        if extension_nbytes < 0:
+            raise TrimError(f"Invalid vox_offset {header['vox_offset']} in {input_path} "
+                            f"(smaller than the {len(header_bytes)}-byte header)")
+        extension_bytes = f.read(extension_nbytes)
+        if len(extension_bytes) != extension_nbytes:
+            raise TrimError(f"Unexpected end of header extensions in {input_path}")
+        volume_nbytes = _volume_nbytes(header)
+        last_volume = max(e.start + e.count for e in extracts)
+
+        pool = _BufferPool(volume_nbytes, BUFFER_POOL_SIZE)
+        # the outputs compress concurrently; share the threads between them
+        output_threads = max(1, threads // len(extracts))
+        writers = []
+        for extract in extracts:
+            out_header = _patch_dim4(header_bytes, header, extract.count) + extension_bytes
+            writer = _VolumeWriter(extract, out_header, pool, output_threads, level)
+            writer.start()
+            writers.append(writer)
+
+        try:
+            for vol in range(last_volume):
+                buf = pool.acquire()
+                nread = f.readinto(buf)
+                if nread != volume_nbytes:
+                    pool.share(buf, 0)
+                    raise TrimError(f"Unexpected end of data in {input_path} at volume {vol}")
+                targets = [w for w in writers if w.extract.start <= vol < w.extract.start + w.extract.count]
+                pool.share(buf, len(targets))
+                for writer in targets:
+                    writer.queue.put((buf, nread))
+        except BaseException:
+            for writer in writers:
+                writer.abort()
+            raise
+
+    counts = {}
+    errors = []
+    for writer in writers:
+        try:
+            writer.finish()
+        except TrimError as e:
+            errors.append(str(e))
+            continue
+        counts[str(writer.extract.output)] = writer.extract.count
+    if errors:
+        raise TrimError('; '.join(errors))
+
+    for writer in writers:
+        out_header = dict(header)
+        out_header['dim'] = list(header['dim'])
+        out_header['dim'][0] = max(out_header['dim'][0], 4)
+        out_header['dim'][4] = writer.extract.count
+        if index is not None:
+            index.record(writer.extract.output, out_header)
+        logger.info(f"Wrote {writer.extract.output.name}: volumes {writer.extract.start}-"
+                    f"{writer.extract.start + writer.extract.count - 1} ({writer.extract.count} volumes)")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Trim dummy volumes from a 4D NIfTI in a single pass')
+    parser.add_argument('--input', required=True, type=Path, help='Raw 4D NIfTI image')
+    parser.add_argument('--expected-vols', type=int, default=None, help='Expected number of input volumes')
+    parser.add_argument('--extract', required=True, action='append', type=parse_extract,
+                        help='OUTPUT:START:COUNT (0-based START, repeatable)')
+    parser.add_argument('--threads', type=int, default=default_threads(),
+                        help='Compression threads, split across the outputs, when pigz is available')
+    parser.add_argument('--level', type=int, default=6, choices=range(1, 10), metavar='1-9',
+                        help='gzip compression level (default: 6)')
+    parser.add_argument('--counts-json', type=Path, default=None,
+                        help='Write {output: volumes} JSON after a successful run')
+    args = parser.parse_args()
+
+    logger = setup_logging()
+
+    try:
+        with nifti_index.open_index() as index:
+            counts = trim_volumes(args.input, args.extract, expected_vols=args.expected_vols,
+                                  threads=args.threads, level=args.level, index=index, logger=logger)
+    except (TrimError, nifti_header.NiftiHeaderError, OSError) as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+    if args.counts_json is not None:
+        sidecar_io.write_json(args.counts_json, counts)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,10 @@ BOLD images to properly link them for distortion correction in fMRIPrep.
 It handles both AP and PA phase encoding directions and sets the appropriate
 B0 field identifiers and intended-for relationships.
 
+All runs of a subject are handled in one pass: the final metadata of every
+sidecar is computed in memory first, then each file is written once through
+toolbox/sidecar_io.py (atomically, and only if its content changed).
+
 @Author: Shawn Schwartz - Stanford Memory Lab
 @Date: January 30, 2025
 @Description: Update JSON metadata in fieldmap and BOLD files for fMRIPrep
@@ -23,11 +27,16 @@ Arguments:
     --runs: Comma-separated list of run numbers
 """
 
+from collections import defaultdict
 from pathlib import Path
 import json
 import argparse
 import logging
-from typing import Dict, List
+import sys
+from typing import Dict, List, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'toolbox'))
+import sidecar_io  # noqa: E402
 
 
 def setup_logging(subject_id: str) -> logging.Logger:
@@ -40,98 +49,126 @@ def setup_logging(subject_id: str) -> logging.Logger:
     logger = logging.getLogger(f"fmap_metadata_sub-{subject_id}")
     return logger
 
-def update_json_metadata(
+def _sidecar_json(nifti_path: Path) -> Path:
+    """JSON sidecar of a .nii.gz file"""
+    return nifti_path.with_name(nifti_path.name[:-len('.nii.gz')] + '.json')
+
+
+def plan_metadata_updates(
     bids_dir: Path,
     subject_id: str,
-    task_id: str,
     new_task_id: str,
-    run_id: str,
+    run_ids: List[str],
     fmap_mapping: Dict[str, str],
     logger: logging.Logger
-) -> None:
-    """
-    Update JSON metadata for fieldmaps and BOLD data
+) -> Dict[Path, Dict]:
     """
-    fmap_id = fmap_mapping.get(run_id)
+    Compute the metadata changes for every fieldmap and BOLD sidecar of the given runs
 
-    # check if BOLD file exists
-    bold_file = bids_dir / f'sub-{subject_id}/func/sub-{subject_id}_task-{new_task_id}_run-{run_id}_dir-PA_bold.nii.gz'
-    if not bold_file.exists():
-        logger.warning(f"BOLD file not found: {bold_file}")
-        return
-
-    # find paired run for this fieldmap
-    paired_runs = []
+    fmap_mapping is inverted once, so each fieldmap gets its IntendedFor list
+    (all runs sharing it) a single time no matter how many of its runs are
+    listed. Returns {json path: keys to set}.
+    """
+    runs_by_fmap: Dict[str, List[str]] = defaultdict(list)
     for run, fmap in fmap_mapping.items():
-        if fmap == fmap_id:
-            paired_runs.append(run)
-    paired_runs.sort()
-
-    # generate IntendedFor file list
-    intended_files = [
-        f'bids::sub-{subject_id}/func/sub-{subject_id}_task-{new_task_id}_run-{run}_dir-PA_bold.nii.gz'
-        for run in paired_runs
-    ]
-
-    fmap_identifier = f'phasediff_fmap{fmap_id}'
-
-    # update fieldmap JSONs
-    for direction in ['AP', 'PA']:
-        polarity = '1-flipped' if direction == 'AP' else '0-normal'
-        phasedir = 'j-' if direction == 'AP' else 'j'
-        json_path = bids_dir / f'sub-{subject_id}/fmap/sub-{subject_id}_acq-{new_task_id}_run-{fmap_id}_dir-{direction}_epi.json'
-
-        try:
-            json_path.chmod(0o775)
-            with json_path.open() as f:
-                metadata = json.load(f)
-
-            metadata.update({
+        runs_by_fmap[fmap].append(run)
+
+    updates: Dict[Path, Dict] = {}
+    for run_id in run_ids:
+        # check if BOLD file exists
+        bold_file = bids_dir / f'sub-{subject_id}/func/sub-{subject_id}_task-{new_task_id}_run-{run_id}_dir-PA_bold.nii.gz'
+        if not bold_file.exists():
+            logger.warning(f"BOLD file not found: {bold_file}")
+            continue
+
+        fmap_id = fmap_mapping.get(run_id)
+        bold_update = {
+            'PhaseEncodingDirection': 'j',
+            'PhaseEncodingPolarityGE': '0-normal',
+            'TaskName': new_task_id
+        }
+        if fmap_id is None:
+            logger.warning(f"No fieldmap mapped to run {run_id}; B0FieldSource not set")
+            updates[_sidecar_json(bold_file)] = bold_update
+            continue
+
+        fmap_identifier = f'phasediff_fmap{fmap_id}'
+        bold_update['B0FieldSource'] = fmap_identifier
+        updates[_sidecar_json(bold_file)] = bold_update
+
+        # generate IntendedFor file list from all runs paired with this fieldmap
+        intended_files = [
+            f'bids::sub-{subject_id}/func/sub-{subject_id}_task-{new_task_id}_run-{run}_dir-PA_bold.nii.gz'
+            for run in sorted(runs_by_fmap[fmap_id])
+        ]
+        for direction in ['AP', 'PA']:
+            json_path = bids_dir / f'sub-{subject_id}/fmap/sub-{subject_id}_acq-{new_task_id}_run-{fmap_id}_dir-{direction}_epi.json'
+            updates[json_path] = {
                 'B0FieldIdentifier': fmap_identifier,
                 'IntendedFor': intended_files,
-                'PhaseEncodingDirection': phasedir,
-                'PhaseEncodingPolarityGE': polarity,
+                'PhaseEncodingDirection': 'j-' if direction == 'AP' else 'j',
+                'PhaseEncodingPolarityGE': '1-flipped' if direction == 'AP' else '0-normal',
                 'TaskName': new_task_id
-            })
-
-            metadata = dict(sorted(metadata.items()))
-            with json_path.open('w') as f:
-                json.dump(metadata, f, indent=2)
+            }
+    return updates
 
-            logger.info(f"Updated {direction} fieldmap metadata for run {run_id}")
 
-        except Exception as e:
-            logger.error(f"Failed to update {direction} fieldmap metadata: {e}")
-
-    # update BOLD JSON
-    try:
-        bold_path = Path(bold_file)
+def update_subject_metadata(
+    bids_dir: Path,
+    subject_id: str,
+    new_task_id: str,
+    run_ids: List[str],
+    fmap_mapping: Dict[str, str],
+    logger: logging.Logger,
+    sources: Optional[Dict[Path, Path]] = None,
+    mode: int = 0o775
+) -> Tuple[int, int]:
+    """
+    Update fieldmap and BOLD metadata for all runs of a subject
 
-        if bold_path.name.endswith('.nii.gz'):
-            bold_json = bold_path.with_name(bold_path.name[:-7] + '.json')
+    Every sidecar is read once and written at most once. sources maps a
+    sidecar to the file its content starts from (e.g. the raw BOLD JSON a
+    trimmed sidecar derives from); those sidecars are produced here directly
+    instead of being copied first and rewritten afterwards. Returns
+    (sidecars written, sidecars already up to date).
+    """
+    sources = sources or {}
+    updates = plan_metadata_updates(bids_dir, subject_id, new_task_id, run_ids, fmap_mapping, logger)
+    written = unchanged = 0
+    for json_path in sorted(set(updates) | set(sources)):
+        try:
+            if json_path in updates:
+                changed = sidecar_io.update_json(json_path, updates[json_path], source=sources.get(json_path),
+                                                 mode=mode)
+            else:
+                changed = sidecar_io.copy_json(sources[json_path], json_path, mode=mode)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to update metadata in {json_path}: {e}")
+            continue
+        if changed:
+            written += 1
+            logger.info(f"Updated metadata: {json_path.name}")
         else:
-            print("Error: file doesn't end with .nii.gz")
-
-        bold_json.chmod(0o775)
+            unchanged += 1
+    logger.info(f"Metadata: {written} sidecar(s) updated, {unchanged} already up to date")
+    return written, unchanged
 
-        with bold_json.open() as f:
-            metadata = json.load(f)
 
-        metadata.update({
-            'B0FieldSource': fmap_identifier,
-            'PhaseEncodingDirection': 'j',
-            'PhaseEncodingPolarityGE': '0-normal',
-            'TaskName': new_task_id
-        })
-
-        metadata = dict(sorted(metadata.items()))
-        with bold_json.open('w') as f:
-            json.dump(metadata, f, indent=2)
-
-        logger.info(f"Updated BOLD metadata for run {run_id}")
+def update_json_metadata(
+    bids_dir: Path,
+    subject_id: str,
+    task_id: str,
+    new_task_id: str,
+    run_id: str,
+    fmap_mapping: Dict[str, str],
+    logger: logging.Logger
+) -> None:
+    """
+    Update JSON metadata for fieldmaps and BOLD data of a single run
 
-    except Exception as e:
-        logger.error(f"Failed to update BOLD metadata: {e}")
+    Prefer update_subject_metadata for several runs of a subject.
+    """
+    update_subject_metadata(bids_dir, subject_id, new_task_id, [run_id], fmap_mapping, logger)
 
 def main():
     parser = argparse.ArgumentParser(description='Update BIDS metadata for fieldmap processing')
@@ -148,16 +185,14 @@ def main():
     fmap_mapping = json.loads(args.fmap_mapping)
     run_numbers = args.runs.split(',')
 
-    for run_id in run_numbers:
-        update_json_metadata(
-            bids_dir=Path(args.bids_dir),
-            subject_id=args.subid,
-            task_id=args.task_id,
-            new_task_id=args.new_task_id,
-            run_id=run_id,
-            fmap_mapping=fmap_mapping,
-            logger=logger
-        )
+    update_subject_metadata(
+        bids_dir=Path(args.bids_dir),
+        subject_id=args.subid,
+        new_task_id=args.new_task_id,
+        run_ids=run_numbers,
+        fmap_mapping=fmap_mapping,
+        logger=logger
+    )
 
 if __name__ == '__main__':
     main()
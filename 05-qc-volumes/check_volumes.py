@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Volume-count QC engine for step 05 (QC volumes)
+
+Builds the list of every BOLD and fieldmap file a subject should have, both
+in the raw BIDS directory and after trimming, reads their volume counts from
+the NIfTI headers (dim[4]) on a thread pool through the shared header index
+(toolbox/nifti_index.py), and writes scan_volumes_summary.csv in one go.
+This replaces the per-file volume-count process launches and per-row
+`echo >>` appends check_volumes.sh used to do; the CSV schema is unchanged,
+so toolbox/summarize_diagnostics.py reads it as before:
+
+    subject_id,scan_type,run_number,file_path,expected_volumes,actual_volumes,status
+
+The same rows are appended to the study diagnostics store
+(toolbox/diagnostics_store.py), which keeps every QC run in one table.
+
+@Description: Check scan volume counts for one subject and write the diagnostics CSV
+@Dependencies: Python 3.9+
+@Usage: Called by check_volumes.sh for each SLURM array task
+
+Arguments:
+    --subid: Subject ID without "sub-" prefix (e.g., '001')
+    --raw-dir: Raw BIDS directory (DIRECTORIES_RAW_DIR)
+    --trim-dir: Trimmed BIDS directory (DIRECTORIES_TRIM_DIR)
+    --new-task-id: Task identifier of the trimmed data
+    --runs: Comma-separated list of run numbers
+    --fmap-mapping: JSON string of BOLD run:fieldmap mapping
+    --n-dummy: Number of dummy volumes removed from the fieldmaps
+    --expected-bold-vols / --expected-bold-vols-after-trimming / --expected-fmap-vols: expected counts
+    --output-csv: Path of the CSV to write
+    --workers: Number of header reads in flight (default: 8)
+    --diagnostics-db: Diagnostics store to append to (default: $DIAGNOSTICS_DB or $SLURM_LOG_DIR/diagnostics/)
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+from glob import glob
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'toolbox'))
+import diagnostics_store  # noqa: E402
+import nifti_header  # noqa: E402
+import nifti_index  # noqa: E402
+
+
+CSV_FIELDS = ['subject_id', 'scan_type', 'run_number', 'file_path', 'expected_volumes', 'actual_volumes', 'status']
+TASK_PATTERN = re.compile(r'_task-([^_]*)_')
+
+
+class VolumeCheck(NamedTuple):
+    subject_id: str
+    scan_type: str
+    run_number: str
+    file_path: str
+    expected_volumes: int
+
+
+def _task_name(bold_file: str) -> str:
+    match = TASK_PATTERN.search(os.path.basename(bold_file))
+    return match.group(1) if match else ''
+
+
+def plan_checks(
+    subject_id: str,
+    raw_dir: Path,
+    trim_dir: Path,
+    new_task_id: str,
+    runs: List[str],
+    fmap_mapping: Dict[str, str],
+    n_dummy: int,
+    expected_bold_vols: int,
+    expected_bold_vols_after_trimming: int,
+    expected_fmap_vols: int
+) -> List[VolumeCheck]:
+    """
+    Every file to check, in the row order of the CSV: for each run the BOLD
+    file(s) then the mapped fieldmap, raw data first, then trimmed data.
+    A BOLD run without any matching file is returned with its glob pattern
+    as file_path, so it is reported as FILE_NOT_FOUND.
+    """
+    subject = f'sub-{subject_id}'
+    checks = []
+    for stage, bids_dir, expected_bold in (('raw', raw_dir, expected_bold_vols),
+                                           ('trimmed', trim_dir, expected_bold_vols_after_trimming)):
+        for run in runs:
+            bold_pattern = str(bids_dir / subject / 'func' / f'{subject}_task-*_run-{run}_dir-PA_bold.nii.gz')
+            bold_files = sorted(glob(bold_pattern))
+            # the trimmed fieldmap is named after the task of the run's BOLD file
+            task_name = new_task_id
+
+            if not bold_files:
+                checks.append(VolumeCheck(subject_id, 'BOLD', run, bold_pattern, expected_bold))
+            elif len(bold_files) > 1:
+                print(f"[WARNING] Multiple BOLD files found for subject {subject_id}, run {run}. Checking all.")
+            for bold_file in bold_files:
+                task_name = _task_name(bold_file)
+                checks.append(VolumeCheck(subject_id, f'BOLD-{task_name}', run, bold_file, expected_bold))
+
+            run_fmap = fmap_mapping.get(run, '')
+            if stage == 'raw':
+                fmap_file = bids_dir / subject / 'fmap' / f'{subject}_run-{run_fmap}_dir-AP_epi.nii.gz'
+                expected_fmap = expected_fmap_vols
+            else:
+                fmap_file = bids_dir / subject / 'fmap' / f'{subject}_acq-{task_name}_run-{run_fmap}_dir-AP_epi.nii.gz'
+                expected_fmap = expected_fmap_vols - n_dummy
+            checks.append(VolumeCheck(subject_id, 'FIELDMAP', run_fmap, str(fmap_file), expected_fmap))
+    return checks
+
+
+def run_checks(checks: List[VolumeCheck], index: nifti_index.HeaderIndex, workers: int = 8) -> List[List]:
+    """Read the volume count of every checked file (one batched header lookup) and build the CSV rows."""
+    # a fieldmap shared by several runs is read once
+    existing = sorted({check.file_path for check in checks if os.path.isfile(check.file_path)})
+    headers = index.headers(existing, workers=workers)
+
+    rows = []
+    for check in checks:
+        header = headers.get(check.file_path)
+        if header is None:
+            print(f"[WARNING] File not found: {check.file_path}")
+            actual, status = 'FILE_NOT_FOUND', 'ERROR'
+        elif isinstance(header, Exception):
+            print(f"[ERROR] Could not read header of {check.file_path}: {header}")
+            actual, status = 'UNREADABLE', 'ERROR'
+        else:
+            actual = nifti_header.get_nvols(header)
+            if actual != check.expected_volumes:
+                status = 'ERROR'
+                print(f"[ERROR] Volume mismatch in {check.file_path}: Expected {check.expected_volumes}, found {actual}")
+            else:
+                status = 'OK'
+                print(f"[INFO] Volume check passed for {check.file_path}: {actual} volumes")
+        rows.append([check.subject_id, check.scan_type, check.run_number, check.file_path,
+                     check.expected_volumes, actual, status])
+    return rows
+
+
+def write_csv(csv_path: Path, rows: List[List]) -> None:
+    """Write the header and all rows at once."""
+    csv_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(CSV_FIELDS)
+        writer.writerows(rows)
+
+
+def main():
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description='Check scan volume counts for one subject')
+    parser.add_argument('--subid', required=True, help='Subject ID (e.g., 001)')
+    parser.add_argument('--raw-dir', type=Path, default=env('RAW_DIR'), help='Raw BIDS directory')
+    parser.add_argument('--trim-dir', type=Path, default=env('TRIM_DIR'), help='Trimmed BIDS directory')
+    parser.add_argument('--new-task-id', default=env('new_task_id'), help='New task ID')
+    parser.add_argument('--runs', required=True, help='Comma-separated list of run numbers')
+    parser.add_argument('--fmap-mapping', required=True, type=json.loads,
+                        help='JSON string of BOLD run -> fieldmap mapping')
+    parser.add_argument('--n-dummy', type=int, default=env('n_dummy'), help='Dummy volumes removed')
+    parser.add_argument('--expected-bold-vols', type=int, default=env('EXPECTED_BOLD_VOLS'))
+    parser.add_argument('--expected-bold-vols-after-trimming', type=int,
+                        default=env('EXPECTED_BOLD_VOLS_AFTER_TRIMMING'))
+    parser.add_argument('--expected-fmap-vols', type=int, default=env('EXPECTED_FMAP_VOLS'))
+    parser.add_argument('--output-csv', required=True, type=Path, help='CSV file to write')
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent header reads (default: 8)')
+    parser.add_argument('--diagnostics-db', default=None,
+                        help='Diagnostics store (default: $DIAGNOSTICS_DB or $SLURM_LOG_DIR/diagnostics/%s)'
+                             % diagnostics_store.STORE_FILENAME)
+    args = parser.parse_args()
+
+    for name in ('raw_dir', 'trim_dir', 'new_task_id', 'n_dummy', 'expected_bold_vols',
+                 'expected_bold_vols_after_trimming', 'expected_fmap_vols'):
+        if getattr(args, name) is None:
+            parser.error(f"--{name.replace('_', '-')} is required (or source load_config.sh first)")
+    # values taken from the environment arrive as strings
+    for name in ('n_dummy', 'expected_bold_vols', 'expected_bold_vols_after_trimming', 'expected_fmap_vols'):
+        setattr(args, name, int(getattr(args, name)))
+    runs = [r.strip() for r in args.runs.split(',') if r.strip()]
+
+    print(f"[INFO] Processing subject {args.subid}")
+    checks = plan_checks(args.subid, Path(args.raw_dir), Path(args.trim_dir), args.new_task_id, runs,
+                         args.fmap_mapping, args.n_dummy, args.expected_bold_vols,
+                         args.expected_bold_vols_after_trimming, args.expected_fmap_vols)
+    with nifti_index.open_index() as index:
+        rows = run_checks(checks, index, args.workers)
+    write_csv(args.output_csv, rows)
+    diagnostics_store.record_run(rows, source=str(args.output_csv), db_path=args.diagnostics_db)
+    print(f"[INFO] Completed volume check for subject {args.subid}")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,25 @@ Processes header of Nifti files
 # Created by Alice Xue, 06/2018
 # https://github.com/alicexue/fmri-pipeline
 
-import subprocess
+import atexit
+import os
+import sys
+
+# the native header reader and header index are shared with the QC/prep stages and live in toolbox/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'toolbox'))
+import nifti_header  # noqa: E402
+import nifti_index  # noqa: E402
+
+_index = None
+
+
+def _get_index():
+    """Open the shared header index once per process (see toolbox/nifti_index.py)."""
+    global _index
+    if _index is None:
+        _index = nifti_index.open_index()
+        atexit.register(_index.close)
+    return _index
 
 
 def read_nifti_header(niftifile):
@@ -15,16 +33,20 @@ def read_nifti_header(niftifile):
         niftifile (str): full path of niftifile
     Returns:
         dictionary with original variables in header as keys and the values as their respective values
+        (same keys as printed by fslinfo, e.g. dim4, pixdim4, data_type)
+    """
+    header = _get_index().header(niftifile)
+    return {key: str(value) for key, value in nifti_header.fslinfo_fields(header).items()}
+
+
+def get_nvols(niftifile):
+    """
+    Args:
+        niftifile (str): full path of niftifile
+    Returns:
+        the number of volumes (timepoints) as an integer
     """
-    p = subprocess.Popen(['fslinfo', niftifile], stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
-    output, errors = p.communicate()
-    l1 = output.split('\n')
-    header_vals = {}
-    for line in l1:
-        tmp = line.replace('\t', ' ').split(' ')
-        if tmp[0] != '':
-            header_vals[tmp[0]] = tmp[-1]
-    return header_vals
+    return _get_index().nvols(niftifile)
 
 
 def get_tr(niftifile):
@@ -34,9 +56,10 @@ def get_tr(niftifile):
     Returns:
         the Repetition Time as a floating number
     """
-    header_vals = read_nifti_header(niftifile)
-    tr = float(header_vals['pixdim4'])
-    if tr >= 1000:
-        tr = tr / 1000 
+    header = _get_index().header(niftifile)
+    tr = nifti_header.get_tr_seconds(header)
+    if header['time_units'] not in ('s', 'ms', 'us') and tr >= 1000:
+        # no usable time units in the header; a TR this large can only be milliseconds
+        tr = tr / 1000
         print("NOTE: TR information in file header appears to be in milliseconds rather than seconds; converting to seconds for compatibility with FSL: %ss" % tr)
     return tr
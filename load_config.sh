@@ -117,6 +117,8 @@ try:
         'FW_PROJECT_ID': 'USER_FW_PROJECT_ID',
         'FW_CLI_API_KEY_FILE': 'SCAN_FW_CLI_API_KEY_FILE',
         'FW_URL': 'SCAN_FW_URL',
+        'FW_DOWNLOAD_MODE': 'SCAN_FW_DOWNLOAD_MODE',
+        'FW_DOWNLOAD_WORKERS': 'SCAN_FW_DOWNLOAD_WORKERS',
         'CONFIG_FILE': 'SCAN_CONFIG_FILE',
         'EXPERIMENT_TYPE': 'SCAN_EXPERIMENT_TYPE',
         'task_id': 'SCAN_TASK_ID',
@@ -141,6 +143,7 @@ try:
         'SINGULARITY_IMAGE_DIR': 'PIPELINE_SINGULARITY_IMAGE_DIR',
         'SINGULARITY_IMAGE': 'PIPELINE_SINGULARITY_IMAGE',
         'HEUDICONV_IMAGE': 'PIPELINE_HEUDICONV_IMAGE',
+        'DCM2NIIX_WORKERS': 'PIPELINE_DCM2NIIX_WORKERS',
         'FMRIPREP_SLURM_JOB_NAME': 'FMRIPREP_SLURM_JOB_NAME',
         'FMRIPREP_SLURM_ARRAY_SIZE': 'FMRIPREP_SLURM_ARRAY_SIZE',
         'FMRIPREP_SLURM_TIME': 'FMRIPREP_SLURM_TIME',
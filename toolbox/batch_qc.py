@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Study-wide QC (steps 04 and 05) for every subject in one process
+
+Steps 04-qc-metadata and 05-qc-volumes normally run as SLURM arrays with one
+task per subject, each paying for module loads, load_config.sh and Python
+startup to check a few dozen files. This script checks the metadata and the
+volume counts of every subject in the subjects file in a single run: all
+JSON sidecars and NIfTI headers of the study are read up front on a thread
+pool through the shared header index (toolbox/nifti_index.py), after which
+the per-subject checks only hit the index.
+
+Outputs keep the per-subject layout of the array jobs:
+    ${log_dir}/qc-verify_nii_metadata/sub-<id>_summary-{bids,bids_trimmed}.csv
+    ${log_dir}/diagnostics/<timestamp>_<id>/scan_volumes_summary.csv
+plus one study-level CSV with a row per subject:
+    ${log_dir}/diagnostics/<timestamp>_study/study_qc_summary.csv
+The volume results are also appended to the diagnostics store
+(${log_dir}/diagnostics/diagnostics.sqlite, see diagnostics_store.py), one
+run per subject CSV as the array jobs record them.
+
+Subjects are appended to 04-/05-processed_subjects.txt as the array jobs do.
+Subject list modifiers are honored: `skip` skips the subject, and step
+modifiers (e.g. `101:step5`) restrict it to the listed QC steps.
+
+@Author: Shawn Schwartz - Stanford Memory Lab
+@Description: Run metadata and volume QC for the whole study in one job
+@Dependencies: Python 3.9+, PyYAML
+@Usage: Called by batch_qc.sh (locally or as a single sbatch job)
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / '05-qc-volumes'))
+import check_volumes  # noqa: E402
+import diagnostics_store  # noqa: E402
+import nifti_index  # noqa: E402
+import verify_nii_metadata  # noqa: E402
+
+
+METADATA_STEP = 4
+VOLUMES_STEP = 5
+STUDY_FIELDS = ['subject_id', 'metadata_files', 'metadata_failures', 'volume_checks', 'volume_errors', 'status']
+
+
+def read_subject_entries(subjects_file):
+    """Subject entries of a subjects file, without comments and blank lines."""
+    with open(subjects_file, 'r') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+def parse_subject_entry(entry):
+    """
+    Split "101:step5:force" into the subject ID and the QC steps to run for it
+    (see parse_subject_modifiers.sh). Returns (subject_id, set of steps).
+    """
+    parts = [part.strip() for part in entry.split(':')]
+    subject_id, modifiers = parts[0], [m for m in parts[1:] if m]
+    if 'skip' in modifiers:
+        return subject_id, set()
+    steps = {int(m[len('step'):]) for m in modifiers if m.startswith('step') and m[len('step'):].isdigit()}
+    qc_steps = {METADATA_STEP, VOLUMES_STEP}
+    return subject_id, (steps & qc_steps) if steps else qc_steps
+
+
+def append_processed(processed_file, subject_ids):
+    if not subject_ids:
+        return
+    with open(processed_file, 'a') as f:
+        f.writelines(f'{subject_id}\n' for subject_id in subject_ids)
+
+
+def run_batch(args, subjects):
+    """Run the QC steps for every (subject_id, steps) pair; returns the study-level rows."""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    diagnostics_dir = args.log_dir / 'diagnostics'
+    metadata_dir = args.log_dir / 'qc-verify_nii_metadata'
+    metadata_dirs = (('bids', args.raw_dir, args.task_id), ('bids_trimmed', args.trim_dir, args.new_task_id))
+
+    metadata_subjects = [s for s, steps in subjects if METADATA_STEP in steps]
+    volume_subjects = [s for s, steps in subjects if VOLUMES_STEP in steps]
+    expected_by_series_number = verify_nii_metadata.get_expected_series_map(
+        verify_nii_metadata.load_config(args.config_path))
+    volume_checks = {
+        subject_id: check_volumes.plan_checks(
+            subject_id, args.raw_dir, args.trim_dir, args.new_task_id, args.runs, args.fmap_mapping,
+            args.n_dummy, args.expected_bold_vols, args.expected_bold_vols_after_trimming,
+            args.expected_fmap_vols)
+        for subject_id in volume_subjects
+    }
+
+    with nifti_index.open_index() as index:
+        # read every sidecar and header of the study once, concurrently
+        sidecars = [
+            nii_path[:-len('.nii.gz')] + '.json'
+            for subject_id in metadata_subjects
+            for dir_type, bids_dir, task in metadata_dirs
+            for nii_path in verify_nii_metadata.collect_bids_files(
+                os.path.join(bids_dir, f'sub-{subject_id}'), task, dir_type)
+        ]
+        print(f"[INFO] Reading {len(sidecars)} sidecars with {args.workers} workers")
+        index.sidecars(sorted(set(sidecars)), workers=args.workers)
+
+        metadata_dir.mkdir(parents=True, exist_ok=True)
+        metadata_results = {}
+        for subject_id in metadata_subjects:
+            records = []
+            for dir_type, bids_dir, task in metadata_dirs:
+                records += verify_nii_metadata.run_qc(
+                    subject_dir=os.path.join(bids_dir, f'sub-{subject_id}'), task_name=task,
+                    config_path=args.config_path,
+                    output_csv=str(metadata_dir / f'sub-{subject_id}_summary-{dir_type}.csv'),
+                    bids_dir_type=dir_type, subid=subject_id, index=index,
+                    expected_by_series_number=expected_by_series_number)
+            metadata_results[subject_id] = records
+
+        volume_results = {}
+        all_checks = [check for checks in volume_checks.values() for check in checks]
+        print(f"[INFO] Checking {len(all_checks)} volume counts with {args.workers} workers")
+        rows = check_volumes.run_checks(all_checks, index, args.workers)
+        for row in rows:
+            volume_results.setdefault(row[0], []).append(row)
+        volume_csvs = {}
+        for subject_id in volume_subjects:
+            volume_csvs[subject_id] = diagnostics_dir / f'{timestamp}_{subject_id}' / 'scan_volumes_summary.csv'
+            check_volumes.write_csv(volume_csvs[subject_id], volume_results.get(subject_id, []))
+
+    study_rows = []
+    for subject_id, steps in subjects:
+        if not steps:
+            print(f"[INFO] Skipping subject {subject_id} due to skip modifier")
+            continue
+        records = metadata_results.get(subject_id)
+        volume_rows = volume_results.get(subject_id, [])
+        metadata_failures = sum(1 for r in records if r['Match'] == 'FAIL') if records is not None else ''
+        volume_errors = sum(1 for r in volume_rows if r[-1] == 'ERROR') if VOLUMES_STEP in steps else ''
+        status = 'ERROR' if metadata_failures or volume_errors else 'OK'
+        study_rows.append({
+            'subject_id': subject_id,
+            'metadata_files': len(records) if records is not None else '',
+            'metadata_failures': metadata_failures,
+            'volume_checks': len(volume_rows) if VOLUMES_STEP in steps else '',
+            'volume_errors': volume_errors,
+            'status': status,
+        })
+
+    study_csv = diagnostics_dir / f'{timestamp}_study' / 'study_qc_summary.csv'
+    study_csv.parent.mkdir(parents=True, exist_ok=True)
+    with open(study_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=STUDY_FIELDS, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(study_rows)
+    print(f"[INFO] Study QC summary written to: {study_csv}")
+    if rows:
+        # one run per subject CSV, as check_volumes.py records it, so `import` recognizes them
+        db_path = args.diagnostics_db or str(diagnostics_dir / diagnostics_store.STORE_FILENAME)
+        diagnostics_store.record_runs(
+            [(volume_results[subject_id], str(csv_path)) for subject_id, csv_path in volume_csvs.items()
+             if volume_results.get(subject_id)], db_path=db_path)
+
+    # same bookkeeping as the per-subject array jobs
+    append_processed(args.log_dir / '04-processed_subjects.txt', metadata_subjects)
+    append_processed(args.log_dir / '05-processed_subjects.txt',
+                     [row['subject_id'] for row in study_rows if row['volume_errors'] == 0])
+    return study_rows
+
+
+def main():
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description='Run metadata and volume QC for every subject in one process')
+    parser.add_argument('--subjects-file', required=True, type=Path, help='Subjects list (with optional modifiers)')
+    parser.add_argument('--raw-dir', type=Path, default=env('RAW_DIR'), help='Raw BIDS directory')
+    parser.add_argument('--trim-dir', type=Path, default=env('TRIM_DIR'), help='Trimmed BIDS directory')
+    parser.add_argument('--task-id', default=env('task_id'), help='Original task ID')
+    parser.add_argument('--new-task-id', default=env('new_task_id'), help='New task ID')
+    parser.add_argument('--config-path', default=env('CONFIG_FILE'), help='Scan config JSON (scan-config.json)')
+    parser.add_argument('--runs', required=True, help='Comma-separated list of run numbers')
+    parser.add_argument('--fmap-mapping', required=True, type=json.loads,
+                        help='JSON string of BOLD run -> fieldmap mapping')
+    parser.add_argument('--n-dummy', type=int, default=env('n_dummy'), help='Dummy volumes removed')
+    parser.add_argument('--expected-bold-vols', type=int, default=env('EXPECTED_BOLD_VOLS'))
+    parser.add_argument('--expected-bold-vols-after-trimming', type=int,
+                        default=env('EXPECTED_BOLD_VOLS_AFTER_TRIMMING'))
+    parser.add_argument('--expected-fmap-vols', type=int, default=env('EXPECTED_FMAP_VOLS'))
+    parser.add_argument('--log-dir', type=Path, default=env('SLURM_LOG_DIR'), help='Workflow log directory')
+    parser.add_argument('--workers', type=int, default=16, help='Concurrent file reads (default: 16)')
+    parser.add_argument('--diagnostics-db', default=env('DIAGNOSTICS_DB'),
+                        help='Diagnostics store (default: <log-dir>/diagnostics/%s)' % diagnostics_store.STORE_FILENAME)
+    args = parser.parse_args()
+
+    for name in ('raw_dir', 'trim_dir', 'task_id', 'new_task_id', 'config_path', 'n_dummy', 'expected_bold_vols',
+                 'expected_bold_vols_after_trimming', 'expected_fmap_vols', 'log_dir'):
+        if getattr(args, name) is None:
+            parser.error(f"--{name.replace('_', '-')} is required (or source load_config.sh first)")
+    # values taken from the environment arrive as strings
+    for name in ('n_dummy', 'expected_bold_vols', 'expected_bold_vols_after_trimming', 'expected_fmap_vols'):
+        setattr(args, name, int(getattr(args, name)))
+    for name in ('raw_dir', 'trim_dir', 'log_dir'):
+        setattr(args, name, Path(getattr(args, name)))
+    args.runs = [r.strip() for r in args.runs.split(',') if r.strip()]
+
+    if not args.subjects_file.exists():
+        print(f"[ERROR] Subjects file {args.subjects_file} not found!")
+        sys.exit(1)
+    subjects = [parse_subject_entry(entry) for entry in read_subject_entries(args.subjects_file)]
+    print(f"[INFO] Found {len(subjects)} subjects in {args.subjects_file}")
+
+    study_rows = run_batch(args, subjects)
+    failed = [row['subject_id'] for row in study_rows if row['status'] == 'ERROR']
+    print(f"[INFO] {len(study_rows) - len(failed)} subject(s) passed, {len(failed)} need review")
+    if failed:
+        print(f"[ERROR] Subjects with QC errors: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/bin/bash
+# @Author: Shawn Schwartz - Stanford Memory Lab
+# @Date: October 18, 2026
+# @Description: Run QC steps 04 (metadata) and 05 (volumes) for the whole study in one job
+# @Usage: ./toolbox/batch_qc.sh                    (run on this machine)
+#         sbatch --time=00:30:00 --cpus-per-task=8 ./toolbox/batch_qc.sh   (single SLURM job)
+#
+# Replaces one SLURM array task per subject with a single batch_qc.py process
+# that reads the sidecars and headers of every subject on a thread pool.
+
+module load python/3.9.0
+
+export SKIP_SUBJECTS_PROMPT=true
+source ./load_config.sh
+
+if [ -n "${SELECTED_SUBJECTS_FILE}" ]; then
+  SUBJECTS_FILE="${SELECTED_SUBJECTS_FILE}"
+else
+  SUBJECTS_FILE="all-subjects.txt"
+fi
+echo "($(date)) [INFO] Using subjects file: ${SUBJECTS_FILE}"
+
+# convert fmap_mapping to JSON string
+fmap_to_json="{"
+for key in "${run_numbers[@]}"; do
+  fmap_to_json+="\"$key\":\"$(fmap_mapping "$key")\","
+done
+fmap_to_json="${fmap_to_json%,}}"
+run_numbers_csv=$(IFS=,; echo "${run_numbers[*]}")
+
+# I/O-bound reads: a few threads per allocated CPU
+workers=$(( ${SLURM_CPUS_PER_TASK:-4} * 4 ))
+
+python3 "${SCRIPTS_DIR}/toolbox/batch_qc.py" \
+  --subjects-file "${SUBJECTS_FILE}" \
+  --raw-dir "${RAW_DIR}" \
+  --trim-dir "${TRIM_DIR}" \
+  --task-id "${task_id}" \
+  --new-task-id "${new_task_id}" \
+  --config-path "${CONFIG_FILE}" \
+  --runs "${run_numbers_csv}" \
+  --fmap-mapping "${fmap_to_json}" \
+  --n-dummy "${n_dummy}" \
+  --expected-bold-vols "${EXPECTED_BOLD_VOLS}" \
+  --expected-bold-vols-after-trimming "${EXPECTED_BOLD_VOLS_AFTER_TRIMMING}" \
+  --expected-fmap-vols "${EXPECTED_FMAP_VOLS}" \
+  --log-dir "${SLURM_LOG_DIR}" \
+  --workers "${workers}"
+status=$?
+
+if [ ${status} -eq 0 ]; then
+  echo "($(date)) [SUCCESS] Study QC passed for all subjects"
+else
+  echo "($(date)) [ERROR] Study QC found subjects needing review (see ${SLURM_LOG_DIR}/diagnostics)"
+fi
+exit ${status}
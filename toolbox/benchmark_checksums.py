@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Benchmark dir_checksum_compare.py hashing modes on a synthetic tree
+
+Builds two copies of a synthetic tree of many small JSON sidecars and a few
+large .nii.gz-sized files (random bytes, i.e. incompressible like real
+gzipped NIfTI). The second copy has one JSON sidecar edited and one byte
+flipped in the middle of one large file. Each algorithm is then timed in full
+mode and in tiered mode, and each run must find exactly the two differences.
+
+The tree is kept under --work-dir and reused by later runs. Timings after the
+first pass come mostly from the page cache unless the large files are bigger
+than RAM, so use --nifti-gb larger than the node's memory for disk-bound
+numbers.
+
+Usage:
+    python benchmark_checksums.py --work-dir /scratch/users/$USER/checksum_bench [--n-json 5000] [--n-nifti 2] [--nifti-gb 2]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import dir_checksum_compare as dcc
+
+WRITE_CHUNK = 64 * 1024 * 1024
+
+
+def write_random_file(path, size):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            n = min(WRITE_CHUNK, remaining)
+            f.write(os.urandom(n))
+            remaining -= n
+
+
+def build_tree(work_dir, n_json, n_nifti, nifti_bytes):
+    """Create (or reuse) work_dir/a and its mutated copy work_dir/b."""
+    dir_a = work_dir / 'a'
+    dir_b = work_dir / 'b'
+    stamp = work_dir / 'tree.json'
+    spec = {'n_json': n_json, 'n_nifti': n_nifti, 'nifti_bytes': nifti_bytes}
+    if stamp.exists() and json.loads(stamp.read_text()) == spec:
+        print(f"Reusing synthetic tree in {work_dir}")
+        return dir_a, dir_b
+
+    for d in (dir_a, dir_b):
+        if d.exists():
+            shutil.rmtree(d)
+    print(f"Building synthetic tree: {n_json} JSON sidecars, {n_nifti} x {nifti_bytes / 1024 ** 3:.2f} GiB files")
+    for i in range(n_json):
+        sub_dir = dir_a / f"sub-{i % 100:03d}" / 'func'
+        sub_dir.mkdir(parents=True, exist_ok=True)
+        sidecar = {'RepetitionTime': 0.71, 'EchoTime': 0.03, 'TaskName': 'bench', 'Run': i}
+        (sub_dir / f"sub-{i % 100:03d}_run-{i:05d}_bold.json").write_text(json.dumps(sidecar, indent=2))
+    for i in range(n_nifti):
+        anat_dir = dir_a / f"sub-{i:03d}" / 'anat'
+        anat_dir.mkdir(parents=True, exist_ok=True)
+        write_random_file(anat_dir / f"sub-{i:03d}_run-{i:02d}_bold.nii.gz", nifti_bytes)
+
+    shutil.copytree(dir_a, dir_b)
+    jsons = sorted(dir_b.glob('sub-*/func/*.json'))
+    niftis = sorted(dir_b.glob('sub-*/anat/*.nii.gz'))
+    if jsons:
+        jsons[0].write_text(jsons[0].read_text().replace('bench', 'bench2'))
+    if niftis:
+        with open(niftis[0], 'r+b') as f:
+            f.seek(nifti_bytes // 2)
+            byte = f.read(1)
+            f.seek(nifti_bytes // 2)
+            f.write(bytes([byte[0] ^ 0xFF]))
+    stamp.write_text(json.dumps(spec))
+    return dir_a, dir_b
+
+
+def run_mode(dir_a, dir_b, algorithm, workers, sample_size):
+    start = time.time()
+    different = sum(record.status != 'matching'
+                    for record in dcc.compare_trees(dir_a, dir_b, algorithm, workers, progress_interval=0,
+                                                    sample_size=sample_size))
+    return time.time() - start, different
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dir_checksum_compare hashing modes')
+    parser.add_argument('--work-dir', required=True, help='Directory for the synthetic trees (kept for reuse)')
+    parser.add_argument('--n-json', type=int, default=5000, help='Number of small JSON sidecars (default: 5000)')
+    parser.add_argument('--n-nifti', type=int, default=2, help='Number of large .nii.gz files (default: 2)')
+    parser.add_argument('--nifti-gb', type=float, default=2.0, help='Size of each large file in GiB (default: 2)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of hashing processes (default/0: SLURM_CPUS_PER_TASK or CPU count)')
+    parser.add_argument('--algorithms', nargs='+', default=None,
+                        help=f'Algorithms to time (default: sha256 md5 blake2b{" xxh3" if dcc.xxhash else ""})')
+    args = parser.parse_args()
+
+    workers = args.workers if args.workers > 0 else dcc.default_workers()
+    algorithms = args.algorithms or [a for a in ('sha256', 'md5', 'blake2b', 'xxh3') if a in dcc.HASH_FUNCS]
+    work_dir = Path(args.work_dir).resolve()
+    work_dir.mkdir(parents=True, exist_ok=True)
+    dir_a, dir_b = build_tree(work_dir, args.n_json, args.n_nifti, int(args.nifti_gb * 1024 ** 3))
+    total_bytes = 2 * sum(f.stat().st_size for f in dir_a.rglob('*') if f.is_file())
+
+    results = []
+    for algorithm in algorithms:
+        for tiered in (False, True):
+            mode = 'tiered' if tiered else 'full'
+            elapsed, different = run_mode(dir_a, dir_b, algorithm, workers,
+                                          dcc.DEFAULT_SAMPLE_SIZE if tiered else None)
+            results.append((algorithm, mode, elapsed, different))
+
+    print("\n===== CHECKSUM BENCHMARK =====")
+    print(f"Tree: {args.n_json} JSON + {args.n_nifti} x {args.nifti_gb} GiB, "
+          f"{total_bytes / 1024 ** 3:.2f} GiB across both copies, {workers} workers")
+    print(f"{'algorithm':10s} {'mode':7s} {'seconds':>9s} {'GiB/s':>7s}  differences")
+    for algorithm, mode, elapsed, different in results:
+        rate = total_bytes / 1024 ** 3 / elapsed if elapsed > 0 else 0.0
+        status = "ok" if different == 2 else f"EXPECTED 2, FOUND {different}"
+        print(f"{algorithm:10s} {mode:7s} {elapsed:9.2f} {rate:7.2f}  {status}")
+
+
+if __name__ == '__main__':
+    main()
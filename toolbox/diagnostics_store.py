@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Append-only study-level store of volume QC results
+
+Every QC run (05-qc-volumes/check_volumes.py, toolbox/batch_qc.py) appends
+its rows to one SQLite database next to the diagnostics directories, in
+addition to the per-run scan_volumes_summary.csv. The latest state of the
+whole study is then a single indexed query instead of a glob over hundreds
+of timestamped CSV directories:
+
+    qc_runs        (id, recorded_at, source)
+    volume_checks  (qc_run, subject_id, scan_type, run_number, file_path,
+                    expected_volumes, actual_volumes, status)
+
+A subject's latest result is the set of rows from the QC run with the newest
+recorded_at (ties broken by insertion order) that checked it, so importing
+older CSVs after the fact never hides newer results. Rows are never updated
+or deleted, so older runs stay queryable.
+
+The database lives under the workflow log dir by default:
+    ${DIAGNOSTICS_DB}                                        (if set)
+    ${SLURM_LOG_DIR}/diagnostics/diagnostics.sqlite          (otherwise)
+
+Usage:
+    python3 diagnostics_store.py latest [--subjects 001,002] [--errors-only]
+    python3 diagnostics_store.py import DIAGNOSTICS_DIR [DIAGNOSTICS_DIR ...]
+    python3 diagnostics_store.py stats
+
+Arguments:
+    --db PATH       SQLite file to use instead of the default location
+"""
+
+import argparse
+import csv
+import os
+import re
+import sqlite3
+import sys
+from datetime import datetime
+
+
+SCHEMA_VERSION = 1
+STORE_FILENAME = 'diagnostics.sqlite'
+CSV_FIELDS = ['subject_id', 'scan_type', 'run_number', 'file_path', 'expected_volumes', 'actual_volumes', 'status']
+RUN_DIR_PATTERN = re.compile(r'^(\d{8}_\d{6})')
+
+
+def _as_values(row):
+    return [row[f] for f in CSV_FIELDS] if isinstance(row, dict) else list(row)
+
+
+def default_store_path():
+    """Resolve the store location from the environment (None if unknown)."""
+    explicit = os.environ.get('DIAGNOSTICS_DB')
+    if explicit:
+        return explicit
+    log_dir = os.environ.get('SLURM_LOG_DIR')
+    if log_dir:
+        return os.path.join(log_dir, 'diagnostics', STORE_FILENAME)
+    return None
+
+
+class DiagnosticsStore:
+    """SQLite table of every volume check ever run, one qc_runs row per QC invocation."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # array tasks of the same step write concurrently; wait for the lock
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self._init_schema()
+
+    def _init_schema(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, SCHEMA_VERSION):
+            raise sqlite3.DatabaseError(f"{self.db_path} has schema version {version}, expected {SCHEMA_VERSION}")
+        self.conn.executescript(
+            'CREATE TABLE IF NOT EXISTS qc_runs ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' recorded_at TEXT NOT NULL,'
+            ' source TEXT);'
+            'CREATE TABLE IF NOT EXISTS volume_checks ('
+            ' qc_run INTEGER NOT NULL REFERENCES qc_runs(id),'
+            ' subject_id TEXT NOT NULL,'
+            ' scan_type TEXT NOT NULL,'
+            ' run_number TEXT NOT NULL,'
+            ' file_path TEXT NOT NULL,'
+            ' expected_volumes INTEGER,'
+            ' actual_volumes TEXT,'
+            ' status TEXT NOT NULL);'
+            'CREATE INDEX IF NOT EXISTS volume_checks_subject ON volume_checks (subject_id, qc_run);'
+            f'PRAGMA user_version = {SCHEMA_VERSION};'
+        )
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def append(self, rows, source=None, recorded_at=None):
+        """
+        Record one QC run. rows are CSV rows in CSV_FIELDS order (lists) or
+        dicts keyed by CSV_FIELDS. source is stored as an absolute path.
+        Returns the new qc_run id.
+        """
+        recorded_at = recorded_at or datetime.now().isoformat(timespec='seconds')
+        source = os.path.abspath(source) if source else None
+        with self.conn:
+            qc_run = self.conn.execute(
+                'INSERT INTO qc_runs (recorded_at, source) VALUES (?, ?)', (recorded_at, source)
+            ).lastrowid
+            self.conn.executemany(
+                'INSERT INTO volume_checks (qc_run, subject_id, scan_type, run_number, file_path,'
+                ' expected_volumes, actual_volumes, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(qc_run, *_as_values(row)) for row in rows],
+            )
+        return qc_run
+
+    def latest(self, subject_ids=None, errors_only=False):
+        """
+        Rows of each subject's most recent QC run (by recorded_at, then id), as
+        dicts with the CSV columns plus recorded_at, ordered by subject and then
+        as they were checked.
+        """
+        query = (
+            'WITH latest AS ('
+            ' SELECT s.subject_id, (SELECT v.qc_run FROM volume_checks v JOIN qc_runs q ON q.id = v.qc_run'
+            '                      WHERE v.subject_id = s.subject_id'
+            '                      ORDER BY q.recorded_at DESC, q.id DESC LIMIT 1) AS qc_run'
+            ' FROM (SELECT DISTINCT subject_id FROM volume_checks) s)'
+            ' SELECT c.subject_id, c.scan_type, c.run_number, c.file_path, c.expected_volumes,'
+            ' c.actual_volumes, c.status, r.recorded_at'
+            ' FROM volume_checks c'
+            ' JOIN latest l ON c.subject_id = l.subject_id AND c.qc_run = l.qc_run'
+            ' JOIN qc_runs r ON r.id = c.qc_run'
+        )
+        conditions, params = [], []
+        if subject_ids:
+            conditions.append(f"c.subject_id IN ({','.join('?' * len(subject_ids))})")
+            params.extend(subject_ids)
+        if errors_only:
+            conditions.append("c.status = 'ERROR'")
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY c.subject_id, c.rowid'
+        columns = CSV_FIELDS + ['recorded_at']
+        return [dict(zip(columns, row)) for row in self.conn.execute(query, params)]
+
+    def has_source(self, source):
+        """True if a QC run from source (a CSV or diagnostics directory) is already stored."""
+        row = self.conn.execute(
+            'SELECT 1 FROM qc_runs WHERE source = ? LIMIT 1', (os.path.abspath(source),)).fetchone()
+        return row is not None
+
+    def import_csv(self, csv_path, recorded_at=None):
+        """
+        Append an existing scan_volumes_summary.csv as one QC run, unless it is
+        already stored (imported before, or recorded by the run that wrote it).
+        Returns the new qc_run id, or None if it was skipped.
+        """
+        if self.has_source(csv_path):
+            return None
+        with open(csv_path, 'r', newline='') as f:
+            rows = list(csv.DictReader(f))
+        return self.append(rows, source=str(csv_path), recorded_at=recorded_at)
+
+    def stats(self):
+        runs = self.conn.execute('SELECT COUNT(*) FROM qc_runs').fetchone()[0]
+        rows, subjects = self.conn.execute(
+            'SELECT COUNT(*), COUNT(DISTINCT subject_id) FROM volume_checks').fetchone()
+        return {'qc_runs': runs, 'volume_checks': rows, 'subjects': subjects}
+
+
+def open_store(db_path=None):
+    """Open the diagnostics store at db_path, or at the default location."""
+    db_path = db_path if db_path else default_store_path()
+    if not db_path:
+        raise ValueError('no diagnostics store location (set DIAGNOSTICS_DB or SLURM_LOG_DIR)')
+    return DiagnosticsStore(db_path)
+
+
+def record_runs(runs, db_path=None):
+    """
+    Append several QC runs, given as (rows, source) pairs, over one connection.
+    Never fails the QC run itself: errors are reported as a warning and the
+    CSV output remains the record.
+    """
+    try:
+        with open_store(db_path) as store:
+            for rows, source in runs:
+                store.append(rows, source=source)
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"[WARNING] Could not record results in the diagnostics store: {e}", file=sys.stderr)
+
+
+def record_run(rows, source=None, db_path=None):
+    """Append one QC run to the store (see record_runs)."""
+    record_runs([(rows, source)], db_path)
+
+
+def _run_time(csv_path):
+    """recorded_at of a diagnostics/<YYYYmmdd_HHMMSS>[_<id>]/ directory, if its name has one."""
+    match = RUN_DIR_PATTERN.match(os.path.basename(os.path.dirname(os.path.abspath(csv_path))))
+    if not match:
+        return None
+    return datetime.strptime(match.group(1), '%Y%m%d_%H%M%S').isoformat(timespec='seconds')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query or populate the study diagnostics store')
+    parser.add_argument('--db', default=None,
+                        help='SQLite store path (default: $DIAGNOSTICS_DB or $SLURM_LOG_DIR/diagnostics/%s)'
+                             % STORE_FILENAME)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p_latest = subparsers.add_parser('latest', help='Print the latest results per subject as CSV')
+    p_latest.add_argument('--subjects', default=None, help='Comma-separated subject IDs (default: all)')
+    p_latest.add_argument('--errors-only', action='store_true', help='Only print ERROR rows')
+    p_import = subparsers.add_parser('import', help='Import existing scan_volumes_summary.csv files, oldest first')
+    p_import.add_argument('dirs', nargs='+', help='Diagnostics directories to search')
+    subparsers.add_parser('stats', help='Show number of stored runs and rows')
+
+    args = parser.parse_args()
+
+    with open_store(args.db) as store:
+        if args.command == 'latest':
+            subjects = [s.strip() for s in args.subjects.split(',')] if args.subjects else None
+            writer = csv.DictWriter(sys.stdout, fieldnames=CSV_FIELDS + ['recorded_at'], lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(store.latest(subjects, args.errors_only))
+        elif args.command == 'import':
+            csv_paths = []
+            for root in args.dirs:
+                for dirpath, _, filenames in os.walk(root):
+                    if 'scan_volumes_summary.csv' in filenames:
+                        csv_paths.append(os.path.join(dirpath, 'scan_volumes_summary.csv'))
+            # oldest first, so runs without a timestamp in their name keep a sensible order
+            csv_paths.sort(key=lambda p: (_run_time(p) or '', p))
+            imported = sum(1 for csv_path in csv_paths
+                           if store.import_csv(csv_path, recorded_at=_run_time(csv_path)) is not None)
+            print(f"[INFO] Imported {imported} QC runs into {store.db_path} "
+                  f"({len(csv_paths) - imported} already stored)")
+        elif args.command == 'stats':
+            print(f"Store: {store.db_path}")
+            for key, value in store.stats().items():
+                print(f"  {key}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,150 +5,476 @@ Directory Checksum Comparison Script
 This script compares two directories by calculating and comparing checksums
 for all files. It automatically reports any differences, missing files, or extra files.
 
+Both trees are walked in sorted order and merged as they are read, so
+memory use stays flat however many files there are. Only the files that
+need a checksum are hashed: files present in just one directory are
+reported without being read, and files whose sizes differ are reported as
+different without being read. The remaining files are hashed on a process
+pool with large reads, and progress (files, bytes, MB/s) is printed while
+hashing. Differences are printed as they are found (up to --max-print) and
+every result can be streamed to a JSONL or CSV file with --output.
+
 Usage:
-    python dir_checksum_compare.py [dir1] [dir2] [--algorithm ALGORITHM]
+    python dir_checksum_compare.py [dir1] [dir2] [--algorithm ALGORITHM] [--workers N]
 
 Arguments:
     dir1            First directory for comparison
     dir2            Second directory for comparison
     --algorithm     Hash algorithm to use (default: sha256)
-                    Options: md5, sha1, sha256, sha512
-    --verbose, -v   Show additional details (matching files)
+                    Options: md5, sha1, sha256, sha512, blake2b, xxh3 (if the xxhash package is installed)
+    --fast          Use xxh3 if available, otherwise blake2b (corruption checks, not security)
+    --tiered        Compare large same-size files by sampled head/middle/tail blocks first
+    --sample-size   Tiered mode sample block size in KiB (default: 1024)
+    --workers       Number of hashing processes (default: SLURM_CPUS_PER_TASK or CPU count)
+    --block-size    Read size in MiB (default: 4)
+    --progress-interval  Seconds between progress lines (default: 10, 0 disables)
+    --manifest1/--manifest2  Checksum manifest per directory (see below)
+    --output, -o    Stream the result of every file, matching ones included (path, status,
+                    sizes, digests) to a file
+    --format        jsonl or csv (default: from the --output extension, else jsonl)
+    --max-print     Maximum number of differing files listed on the terminal (default: 100)
+    --verbose, -v   Also list matching files on the terminal
+
+A checksum manifest is a TSV of path, size, mtime_ns, algorithm and digest
+for every file in a directory. With --manifest1/--manifest2, files whose
+size and mtime match the manifest reuse the stored digest, every other file
+is hashed, and the manifest is rewritten, so re-verifying a mostly unchanged
+tree only reads the changed files. A manifest file can also be given in place
+of dir1 or dir2 to compare manifest-vs-tree or manifest-vs-manifest.
+Manifests are kept sorted by path so they can be merged as streams.
 
 Example:
-    python dir_checksum_compare.py /path/to/source /path/to/backup --algorithm md5
+    python dir_checksum_compare.py /path/to/source /path/to/backup --algorithm md5 --workers 16
+    python dir_checksum_compare.py /path/to/source /path/to/backup \\
+        --manifest1 /path/to/source.checksums.tsv --manifest2 /path/to/backup.checksums.tsv
+    python dir_checksum_compare.py /path/to/source.checksums.tsv /path/to/restored
+    python dir_checksum_compare.py /path/to/subjects /path/to/backup --output differences.jsonl
 """
 
 import os
 import sys
+import csv
+import json
 import hashlib
 import argparse
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
+from typing import NamedTuple, Optional
 import time
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HASH_FUNCS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+    'blake2b': hashlib.blake2b
+}
+if xxhash is not None:
+    HASH_FUNCS['xxh3'] = xxhash.xxh3_128
+
+# Fastest available hash for corruption checks (not for security)
+FAST_ALGORITHM = 'xxh3' if xxhash is not None else 'blake2b'
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_SAMPLE_SIZE = 1024 * 1024
+
+MANIFEST_COLUMNS = ['path', 'size', 'mtime_ns', 'algorithm', 'digest']
 
-def calculate_file_hash(file_path, algorithm='sha256', block_size=65536):
+
+def default_workers():
+    return int(os.environ.get('SLURM_CPUS_PER_TASK') or os.cpu_count() or 1)
+
+
+def calculate_file_hash(file_path, algorithm='sha256', block_size=DEFAULT_BLOCK_SIZE):
     """Calculate hash for a file using specified algorithm."""
-    hash_funcs = {
-        'md5': hashlib.md5,
-        'sha1': hashlib.sha1,
-        'sha256': hashlib.sha256,
-        'sha512': hashlib.sha512
-    }
-
-    if algorithm not in hash_funcs:
+    if algorithm not in HASH_FUNCS:
         raise ValueError(f"Unsupported hash algorithm: {algorithm}")
 
-    hash_obj = hash_funcs[algorithm]()
+    hash_obj = HASH_FUNCS[algorithm]()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
 
     try:
-        with open(file_path, 'rb') as f:
-            for block in iter(lambda: f.read(block_size), b''):
-                hash_obj.update(block)
+        with open(file_path, 'rb', buffering=0) as f:
+            for n in iter(lambda: f.readinto(buf), 0):
+                hash_obj.update(view[:n])
         return hash_obj.hexdigest()
     except IOError as e:
         return f"ERROR: {str(e)}"
 
 
-def get_directory_checksums(dir_path, algorithm):
-    """Recursively traverse directory and calculate checksums for all files."""
-    checksums = {}
-    dir_path = Path(dir_path).resolve()
+def calculate_sample_hash(file_path, algorithm='sha256', sample_size=DEFAULT_SAMPLE_SIZE):
+    """Hash of the head, middle and tail sample_size blocks of a file."""
+    hash_obj = HASH_FUNCS[algorithm]()
 
     try:
-        for root, _, files in os.walk(dir_path):
-            for file in files:
-                full_path = Path(root) / file
-                rel_path = full_path.relative_to(dir_path)
-                checksums[str(rel_path)] = calculate_file_hash(full_path, algorithm)
-    except Exception as e:
-        print(f"Error processing directory {dir_path}: {e}")
-        sys.exit(1)
+        with open(file_path, 'rb', buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            for offset in sorted({0, max(0, size // 2 - sample_size // 2), max(0, size - sample_size)}):
+                f.seek(offset)
+                hash_obj.update(f.read(sample_size))
+        return hash_obj.hexdigest()
+    except IOError as e:
+        return f"ERROR: {str(e)}"
+
+
+def _pair_digests(path1, path2, algorithm, block_size, sample_size):
+    """
+    Digests for one path (None: not needed) on each side. With sample_size
+    set, both files are first compared by their sampled blocks and only hashed
+    in full if the samples match.
+    """
+    if sample_size and path1 and path2:
+        sample1 = calculate_sample_hash(path1, algorithm, sample_size)
+        sample2 = calculate_sample_hash(path2, algorithm, sample_size)
+        if sample1 != sample2:
+            return f"sample:{sample1}", f"sample:{sample2}"
+    digest1 = calculate_file_hash(path1, algorithm, block_size) if path1 else None
+    digest2 = calculate_file_hash(path2, algorithm, block_size) if path2 else None
+    return digest1, digest2
+
+
+def _batch_job(jobs):
+    """Process pool entry point: list of _pair_digests arguments -> list of (digest1, digest2)."""
+    return [_pair_digests(*job) for job in jobs]
+
 
-    return checksums
+class Entry(NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    digest: Optional[str]
 
 
-def compare_checksums(dir1_checksums, dir2_checksums):
-    """Compare checksums between two directories and report differences."""
-    all_files = sorted(set(dir1_checksums.keys()) | set(dir2_checksums.keys()))
+class ComparisonRecord(NamedTuple):
+    path: str
+    status: str
+    size1: Optional[int]
+    size2: Optional[int]
+    digest1: Optional[str]
+    digest2: Optional[str]
 
-    matching = 0
-    different = 0
-    only_in_first = 0
-    only_in_second = 0
 
-    results = {
-        'matching': [],
-        'different': [],
-        'only_in_first': [],
-        'only_in_second': []
-    }
+STATUSES = ('matching', 'different', 'only_in_first', 'only_in_second')
 
-    for file in all_files:
-        if file in dir1_checksums and file in dir2_checksums:
-            if dir1_checksums[file] == dir2_checksums[file]:
-                matching += 1
-                results['matching'].append(file)
+
+def walk_sorted(dir_path, exclude=()):
+    """
+    Yield an Entry (without digest) for every file under dir_path, in sorted
+    relative-path order, holding only one directory listing per level in memory.
+    """
+    dir_path = Path(dir_path).resolve()
+    exclude = {str(Path(p).resolve()) for p in exclude}
+
+    def walk(current, prefix):
+        try:
+            with os.scandir(current) as it:
+                # Sort directories as "name/" so the walk order equals sorted() of the relative paths
+                listing = sorted(((e.name + '/' if e.is_dir(follow_symlinks=False) else e.name), e) for e in it)
+        except OSError as e:
+            print(f"Error processing directory {current}: {e}")
+            sys.exit(1)
+        for key, entry in listing:
+            rel = prefix + entry.name
+            if key.endswith('/'):
+                yield from walk(entry.path, rel + '/')
+            elif entry.is_file() and entry.path not in exclude:
+                st = entry.stat()
+                yield Entry(rel, st.st_size, st.st_mtime_ns, None)
+
+    yield from walk(str(dir_path), '')
+
+
+def iter_manifest(manifest_path):
+    """Yield (Entry, algorithm) for every row of a checksum manifest, checking it is sorted."""
+    with open(manifest_path, 'r', newline='') as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader, None)
+        if header != MANIFEST_COLUMNS:
+            raise ValueError(f"{manifest_path} is not a checksum manifest (expected columns {MANIFEST_COLUMNS})")
+        previous = None
+        for rel, size, mtime_ns, algorithm, digest in reader:
+            if previous is not None and rel <= previous:
+                raise ValueError(f"{manifest_path} is not sorted by path (at {rel})")
+            previous = rel
+            yield Entry(rel, int(size), int(mtime_ns), digest), algorithm
+
+
+def manifest_algorithm(manifest_path):
+    """Hash algorithm of a manifest, from its first row (None if empty)."""
+    for _, algorithm in iter_manifest(manifest_path):
+        return algorithm
+    return None
+
+
+def manifest_tmp_path(manifest_path):
+    """Temporary file a manifest is written to before replacing it."""
+    manifest_path = Path(manifest_path)
+    return manifest_path.with_name(manifest_path.name + '.tmp')
+
+
+class ManifestWriter:
+    """Streams sorted manifest rows to a temporary file that replaces the manifest on close."""
+
+    def __init__(self, manifest_path, algorithm):
+        self.manifest_path = Path(manifest_path)
+        self.tmp_path = manifest_tmp_path(self.manifest_path)
+        self.algorithm = algorithm
+        self._file = open(self.tmp_path, 'w', newline='')
+        self._writer = csv.writer(self._file, delimiter='\t', lineterminator='\n')
+        self._writer.writerow(MANIFEST_COLUMNS)
+
+    def add(self, entry, digest):
+        if digest is not None and not digest.startswith(('ERROR:', 'sample:')):
+            self._writer.writerow([entry.path, entry.size, entry.mtime_ns, self.algorithm, digest])
+
+    def close(self):
+        self._file.close()
+        os.replace(self.tmp_path, self.manifest_path)
+
+
+def tree_entries(dir_path, algorithm, manifest_path=None, reuse_counter=None):
+    """
+    Sorted Entries of a directory; with a manifest, files whose size, mtime
+    and algorithm are unchanged carry the stored digest. The manifest and its
+    temporary file are skipped when they live inside the directory.
+    """
+    exclude = [manifest_path, manifest_tmp_path(manifest_path)] if manifest_path else ()
+    entries = walk_sorted(dir_path, exclude=exclude)
+    if not manifest_path or not Path(manifest_path).exists():
+        yield from entries
+        return
+    stored = iter_manifest(manifest_path)
+    old = next(stored, None)
+    for entry in entries:
+        while old is not None and old[0].path < entry.path:
+            old = next(stored, None)
+        if (old is not None and old[0].path == entry.path and old[0].size == entry.size
+                and old[0].mtime_ns == entry.mtime_ns and old[1] == algorithm):
+            if reuse_counter is not None:
+                reuse_counter[0] += 1
+            yield entry._replace(digest=old[0].digest)
+        else:
+            yield entry
+
+
+def merge_sorted(entries1, entries2):
+    """Merge two sorted Entry streams into (path, entry1 or None, entry2 or None)."""
+    e1 = next(entries1, None)
+    e2 = next(entries2, None)
+    while e1 is not None or e2 is not None:
+        if e2 is None or (e1 is not None and e1.path < e2.path):
+            yield e1.path, e1, None
+            e1 = next(entries1, None)
+        elif e1 is None or e2.path < e1.path:
+            yield e2.path, None, e2
+            e2 = next(entries2, None)
+        else:
+            yield e1.path, e1, e2
+            e1 = next(entries1, None)
+            e2 = next(entries2, None)
+
+
+class ProgressReport:
+    """Periodic files/bytes/throughput lines while hashing."""
+
+    def __init__(self, interval=10.0):
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.start = time.time()
+        self._last = self.start
+
+    def update(self, nfiles, nbytes):
+        self.files += nfiles
+        self.bytes += nbytes
+        now = time.time()
+        if self.interval and now - self._last >= self.interval:
+            self._last = now
+            self.print_line(now)
+
+    def print_line(self, now=None):
+        elapsed = (now or time.time()) - self.start
+        rate = self.bytes / 1024 ** 2 / elapsed if elapsed > 0 else 0.0
+        print(f"  Hashed {self.files} files, {self.bytes / 1024 ** 3:.2f} GiB at {rate:.1f} MB/s", flush=True)
+
+
+def compare_trees(source1, source2, algorithm, workers=1, block_size=DEFAULT_BLOCK_SIZE, progress_interval=10.0,
+                  manifest1=None, manifest2=None, sample_size=None, batch_files=64, batch_bytes=256 * 1024 ** 2):
+    """
+    Stream a comparison of two directories (or manifests) as ComparisonRecords in sorted path order.
+
+    Both sides are walked in sorted order and merged, so memory does not grow
+    with the size of the trees. Only what the comparison needs is hashed:
+    files present on one side only are not read, size mismatches are
+    reported as different without hashing, and a side with a manifest
+    reuses the stored digests of unchanged files (and gets its manifest
+    rewritten). Hashing runs on a process pool in batches, with a bounded
+    number of batches in flight.
+
+    Args:
+        source1, source2: Directory, or manifest file standing in for a directory
+        algorithm: Hash algorithm (replaced by a manifest source's algorithm)
+        workers: Number of hashing processes
+        block_size: Read size in bytes
+        progress_interval: Seconds between progress lines (0 disables)
+        manifest1, manifest2: Optional manifest paths read and updated for directory sources
+        sample_size: Tiered mode: compare sampled head/middle/tail blocks of
+            large same-size files before hashing them in full
+
+    Yields:
+        ComparisonRecord per path
+    """
+    roots, streams, writers, reused = {}, {}, {}, {}
+    manifest_algorithms = {manifest_algorithm(src) for src in (source1, source2) if Path(src).is_file()}
+    if len(manifest_algorithms) > 1:
+        print(f"Error: manifests use different algorithms ({', '.join(sorted(manifest_algorithms))})")
+        sys.exit(1)
+    if manifest_algorithms and algorithm not in manifest_algorithms:
+        algorithm = manifest_algorithms.pop()
+        print(f"Using {algorithm} to match the manifest")
+
+    for n, source, manifest in ((1, source1, manifest1), (2, source2, manifest2)):
+        if Path(source).is_file():
+            roots[n] = None
+            streams[n] = (entry for entry, _ in iter_manifest(source))
+        else:
+            roots[n] = Path(source).resolve()
+            reused[n] = [0]
+            streams[n] = tree_entries(roots[n], algorithm, manifest, reused[n])
+            if manifest:
+                writers[n] = ManifestWriter(manifest, algorithm)
+
+    def needs_digest(n, entry, other):
+        if roots[n] is None or entry is None or entry.digest is not None:
+            return False
+        return n in writers or (other is not None and other.size == entry.size)
+
+    progress = ProgressReport(progress_interval)
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    pending = deque()
+    max_pending = max(2, workers * 2)
+    batch, batch_jobs, batch_size = [], [], 0
+
+    def submit():
+        nonlocal batch, batch_jobs, batch_size
+        if pool is not None and batch_jobs:
+            future = pool.submit(_batch_job, batch_jobs)
+        else:
+            future = Future()
+            future.set_result(_batch_job(batch_jobs))
+        pending.append((batch, future, batch_size))
+        batch, batch_jobs, batch_size = [], [], 0
+
+    def resolve(item):
+        items, future, nbytes = item
+        results = iter(future.result())
+        progress.update(sum(1 for *_, job in items if job), nbytes)
+        for rel, e1, e2, job in items:
+            d1 = e1.digest if e1 else None
+            d2 = e2.digest if e2 else None
+            if job:
+                h1, h2 = next(results)
+                d1 = h1 if job[0] else d1
+                d2 = h2 if job[1] else d2
+            if 1 in writers and e1:
+                writers[1].add(e1, d1)
+            if 2 in writers and e2:
+                writers[2].add(e2, d2)
+            if e2 is None:
+                status = 'only_in_first'
+            elif e1 is None:
+                status = 'only_in_second'
+            elif e1.size != e2.size:
+                status = 'different'
+            elif d1 is not None and d1 == d2 and not d1.startswith('ERROR:'):
+                status = 'matching'
             else:
-                different += 1
-                results['different'].append(file)
-        elif file in dir1_checksums:
-            only_in_first += 1
-            results['only_in_first'].append(file)
+                status = 'different'
+            yield ComparisonRecord(rel, status, e1.size if e1 else None, e2.size if e2 else None, d1, d2)
+
+    try:
+        for rel, e1, e2 in merge_sorted(streams[1], streams[2]):
+            job = None
+            need1 = needs_digest(1, e1, e2)
+            need2 = needs_digest(2, e2, e1)
+            if need1 or need2:
+                tiered = (sample_size if sample_size and need1 and need2 and not writers
+                          and e1.size > 3 * sample_size else None)
+                job = (str(roots[1] / rel) if need1 else None, str(roots[2] / rel) if need2 else None,
+                       algorithm, block_size, tiered)
+                batch_jobs.append(job)
+                batch_size += (e1.size if need1 else 0) + (e2.size if need2 else 0)
+            batch.append((rel, e1, e2, job))
+            if len(batch_jobs) >= batch_files or batch_size >= batch_bytes or len(batch) >= 4096:
+                submit()
+            while pending and (len(pending) > max_pending or pending[0][1].done()):
+                yield from resolve(pending.popleft())
+        submit()
+        while pending:
+            yield from resolve(pending.popleft())
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    for writer in writers.values():
+        writer.close()
+    if progress_interval and progress.files:
+        progress.print_line()
+    for n, count in reused.items():
+        if count[0]:
+            print(f"Reused {count[0]} unchanged digests from manifest {n}")
+
+
+class RecordWriter:
+    """Writes ComparisonRecords to a JSONL or CSV file as they are produced."""
+
+    def __init__(self, path, fmt):
+        self._file = open(path, 'w', newline='')
+        self.fmt = fmt
+        if fmt == 'csv':
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(ComparisonRecord._fields)
+
+    def write(self, record):
+        if self.fmt == 'csv':
+            self._writer.writerow(['' if v is None else v for v in record])
         else:
-            only_in_second += 1
-            results['only_in_second'].append(file)
-
-    return {
-        'stats': {
-            'matching': matching,
-            'different': different,
-            'only_in_first': only_in_first,
-            'only_in_second': only_in_second,
-            'total_files': len(all_files)
-        },
-        'details': results
-    }
-
-
-def print_results(comparison_results, dir1_path, dir2_path, verbose=False):
-    """Print comparison results in a readable format."""
-    stats = comparison_results['stats']
-    details = comparison_results['details']
+            self._file.write(json.dumps(record._asdict()) + '\n')
 
+    def close(self):
+        self._file.close()
+
+
+STATUS_LABELS = {
+    'different': 'DIFFERENT',
+    'only_in_first': 'ONLY IN 1',
+    'only_in_second': 'ONLY IN 2',
+    'matching': 'MATCHING',
+}
+
+
+def print_summary(counts, dir1_path, dir2_path, output=None):
+    """Print the summary counts of a comparison."""
     print("\n===== DIRECTORY CHECKSUM COMPARISON SUMMARY =====")
     print(f"Directory 1: {dir1_path}")
     print(f"Directory 2: {dir2_path}")
-    print(f"Total files: {stats['total_files']}")
-    print(f"Matching files: {stats['matching']}")
-    print(f"Different files: {stats['different']}")
-    print(f"Files only in first directory: {stats['only_in_first']}")
-    print(f"Files only in second directory: {stats['only_in_second']}")
-
-    # Always print changed files and files that exist only in one directory
-    if stats['different'] > 0:
-        print("\n----- FILES WITH DIFFERENT CHECKSUMS -----")
-        for file in details['different']:
-            print(f"  {file}")
-
-    if stats['only_in_first'] > 0:
-        print("\n----- FILES ONLY IN DIRECTORY 1 -----")
-        for file in details['only_in_first']:
-            print(f"  {file}")
-
-    if stats['only_in_second'] > 0:
-        print("\n----- FILES ONLY IN DIRECTORY 2 -----")
-        for file in details['only_in_second']:
-            print(f"  {file}")
-
-    # Only print matching files if verbose flag is set
-    if verbose and stats['matching'] > 0:
-        print("\n----- MATCHING FILES -----")
-        for file in details['matching']:
-            print(f"  {file}")
+    print(f"Total files: {sum(counts.values())}")
+    print(f"Matching files: {counts['matching']}")
+    print(f"Different files: {counts['different']}")
+    print(f"Files only in first directory: {counts['only_in_first']}")
+    print(f"Files only in second directory: {counts['only_in_second']}")
+    if output:
+        print(f"Results written to: {output}")
 
     print("\n===== RESULT =====")
-    if stats['different'] == 0 and stats['only_in_first'] == 0 and stats['only_in_second'] == 0:
+    if counts['different'] == 0 and counts['only_in_first'] == 0 and counts['only_in_second'] == 0:
         print("DIRECTORIES MATCH: All files are identical.")
     else:
         print("DIRECTORIES DIFFER: See details above.")
@@ -156,21 +482,47 @@ def print_results(comparison_results, dir1_path, dir2_path, verbose=False):
 
 def main():
     parser = argparse.ArgumentParser(description='Compare two directories using file checksums')
-    parser.add_argument('dir1', help='First directory for comparison')
-    parser.add_argument('dir2', help='Second directory for comparison')
-    parser.add_argument('--algorithm', default='sha256', choices=['md5', 'sha1', 'sha256', 'sha512'],
+    parser.add_argument('dir1', help='First directory (or checksum manifest) for comparison')
+    parser.add_argument('dir2', help='Second directory (or checksum manifest) for comparison')
+    parser.add_argument('--algorithm', default='sha256', choices=sorted(HASH_FUNCS),
                         help='Hash algorithm to use (default: sha256)')
+    parser.add_argument('--fast', action='store_true',
+                        help=f'Use the fastest available non-cryptographic-grade hash ({FAST_ALGORITHM}) instead of --algorithm')
+    parser.add_argument('--tiered', action='store_true',
+                        help='Compare large same-size files by head/middle/tail samples first; hash in full only if they match')
+    parser.add_argument('--sample-size', type=int, default=DEFAULT_SAMPLE_SIZE // 1024,
+                        help='Tiered mode sample block size in KiB (default: 1024)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of hashing processes (default/0: SLURM_CPUS_PER_TASK or CPU count)')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE // (1024 * 1024),
+                        help='Read size in MiB (default: 4)')
+    parser.add_argument('--progress-interval', type=float, default=10.0,
+                        help='Seconds between progress lines while hashing (default: 10, 0 disables)')
+    parser.add_argument('--manifest1', default=None,
+                        help='Checksum manifest for dir1: unchanged files reuse its digests and it is rewritten afterwards')
+    parser.add_argument('--manifest2', default=None,
+                        help='Checksum manifest for dir2 (see --manifest1)')
+    parser.add_argument('--output', '-o', default=None,
+                        help='Write the result of every file (matching ones included) to this file as it is produced')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default=None,
+                        help='Format of --output (default: from its extension, else jsonl)')
+    parser.add_argument('--max-print', type=int, default=100,
+                        help='Maximum number of differing files listed on the terminal (default: 100)')
     parser.add_argument('--verbose', '-v', action='store_true',
-                        help='Show additional details (matching files)')
+                        help='Also list matching files on the terminal')
 
     args = parser.parse_args()
+    workers = args.workers if args.workers > 0 else default_workers()
+    if args.fast:
+        args.algorithm = FAST_ALGORITHM
+    fmt = args.format or ('csv' if args.output and args.output.endswith('.csv') else 'jsonl')
 
-    # Validate directories exist
-    if not os.path.isdir(args.dir1):
+    # Validate directories (or manifests) exist
+    if not os.path.exists(args.dir1):
         print(f"Error: Directory does not exist: {args.dir1}")
         sys.exit(1)
 
-    if not os.path.isdir(args.dir2):
+    if not os.path.exists(args.dir2):
         print(f"Error: Directory does not exist: {args.dir2}")
         sys.exit(1)
 
@@ -180,22 +532,34 @@ def main():
     print(f"Comparing directories:")
     print(f"  Directory 1: {dir1_path}")
     print(f"  Directory 2: {dir2_path}")
-    print(f"  Using algorithm: {args.algorithm}")
+    print(f"  Using algorithm: {args.algorithm}{' (tiered)' if args.tiered else ''} with {workers} workers")
 
-    # Calculate checksums
     start_time = time.time()
-    print(f"\nCalculating checksums for directory 1...")
-    dir1_checksums = get_directory_checksums(dir1_path, args.algorithm)
-    print(f"Found {len(dir1_checksums)} files in directory 1")
-
-    print(f"\nCalculating checksums for directory 2...")
-    dir2_checksums = get_directory_checksums(dir2_path, args.algorithm)
-    print(f"Found {len(dir2_checksums)} files in directory 2")
-
-    # Compare and print results
-    print("\nComparing checksums...")
-    results = compare_checksums(dir1_checksums, dir2_checksums)
-    print_results(results, dir1_path, dir2_path, args.verbose)
+    counts = Counter({status: 0 for status in STATUSES})
+    writer = RecordWriter(args.output, fmt) if args.output else None
+    printed = 0
+    print()
+    try:
+        for record in compare_trees(dir1_path, dir2_path, args.algorithm, workers,
+                                    args.block_size * 1024 * 1024, args.progress_interval,
+                                    args.manifest1, args.manifest2,
+                                    args.sample_size * 1024 if args.tiered else None):
+            counts[record.status] += 1
+            if writer:
+                writer.write(record)
+            if record.status == 'matching' and not args.verbose:
+                continue
+            if printed < args.max_print:
+                print(f"  {STATUS_LABELS[record.status]:10s} {record.path}")
+                printed += 1
+    finally:
+        if writer:
+            writer.close()
+
+    listed = sum(counts.values()) - (0 if args.verbose else counts['matching'])
+    if listed > printed:
+        print(f"  ... {listed - printed} more not shown" + (f" (see {args.output})" if args.output else ""))
+    print_summary(counts, dir1_path, dir2_path, args.output)
 
     elapsed_time = time.time() - start_time
     print(f"\nComparison completed in {elapsed_time:.2f} seconds.")
@@ -203,4 +567,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
@@ -14,6 +14,7 @@ NC='\033[0m' # No Color
 # Source configuration
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 SKIP_SUBJECTS_PROMPT=true source "${SCRIPT_DIR}/../load_config.sh"
+source "${SCRIPT_DIR}/freesurfer_sync.sh"
 
 echo -e "${BLUE}╔═══════════════════════════════════════════════════════════════╗${NC}"
 echo -e "${BLUE}║     Freesurfer Output Download Utility                        ║${NC}"
@@ -29,6 +30,7 @@ LOCAL_DOWNLOAD_DIR="${FREESURFER_EDITING_LOCAL_FREESURFER_DIR:-${HOME}/freesurfe
 LOCAL_DOWNLOAD_DIR="${LOCAL_DOWNLOAD_DIR/#\~/$HOME}"
 SUBJECTS_LIST="${FREESURFER_EDITING_SUBJECTS_LIST:-}"
 DOWNLOAD_ALL="${FREESURFER_EDITING_DOWNLOAD_ALL:-false}"
+FS_SYNC_JOBS="${FREESURFER_EDITING_SYNC_JOBS:-4}"
 
 # Parse command line arguments
 while [[ $# -gt 0 ]]; do
@@ -53,6 +55,10 @@ while [[ $# -gt 0 ]]; do
             SUBJECTS_LIST="$2"
             shift 2
             ;;
+        --jobs)
+            FS_SYNC_JOBS="$2"
+            shift 2
+            ;;
         --all)
             DOWNLOAD_ALL=true
             shift
@@ -67,6 +73,7 @@ while [[ $# -gt 0 ]]; do
             echo "  --local-dir <path>         Local directory to download to (default: ~/freesurfer_edits)"
             echo "  --subjects <file|list>     Subject list file or comma-separated subject IDs"
             echo "  --all                      Download all subjects"
+            echo "  --jobs <n>                 Subjects downloaded in parallel (default: 4)"
             echo "  -h, --help                 Show this help message"
             echo ""
             echo "Interactive mode (no arguments):"
@@ -117,10 +124,18 @@ REMOTE_FREESURFER_DIR="${REMOTE_BASE_DIR}/freesurfer"
 # Escape path for safe use in remote shell
 ESCAPED_REMOTE_FREESURFER_DIR=$(printf '%q' "$REMOTE_FREESURFER_DIR")
 
-# Check if remote directory exists
+# Open the shared SSH connection (used by every ssh/rsync call below)
 echo ""
+echo -e "${BLUE}Connecting to ${REMOTE_SERVER}...${NC}"
+if ! fs_sync_connect "${REMOTE_USER}@${REMOTE_SERVER}"; then
+    echo -e "${RED}Error: Could not connect to ${REMOTE_USER}@${REMOTE_SERVER}${NC}"
+    exit 1
+fi
+trap 'fs_sync_disconnect "${REMOTE_USER}@${REMOTE_SERVER}"' EXIT
+
+# Check if remote directory exists
 echo -e "${BLUE}Checking remote Freesurfer directory...${NC}"
-if ! ssh "${REMOTE_USER}@${REMOTE_SERVER}" "[ -d '${ESCAPED_REMOTE_FREESURFER_DIR}' ]"; then
+if ! ssh ${FS_SSH_OPTS} "${REMOTE_USER}@${REMOTE_SERVER}" "[ -d '${ESCAPED_REMOTE_FREESURFER_DIR}' ]"; then
     echo -e "${RED}Error: Remote Freesurfer directory does not exist: ${REMOTE_FREESURFER_DIR}${NC}"
     exit 1
 fi
@@ -130,7 +145,7 @@ echo -e "${GREEN}✓ Remote directory found${NC}"
 if [ "$DOWNLOAD_ALL" = true ]; then
     echo ""
     echo -e "${BLUE}Fetching all subjects from remote...${NC}"
-    SUBJECTS=$(ssh "${REMOTE_USER}@${REMOTE_SERVER}" "ls -d '${ESCAPED_REMOTE_FREESURFER_DIR}'/sub-* 2>/dev/null | xargs -n 1 basename")
+    SUBJECTS=$(ssh ${FS_SSH_OPTS} "${REMOTE_USER}@${REMOTE_SERVER}" "ls -d '${ESCAPED_REMOTE_FREESURFER_DIR}'/sub-* 2>/dev/null | xargs -n 1 basename")
 
     if [ -z "$SUBJECTS" ]; then
         echo -e "${RED}Error: No subjects found in ${REMOTE_FREESURFER_DIR}${NC}"
@@ -153,7 +168,7 @@ elif [ -z "$SUBJECTS_LIST" ]; then
     read -p "> " SUBJECTS_INPUT
 
     if [ "$SUBJECTS_INPUT" = "all" ]; then
-        SUBJECTS=$(ssh "${REMOTE_USER}@${REMOTE_SERVER}" "ls -d '${ESCAPED_REMOTE_FREESURFER_DIR}'/sub-* 2>/dev/null | xargs -n 1 basename")
+        SUBJECTS=$(ssh ${FS_SSH_OPTS} "${REMOTE_USER}@${REMOTE_SERVER}" "ls -d '${ESCAPED_REMOTE_FREESURFER_DIR}'/sub-* 2>/dev/null | xargs -n 1 basename")
     elif [ -f "$SUBJECTS_INPUT" ]; then
         # Read from file, filter comments and blank lines
         SUBJECTS=$(grep -v '^[[:space:]]*#' "$SUBJECTS_INPUT" | grep -v '^[[:space:]]*$' | cut -d: -f1)
@@ -204,30 +219,20 @@ echo ""
 echo -e "${GREEN}Starting download...${NC}"
 echo ""
 
-SUCCESS_COUNT=0
-FAIL_COUNT=0
-FAILED_SUBJECTS=""
-
-for subject in $SUBJECTS; do
-    echo -e "${BLUE}Downloading ${subject}...${NC}"
-
-    # Create subject directory
+download_subject() {
+    local subject=$1
     mkdir -p "${LOCAL_DOWNLOAD_DIR}/${subject}"
+    fs_sync_subject "$subject" \
+        "${REMOTE_USER}@${REMOTE_SERVER}:$(fs_sync_remote_path "${REMOTE_FREESURFER_DIR}/${subject}/")" \
+        "${LOCAL_DOWNLOAD_DIR}/${subject}/"
+}
 
-    # Use rsync to download
-    if rsync -avz --progress \
-        "${REMOTE_USER}@${REMOTE_SERVER}:'${REMOTE_FREESURFER_DIR}/${subject}/'" \
-        "${LOCAL_DOWNLOAD_DIR}/${subject}/"; then
-
-        echo -e "${GREEN}✓ ${subject} downloaded successfully${NC}"
-        ((SUCCESS_COUNT++))
-    else
-        echo -e "${RED}✗ Failed to download ${subject}${NC}"
-        FAILED_SUBJECTS="${FAILED_SUBJECTS}\n  - ${subject}"
-        ((FAIL_COUNT++))
-    fi
-    echo ""
-done
+fs_sync_parallel download_subject $SUBJECTS
+echo ""
+fs_sync_report "local files replaced" $SUBJECTS
+SUCCESS_COUNT=$FS_SYNC_SUCCESS
+FAIL_COUNT=$FS_SYNC_FAILED
+FAILED_SUBJECTS=$FS_SYNC_FAILED_SUBJECTS
 
 # Summary
 echo ""
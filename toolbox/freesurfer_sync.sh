@@ -0,0 +1,149 @@
+#!/bin/bash
+# @Author: Shawn Schwartz - Stanford Memory Lab
+# @Date: October 18, 2026
+# @Description: Parallel rsync helpers shared by download_freesurfer.sh and upload_freesurfer.sh
+# @Usage: source "${SCRIPT_DIR}/freesurfer_sync.sh"
+#
+# - Several subjects are synced at once (FS_SYNC_JOBS), all over one shared
+#   ssh ControlMaster connection, so a password/2FA prompt happens only once.
+# - Compression is skipped for already-compressed files (.mgz, .nii.gz, ...),
+#   which make up most of a FreeSurfer subject directory.
+# - Each subject's rsync output goes to its own log, which is parsed into a
+#   per-subject summary of files and bytes moved and files backed up.
+#
+# Kept compatible with bash 3.2 (macOS), like load_config.sh.
+
+FS_SYNC_JOBS="${FS_SYNC_JOBS:-4}"
+FS_SYNC_SKIP_COMPRESS="mgz/gz/zip/bz2/xz/zst/jpg/png"
+FS_SYNC_LOG_DIR=""
+FS_SSH_OPTS=""
+
+# rsync >= 3.0 can send paths to the remote rsync over its own protocol (-s),
+# so they are passed as-is. Paths quoted for the remote shell do not work with
+# rsync >= 3.2.4, which escapes the arguments itself and keeps the quotes as
+# literal characters; only older rsyncs (e.g. 2.6.9 on macOS) need them.
+if rsync --help 2>&1 | grep -qE -- '--(protect|secluded)-args'; then
+    FS_SYNC_PROTECT_ARGS="-s"
+else
+    FS_SYNC_PROTECT_ARGS=""
+fi
+
+# A path on the remote side as rsync needs it: plain with -s, quoted otherwise
+fs_sync_remote_path() {
+    if [ -n "$FS_SYNC_PROTECT_ARGS" ]; then
+        printf '%s' "$1"
+    else
+        printf "'%s'" "$1"
+    fi
+}
+
+# Open the shared ssh connection used by every ssh/rsync call that follows
+fs_sync_connect() {
+    local remote=$1
+    local socket_dir="/tmp/${USER}_ssh_mux"
+    mkdir -p "$socket_dir"
+    FS_SSH_OPTS="-o ControlMaster=auto -o ControlPath=${socket_dir}/socket_%r@%h-%p -o ControlPersist=10m"
+    FS_SYNC_LOG_DIR=$(mktemp -d "${TMPDIR:-/tmp}/freesurfer_sync.XXXXXX")
+    ssh ${FS_SSH_OPTS} "$remote" true
+}
+
+fs_sync_disconnect() {
+    local remote=$1
+    ssh ${FS_SSH_OPTS} -O exit "$remote" 2>/dev/null
+}
+
+# rsync one subject; extra arguments (e.g. --backup) are passed through
+fs_sync_subject() {
+    local subject=$1
+    local src=$2
+    local dst=$3
+    shift 3
+
+    local compress_opts=""
+    # --skip-compress needs rsync >= 3.0; older rsyncs sync uncompressed
+    if rsync --help 2>&1 | grep -q -- '--skip-compress'; then
+        compress_opts="-z --skip-compress=${FS_SYNC_SKIP_COMPRESS}"
+    fi
+
+    rsync -a ${FS_SYNC_PROTECT_ARGS} ${compress_opts} -e "ssh ${FS_SSH_OPTS}" \
+        --stats --out-format='%i %l %n' "$@" \
+        "$src" "$dst" > "${FS_SYNC_LOG_DIR}/${subject}.log" 2>&1
+}
+
+# Run "$worker subject" for every subject, FS_SYNC_JOBS at a time
+fs_sync_parallel() {
+    local worker=$1
+    shift
+
+    local subject
+    for subject in "$@"; do
+        while [ "$(jobs -rp | wc -l)" -ge "$FS_SYNC_JOBS" ]; do
+            sleep 1
+        done
+        echo -e "${BLUE}Syncing ${subject}...${NC}"
+        (
+            "$worker" "$subject"
+            echo $? > "${FS_SYNC_LOG_DIR}/${subject}.status"
+        ) &
+    done
+    wait
+}
+
+# "files bytes replaced replaced_bytes sent received" from a subject's rsync log
+fs_sync_stats() {
+    local subject=$1
+    awk '
+        /^[<>]f/ {
+            size = $2; gsub(",", "", size)
+            files++; bytes += size
+            if (substr($1, 3, 3) != "+++") { replaced++; replaced_bytes += size }
+        }
+        /^Total bytes sent:/ { v = $4; gsub(",", "", v); sent = v }
+        /^Total bytes received:/ { v = $4; gsub(",", "", v); received = v }
+        END { printf "%d %.0f %d %.0f %.0f %.0f\n", files, bytes, replaced, replaced_bytes, sent, received }
+    ' "${FS_SYNC_LOG_DIR}/${subject}.log"
+}
+
+# Files a sync created (did not exist at the destination), one path per line
+# relative to the subject directory, written to ${FS_SYNC_LOG_DIR}/${subject}.added
+fs_sync_added() {
+    local subject=$1
+    awk '/^[<>]f\+\+\+/ { sub(/^[^ ]+ [^ ]+ /, ""); print }' \
+        "${FS_SYNC_LOG_DIR}/${subject}.log" > "${FS_SYNC_LOG_DIR}/${subject}.added"
+}
+
+fs_sync_mb() {
+    awk -v b="$1" 'BEGIN { printf "%.1f MB", b / 1048576 }'
+}
+
+# Print per-subject results and set FS_SYNC_SUCCESS/FS_SYNC_FAILED/FS_SYNC_FAILED_SUBJECTS.
+# $1 describes replaced files (e.g. "backed up" or "replaced locally").
+fs_sync_report() {
+    local replaced_label=$1
+    shift
+
+    FS_SYNC_SUCCESS=0
+    FS_SYNC_FAILED=0
+    FS_SYNC_FAILED_SUBJECTS=""
+    local total_bytes=0
+    local total_wire=0
+
+    local subject status files bytes replaced replaced_bytes sent received
+    for subject in "$@"; do
+        status=$(cat "${FS_SYNC_LOG_DIR}/${subject}.status" 2>/dev/null || echo 1)
+        if [ "$status" -ne 0 ]; then
+            echo -e "${RED}✗ ${subject} failed (rsync exit ${status}); last lines of ${FS_SYNC_LOG_DIR}/${subject}.log:${NC}"
+            tail -n 5 "${FS_SYNC_LOG_DIR}/${subject}.log" | sed 's/^/    /'
+            FS_SYNC_FAILED_SUBJECTS="${FS_SYNC_FAILED_SUBJECTS}\n  - ${subject}"
+            FS_SYNC_FAILED=$((FS_SYNC_FAILED + 1))
+            continue
+        fi
+        read files bytes replaced replaced_bytes sent received <<< "$(fs_sync_stats "$subject")"
+        echo -e "${GREEN}✓ ${subject}${NC}: ${files} files changed ($(fs_sync_mb "$bytes")), ${replaced} ${replaced_label} ($(fs_sync_mb "$replaced_bytes")); $(fs_sync_mb "$sent") sent, $(fs_sync_mb "$received") received"
+        FS_SYNC_SUCCESS=$((FS_SYNC_SUCCESS + 1))
+        total_bytes=$(awk -v a="$total_bytes" -v b="$bytes" 'BEGIN { printf "%.0f", a + b }')
+        total_wire=$(awk -v a="$total_wire" -v b="$sent" -v c="$received" 'BEGIN { printf "%.0f", a + b + c }')
+    done
+    echo -e "${BLUE}Total: $(fs_sync_mb "$total_bytes") of changed files, $(fs_sync_mb "$total_wire") over the network${NC}"
+    echo -e "${BLUE}rsync logs: ${FS_SYNC_LOG_DIR}${NC}"
+}
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Native NIfTI header reader
+
+Parses the fixed-size NIfTI-1 (348 byte) and NIfTI-2 (540 byte) headers
+directly from disk without forking FSL tools such as `fslinfo` or `fslnvols`.
+For `.nii.gz` files only the leading gzip block(s) needed to cover the header
+are decompressed, so reading the header of a multi-GB 4D BOLD series costs the
+same as reading a 3D anatomical image.
+
+Usage:
+    python3 nifti_header.py FILE [FILE ...]
+    python3 nifti_header.py --benchmark [--repeat N] FILE [FILE ...]
+
+Arguments:
+    FILE            One or more .nii or .nii.gz files
+    --benchmark     Compare per-file latency of the native reader against fslinfo
+    --repeat        Number of timed repetitions per file (default: 5)
+"""
+
+import argparse
+import gzip
+import shutil
+import struct
+import subprocess
+import sys
+import time
+
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# NIfTI datatype codes -> fslinfo-style names
+DATATYPE_NAMES = {
+    0: 'UNKNOWN',
+    1: 'BINARY',
+    2: 'UINT8',
+    4: 'INT16',
+    8: 'INT32',
+    16: 'FLOAT32',
+    32: 'COMPLEX64',
+    64: 'FLOAT64',
+    128: 'RGB24',
+    256: 'INT8',
+    512: 'UINT16',
+    768: 'UINT32',
+    1024: 'INT64',
+    1280: 'UINT64',
+    1536: 'FLOAT128',
+    1792: 'COMPLEX128',
+    2048: 'COMPLEX256',
+    2304: 'RGBA32',
+}
+
+SPATIAL_UNITS = {0: 'unknown', 1: 'm', 2: 'mm', 3: 'um'}
+TIME_UNITS = {0: 'unknown', 8: 's', 16: 'ms', 24: 'us', 32: 'hz', 40: 'ppm', 48: 'rads'}
+
+
+class NiftiHeaderError(ValueError):
+    """Raised when a file does not contain a readable NIfTI-1/2 header."""
+
+
+def _read_header_bytes(nifti_path):
+    """Read just enough bytes from the start of the file to cover a NIfTI-2 header."""
+    path = str(nifti_path)
+    opener = gzip.open if path.endswith('.gz') else open
+    try:
+        with opener(path, 'rb') as f:
+            return f.read(NIFTI2_HEADER_SIZE)
+    except (OSError, EOFError) as e:
+        raise NiftiHeaderError(f"Could not read NIfTI header from {path}: {e}") from e
+
+
+def _detect_layout(raw, nifti_path):
+    """Return (endian prefix, nifti version) based on the sizeof_hdr field."""
+    if len(raw) < 4:
+        raise NiftiHeaderError(f"File too short to be NIfTI: {nifti_path}")
+    for endian in ('<', '>'):
+        sizeof_hdr = struct.unpack(endian + 'i', raw[:4])[0]
+        if sizeof_hdr == NIFTI1_HEADER_SIZE:
+            return endian, 1
+        if sizeof_hdr == NIFTI2_HEADER_SIZE:
+            return endian, 2
+    raise NiftiHeaderError(f"Not a NIfTI-1/2 file (bad sizeof_hdr): {nifti_path}")
+
+
+def _parse_nifti1(raw, endian):
+    if len(raw) < NIFTI1_HEADER_SIZE:
+        raise NiftiHeaderError("Truncated NIfTI-1 header")
+    dim = list(struct.unpack_from(endian + '8h', raw, 40))
+    datatype, bitpix = struct.unpack_from(endian + '2h', raw, 70)
+    pixdim = list(struct.unpack_from(endian + '8f', raw, 76))
+    vox_offset, scl_slope, scl_inter = struct.unpack_from(endian + '3f', raw, 108)
+    xyzt_units = raw[123]
+    cal_max, cal_min, slice_duration, toffset = struct.unpack_from(endian + '4f', raw, 124)
+    descrip = raw[148:228]
+    magic = raw[344:348]
+    return {
+        'dim': dim,
+        'pixdim': pixdim,
+        'datatype': datatype,
+        'bitpix': bitpix,
+        'vox_offset': int(vox_offset),
+        'scl_slope': scl_slope,
+        'scl_inter': scl_inter,
+        'xyzt_units': xyzt_units,
+        'cal_max': cal_max,
+        'cal_min': cal_min,
+        'slice_duration': slice_duration,
+        'toffset': toffset,
+        'descrip': descrip,
+        'magic': magic,
+    }
+
+
+def _parse_nifti2(raw, endian):
+    if len(raw) < NIFTI2_HEADER_SIZE:
+        raise NiftiHeaderError("Truncated NIfTI-2 header")
+    magic = raw[4:12]
+    datatype, bitpix = struct.unpack_from(endian + '2h', raw, 12)
+    dim = list(struct.unpack_from(endian + '8q', raw, 16))
+    pixdim = list(struct.unpack_from(endian + '8d', raw, 104))
+    vox_offset = struct.unpack_from(endian + 'q', raw, 168)[0]
+    scl_slope, scl_inter, cal_max, cal_min, slice_duration, toffset = struct.unpack_from(
+        endian + '6d', raw, 176)
+    descrip = raw[240:320]
+    xyzt_units = struct.unpack_from(endian + 'i', raw, 500)[0]
+    return {
+        'dim': dim,
+        'pixdim': pixdim,
+        'datatype': datatype,
+        'bitpix': bitpix,
+        'vox_offset': int(vox_offset),
+        'scl_slope': scl_slope,
+        'scl_inter': scl_inter,
+        'xyzt_units': xyzt_units,
+        'cal_max': cal_max,
+        'cal_min': cal_min,
+        'slice_duration': slice_duration,
+        'toffset': toffset,
+        'descrip': descrip,
+        'magic': magic,
+    }
+
+
+def parse_header(raw, source='<bytes>'):
+    """
+    Parse NIfTI-1 or NIfTI-2 header bytes.
+
+    Args:
+        raw: Bytes from the start of the file (at least sizeof_hdr long)
+        source: Name used in error messages
+
+    Returns:
+        dict of header fields (see read_header)
+    """
+    endian, version = _detect_layout(raw, source)
+    if version == 1:
+        header = _parse_nifti1(raw, endian)
+    else:
+        header = _parse_nifti2(raw, endian)
+
+    header['nifti_version'] = version
+    header['endian'] = 'little' if endian == '<' else 'big'
+    header['data_type'] = DATATYPE_NAMES.get(header['datatype'], str(header['datatype']))
+    header['spatial_units'] = SPATIAL_UNITS.get(header['xyzt_units'] & 0x07, 'unknown')
+    header['time_units'] = TIME_UNITS.get(header['xyzt_units'] & 0x38, 'unknown')
+    header['descrip'] = header['descrip'].split(b'\x00', 1)[0].decode('ascii', errors='replace')
+    header['magic'] = header['magic'].split(b'\x00', 1)[0].decode('ascii', errors='replace')
+    return header
+
+
+def read_header_from_stream(f, source='<stream>'):
+    """
+    Read exactly one NIfTI header from an open binary stream.
+
+    Consumes sizeof_hdr bytes (348 or 540) so the caller can continue reading
+    extensions/voxel data from the same stream.
+
+    Returns:
+        (header dict, raw header bytes)
+    """
+    raw = f.read(4)
+    _, version = _detect_layout(raw, source)
+    size = NIFTI1_HEADER_SIZE if version == 1 else NIFTI2_HEADER_SIZE
+    raw += f.read(size - 4)
+    return parse_header(raw, source), raw
+
+
+def read_header(nifti_path):
+    """
+    Read a NIfTI-1 or NIfTI-2 header without loading any image data.
+
+    Args:
+        nifti_path: Path to a .nii or .nii.gz file
+
+    Returns:
+        dict with keys: nifti_version, endian, dim (list of 8), pixdim (list of 8),
+        datatype (int code), data_type (name), bitpix, vox_offset, scl_slope,
+        scl_inter, cal_max, cal_min, slice_duration, toffset, xyzt_units,
+        spatial_units, time_units, descrip, magic
+
+    Raises:
+        NiftiHeaderError: if the file is missing, truncated or not NIfTI
+    """
+    raw = _read_header_bytes(nifti_path)
+    return parse_header(raw, nifti_path)
+
+
+def get_nvols(header):
+    """Number of volumes (dim4), treating 3D images as a single volume like fslnvols."""
+    ndim = header['dim'][0]
+    if ndim < 4:
+        return 1
+    return max(int(header['dim'][4]), 1)
+
+
+def get_tr_seconds(header):
+    """Repetition time (pixdim4) converted to seconds using the header time units."""
+    tr = float(header['pixdim'][4])
+    units = header['time_units']
+    if units == 'ms':
+        return tr / 1000.0
+    if units == 'us':
+        return tr / 1000000.0
+    return tr
+
+
+def fslinfo_fields(header):
+    """Render a parsed header with the same keys `fslinfo` prints."""
+    fields = {'data_type': header['data_type']}
+    for i in range(1, 5):
+        fields[f'dim{i}'] = header['dim'][i]
+    fields['datatype'] = header['datatype']
+    for i in range(1, 5):
+        fields[f'pixdim{i}'] = header['pixdim'][i]
+    fields['cal_max'] = header['cal_max']
+    fields['cal_min'] = header['cal_min']
+    fields['file_type'] = 'NIFTI-1+' if header['nifti_version'] == 1 else 'NIFTI-2+'
+    return fields
+
+
+def read_header_fslinfo(nifti_path):
+    """Legacy path: fork `fslinfo` and parse its key/value output."""
+    p = subprocess.Popen(['fslinfo', str(nifti_path)], stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, encoding='utf8')
+    output, _ = p.communicate()
+    header_vals = {}
+    for line in output.split('\n'):
+        tmp = line.replace('\t', ' ').split(' ')
+        if tmp[0] != '':
+            header_vals[tmp[0]] = tmp[-1]
+    return header_vals
+
+
+def _time_per_file(func, files, repeat):
+    """Return the median per-file latency (seconds) of calling func on each file."""
+    timings = []
+    for nifti_path in files:
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(nifti_path)
+            samples.append(time.perf_counter() - start)
+        samples.sort()
+        timings.append(samples[len(samples) // 2])
+    return timings
+
+
+def benchmark(files, repeat=5):
+    """Print per-file header read latency for the native reader and fslinfo."""
+    native = _time_per_file(read_header, files, repeat)
+    has_fslinfo = shutil.which('fslinfo') is not None
+    legacy = _time_per_file(read_header_fslinfo, files, repeat) if has_fslinfo else None
+
+    print(f"{'file':60s} {'native (ms)':>12s} {'fslinfo (ms)':>13s} {'speedup':>8s}")
+    for i, nifti_path in enumerate(files):
+        name = str(nifti_path)[-60:]
+        n_ms = native[i] * 1000
+        if legacy is None:
+            print(f"{name:60s} {n_ms:12.3f} {'n/a':>13s} {'n/a':>8s}")
+        else:
+            l_ms = legacy[i] * 1000
+            print(f"{name:60s} {n_ms:12.3f} {l_ms:13.3f} {l_ms / n_ms:7.1f}x")
+
+    mean_native = sum(native) / len(native) * 1000
+    print(f"\nMean native latency:  {mean_native:.3f} ms/file")
+    if legacy is None:
+        print("fslinfo not found on PATH; skipped legacy timings")
+    else:
+        mean_legacy = sum(legacy) / len(legacy) * 1000
+        print(f"Mean fslinfo latency: {mean_legacy:.3f} ms/file")
+        print(f"Speedup:              {mean_legacy / mean_native:.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read NIfTI-1/2 headers without FSL')
+    parser.add_argument('files', nargs='+', help='NIfTI files (.nii or .nii.gz)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Compare per-file latency against fslinfo')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Timed repetitions per file in benchmark mode (default: 5)')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.files, repeat=max(args.repeat, 1))
+        return
+
+    status = 0
+    for nifti_path in args.files:
+        try:
+            header = read_header(nifti_path)
+        except NiftiHeaderError as e:
+            print(f"[ERROR] {e}", file=sys.stderr)
+            status = 1
+            continue
+        if len(args.files) > 1:
+            print(f"==> {nifti_path} <==")
+        for key, value in fslinfo_fields(header).items():
+            print(f"{key:14s} {value}")
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
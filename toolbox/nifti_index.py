@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Persistent header/sidecar cache for BIDS and fMRIPrep trees
+
+Stores parsed NIfTI header fields and JSON sidecar contents in a small SQLite
+database so that repeated QC and prep runs do not re-open the same files.
+Every entry is keyed by absolute path and validated against the file's
+(size, mtime, inode) on lookup; a changed or replaced file is re-read and the
+entry refreshed automatically. New entries are committed right away (once
+per batch for headers()/sidecars()), so concurrent jobs sharing the index
+never wait on another process's open write transaction.
+
+The database lives under the workflow log dir by default:
+    ${NIFTI_INDEX_DB}                                   (if set)
+    ${WORKFLOW_LOG_DIR}/nifti_header_index.sqlite       (otherwise)
+If neither is available the cache is kept in memory for the current process.
+
+Usage:
+    python3 nifti_index.py nvols FILE [FILE ...]
+    python3 nifti_index.py header FILE
+    python3 nifti_index.py sidecar FILE
+    python3 nifti_index.py warm DIR [DIR ...]
+    python3 nifti_index.py stats
+
+Arguments:
+    --db PATH       SQLite file to use instead of the default location
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import nifti_header
+
+
+SCHEMA_VERSION = 1
+INDEX_FILENAME = 'nifti_header_index.sqlite'
+
+KIND_NIFTI = 'nifti'
+KIND_SIDECAR = 'sidecar'
+
+
+def default_index_path():
+    """Resolve the on-disk index location from the environment (None = in-memory)."""
+    explicit = os.environ.get('NIFTI_INDEX_DB')
+    if explicit:
+        return explicit
+    log_dir = os.environ.get('WORKFLOW_LOG_DIR')
+    if log_dir:
+        return os.path.join(log_dir, INDEX_FILENAME)
+    return None
+
+
+def _read_sidecar(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class HeaderIndex:
+    """SQLite-backed cache of NIfTI headers and JSON sidecars keyed by (size, mtime, inode)."""
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path if db_path else ':memory:'
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._writable = True
+
+        if self.db_path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        try:
+            self.conn = sqlite3.connect(self.db_path, timeout=60)
+            self._init_schema()
+        except sqlite3.Error as e:
+            # never let a broken cache block the pipeline; fall back to memory
+            print(f"[WARNING] Could not open header index {self.db_path}: {e}; using in-memory cache",
+                  file=sys.stderr)
+            self.db_path = ':memory:'
+            self.conn = sqlite3.connect(self.db_path)
+            self._init_schema()
+
+    def _init_schema(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.conn.execute('DROP TABLE IF EXISTS files')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' path TEXT PRIMARY KEY,'
+            ' kind TEXT NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' inode INTEGER NOT NULL,'
+            ' payload TEXT NOT NULL)'
+        )
+        self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Flush pending entries and close the database."""
+        if self.conn is None:
+            return
+        self._commit()
+        self.conn.close()
+        self.conn = None
+
+    def _commit(self):
+        if not self._pending or not self._writable:
+            return
+        try:
+            self.conn.commit()
+        except sqlite3.OperationalError as e:
+            print(f"[WARNING] Header index commit failed ({e}); continuing without caching",
+                  file=sys.stderr)
+            self._writable = False
+        self._pending = 0
+
+    def _store(self, path, kind, size, mtime_ns, inode, value):
+        if not self._writable:
+            return
+        try:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO files (path, kind, size, mtime_ns, inode, payload) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (path, kind, size, mtime_ns, inode, json.dumps(value)),
+            )
+            self._pending += 1
+        except sqlite3.OperationalError as e:
+            print(f"[WARNING] Header index write failed ({e}); continuing without caching",
+                  file=sys.stderr)
+            self._writable = False
+
+    def record(self, nifti_path, header):
+        """Store a header the caller already knows (e.g. a file it just wrote) without re-reading it."""
+        path = os.path.abspath(str(nifti_path))
+        size, mtime_ns, inode = _stat_key(path)
+        self._store(path, KIND_NIFTI, size, mtime_ns, inode, header)
+        self._commit()
+
+    def _cached(self, path, kind, key):
+        """Stored value for path if it is still fresh for key (size, mtime_ns, inode), else None."""
+        row = self.conn.execute(
+            'SELECT kind, size, mtime_ns, inode, payload FROM files WHERE path = ?', (path,)
+        ).fetchone()
+        if row is not None and row[0] == kind and tuple(row[1:4]) == key:
+            self.hits += 1
+            return json.loads(row[4])
+        return None
+
+    def _lookup(self, path, kind, loader):
+        path = os.path.abspath(str(path))
+        size, mtime_ns, inode = _stat_key(path)
+
+        value = self._cached(path, kind, (size, mtime_ns, inode))
+        if value is not None:
+            return value
+
+        self.misses += 1
+        value = loader(path)
+        self._store(path, kind, size, mtime_ns, inode, value)
+        self._commit()
+        return value
+
+    def header(self, nifti_path):
+        """Parsed NIfTI header (see nifti_header.read_header), served from the index when fresh."""
+        return self._lookup(nifti_path, KIND_NIFTI, nifti_header.read_header)
+
+    def nvols(self, nifti_path):
+        """Number of volumes in a NIfTI file (fslnvols equivalent)."""
+        return nifti_header.get_nvols(self.header(nifti_path))
+
+    def _lookup_many(self, paths, kind, loader, workers):
+        results = {}
+        misses = []
+        for given in paths:
+            path = os.path.abspath(str(given))
+            try:
+                key = _stat_key(path)
+            except OSError as e:
+                results[given] = e
+                continue
+            value = self._cached(path, kind, key)
+            if value is not None:
+                results[given] = value
+            else:
+                misses.append((given, path, key))
+
+        def _load(path):
+            try:
+                return loader(path)
+            except (OSError, ValueError) as e:
+                return e
+
+        self.misses += len(misses)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            loaded = list(pool.map(_load, [path for _, path, _ in misses]))
+        # sqlite connections stay on this thread; store the new entries here
+        for (given, path, key), value in zip(misses, loaded):
+            results[given] = value
+            if not isinstance(value, Exception):
+                self._store(path, kind, *key, value)
+        self._commit()
+        return results
+
+    def headers(self, nifti_paths, workers=8):
+        """
+        Parsed headers of many files at once. Fresh entries are served from the
+        index; the remaining files are read on a thread pool, since parsing a
+        header is dominated by the open/read latency of the filesystem.
+        Returns {path: header}, or the OSError/ValueError raised for that path.
+        """
+        return self._lookup_many(nifti_paths, KIND_NIFTI, nifti_header.read_header, workers)
+
+    def sidecar(self, json_path):
+        """Parsed JSON sidecar contents, served from the index when fresh."""
+        return self._lookup(json_path, KIND_SIDECAR, _read_sidecar)
+
+    def sidecars(self, json_paths, workers=8):
+        """Parsed contents of many JSON sidecars at once (see headers())."""
+        return self._lookup_many(json_paths, KIND_SIDECAR, _read_sidecar, workers)
+
+    def warm(self, root, workers=8):
+        """Walk a directory tree and index every NIfTI header and JSON sidecar in it, one batch per directory."""
+        indexed = 0
+        for dirpath, _, filenames in os.walk(root):
+            paths = [os.path.join(dirpath, name) for name in sorted(filenames)]
+            niftis = [p for p in paths if p.endswith(('.nii', '.nii.gz'))]
+            sidecars = [p for p in paths if p.endswith('.json')]
+            results = {}
+            if niftis:
+                results.update(self.headers(niftis, workers))
+            if sidecars:
+                results.update(self.sidecars(sidecars, workers))
+            for path, value in results.items():
+                if isinstance(value, Exception):
+                    print(f"[WARNING] Skipping {path}: {value}", file=sys.stderr)
+                else:
+                    indexed += 1
+        return indexed
+
+    def stats(self):
+        """Entry counts by kind."""
+        rows = self.conn.execute('SELECT kind, COUNT(*) FROM files GROUP BY kind').fetchall()
+        return dict(rows)
+
+
+def open_index(db_path=None):
+    """Open the study header index at db_path, or at the default location."""
+    return HeaderIndex(db_path if db_path else default_index_path())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query or populate the NIfTI header/sidecar index')
+    parser.add_argument('--db', default=None,
+                        help='SQLite index path (default: $NIFTI_INDEX_DB or $WORKFLOW_LOG_DIR/%s)' % INDEX_FILENAME)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p_nvols = subparsers.add_parser('nvols', help='Print volume count for each file, one line per file in order '
+                                                  '(ERROR for unreadable files; fslnvols replacement)')
+    p_nvols.add_argument('files', nargs='+')
+    p_header = subparsers.add_parser('header', help='Print parsed header as JSON')
+    p_header.add_argument('file')
+    p_sidecar = subparsers.add_parser('sidecar', help='Print JSON sidecar contents')
+    p_sidecar.add_argument('file')
+    p_warm = subparsers.add_parser('warm', help='Index every NIfTI/JSON file under the given directories')
+    p_warm.add_argument('dirs', nargs='+')
+    subparsers.add_parser('stats', help='Show number of cached entries')
+
+    args = parser.parse_args()
+
+    status = 0
+    with open_index(args.db) as index:
+        if args.command == 'nvols':
+            # one batched lookup; output lines stay aligned with the arguments
+            headers = index.headers(args.files)
+            for path in args.files:
+                header = headers[path]
+                if isinstance(header, Exception):
+                    print(f"[ERROR] {path}: {header}", file=sys.stderr)
+                    print('ERROR')
+                    status = 1
+                else:
+                    print(nifti_header.get_nvols(header))
+        elif args.command == 'header':
+            print(json.dumps(index.header(args.file), indent=2))
+        elif args.command == 'sidecar':
+            print(json.dumps(index.sidecar(args.file), indent=2))
+        elif args.command == 'warm':
+            for root in args.dirs:
+                count = index.warm(root)
+                print(f"[INFO] Indexed {count} files under {root}")
+        elif args.command == 'stats':
+            print(f"Index: {index.db_path}")
+            for kind, count in sorted(index.stats().items()):
+                print(f"  {kind}: {count}")
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Concurrent fMRIPrep report puller used by pull_fmriprep_reports.sh
+
+Lists every sub-*.html report and sub-*/figures/ file on the server with a
+single `find` (path, size, mtime), skips files whose size and mtime already
+match the local copy, and then pulls the remaining files of several subjects
+at once. Each subject is one `tar` streamed over ssh and unpacked locally
+(which keeps the remote mtimes, so the next run can skip them). All ssh
+calls share the ControlMaster connection opened by the shell wrapper.
+
+A source without a host part (/path/to/fmriprep instead of
+user@server:/path/to/fmriprep) is read as a local directory, which is handy
+for testing.
+
+Requires GNU find on the server (for -printf).
+
+Usage:
+    python3 pull_fmriprep_reports.py --source user@server:/path/to/fmriprep --dest ./reports [--jobs 8] [--ssh-opts "..."]
+"""
+
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+
+def log(message):
+    """Same format as the echo lines in pull_fmriprep_reports.sh."""
+    print(f"({datetime.now().strftime('%a %b %d %H:%M:%S %Y')}) {message}", flush=True)
+
+
+class Remote:
+    """Runs shell commands in the source directory, over ssh or locally."""
+
+    def __init__(self, source, ssh_opts=''):
+        if ':' in source:
+            self.host, self.path = source.split(':', 1)
+        else:
+            self.host, self.path = None, source
+        self.ssh_opts = shlex.split(ssh_opts)
+
+    def command(self, script):
+        script = f"cd {shlex.quote(self.path)} && {script}"
+        if self.host is None:
+            return ['bash', '-c', script]
+        return ['ssh', *self.ssh_opts, self.host, script]
+
+
+def list_remote_files(remote):
+    """{relative path: (size, mtime)} for all report HTML files and figures."""
+    # find exits non-zero when a glob matches nothing (e.g. no reports yet); only a failed cd is an error
+    script = "{ find sub-*.html sub-*/figures -type f -printf '%p\\t%s\\t%T@\\n' 2>/dev/null || true; }"
+    result = subprocess.run(remote.command(script), capture_output=True, text=True, check=True)
+    files = {}
+    for line in result.stdout.splitlines():
+        path, size, mtime = line.rsplit('\t', 2)
+        files[path] = (int(size), int(float(mtime)))
+    return files
+
+
+def is_current(local_dir, path, size, mtime):
+    try:
+        st = os.stat(os.path.join(local_dir, path))
+    except FileNotFoundError:
+        return False
+    return st.st_size == size and int(st.st_mtime) == mtime
+
+
+def subject_of(path):
+    """sub-XXX for sub-XXX.html and sub-XXX/figures/..."""
+    first = path.split('/', 1)[0]
+    return first[:-len('.html')] if first.endswith('.html') else first
+
+
+def pull_subject(remote, local_dir, subject_id, paths):
+    """Stream paths as one tar from the source and unpack them into local_dir."""
+    sender = subprocess.Popen(remote.command('tar -cf - -T -'), stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    receiver = subprocess.Popen(['tar', '-xf', '-', '-C', local_dir], stdin=sender.stdout,
+                                stderr=subprocess.PIPE)
+    sender.stdout.close()
+    sender.stdin.write(''.join(f"{path}\n" for path in paths).encode())
+    sender.stdin.close()
+    receiver_err = receiver.communicate()[1]
+    sender_err = sender.stderr.read()
+    sender.wait()
+    if sender.returncode != 0 or receiver.returncode != 0:
+        error = (sender_err or receiver_err).decode(errors='replace').strip()
+        return subject_id, False, error
+    return subject_id, True, ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pull fMRIPrep HTML reports and figures concurrently')
+    parser.add_argument('--source', action='store', required=True,
+                        help='user@server:/path/to/fmriprep (or a local directory)')
+    parser.add_argument('--dest', action='store', required=True, help='Local directory')
+    parser.add_argument('--jobs', action='store', type=int, default=8,
+                        help='Subjects transferred concurrently (default: 8)')
+    parser.add_argument('--ssh-opts', action='store', default='',
+                        help='ssh options, e.g. the ControlMaster/ControlPath options of the shared connection')
+    args = parser.parse_args()
+
+    remote = Remote(args.source, args.ssh_opts)
+    os.makedirs(args.dest, exist_ok=True)
+
+    log("[INFO] Getting list of files to download...")
+    try:
+        files = list_remote_files(remote)
+    except subprocess.CalledProcessError as e:
+        log(f"[ERROR] Could not list {args.source}: {e.stderr.strip()}")
+        sys.exit(1)
+
+    to_pull = defaultdict(list)
+    skipped = 0
+    for path, (size, mtime) in sorted(files.items()):
+        if is_current(args.dest, path, size, mtime):
+            skipped += 1
+        else:
+            to_pull[subject_of(path)].append(path)
+    subjects = sorted({subject_of(path) for path in files})
+    nbytes = sum(files[path][0] for paths in to_pull.values() for path in paths)
+    log(f"[INFO] Found {len(files)} files for {len(subjects)} subjects; "
+        f"{skipped} already up to date, {sum(len(p) for p in to_pull.values())} to download "
+        f"({nbytes / 1024 ** 2:.1f} MB)")
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [pool.submit(pull_subject, remote, args.dest, subject_id, paths)
+                   for subject_id, paths in sorted(to_pull.items())]
+        for future in as_completed(futures):
+            subject_id, ok, error = future.result()
+            if ok:
+                log(f"[INFO] Completed downloading {subject_id} ({len(to_pull[subject_id])} files)")
+            else:
+                failed += 1
+                log(f"[ERROR] Failed to download {subject_id}: {error}")
+
+    log(f"[INFO] Download complete! Files are in {args.dest}")
+    if failed:
+        log(f"[ERROR] {failed} subject(s) failed; rerun to retry them")
+    sys.exit(min(failed, 255))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Compiled series classification table built from scan-config.json
+
+scan-config.json lists, per sequence type, the expected series numbers and
+either an exact series description or a description regex. compile_table()
+turns that into lookup structures once:
+
+    by_description   exact SeriesDescription -> rule
+    patterns         precompiled series_description_pattern regexes
+    by_number        SeriesNumber -> rule, for sequence types defined only by series number
+
+so classifying a series is a dict lookup plus at most one search per pattern
+sequence. The heudiconv heuristic (02-dcm2niix/dcm_heuristic.py) and the
+metadata QC (verify_nii_metadata.get_expected_series_map) both use this table,
+so scan-config.json is the single source of truth for both.
+
+Usage:
+    python3 series_table.py [--config scan-config.json] [--experiment-type advanced] [DESCRIPTION ...]
+"""
+
+import argparse
+import json
+import os
+import re
+from functools import lru_cache
+
+
+class SeriesRule:
+    """One sequence type from scan-config.json."""
+
+    __slots__ = ('sequence_type', 'description', 'series_numbers', 'series_description',
+                 'series_description_pattern', 'filename_template', 'required', 'regex')
+
+    def __init__(self, sequence_type, props):
+        self.sequence_type = sequence_type
+        self.description = props.get('description', '')
+        self.series_numbers = tuple(props.get('series_numbers', []))
+        self.series_description = props.get('series_description')
+        self.series_description_pattern = props.get('series_description_pattern')
+        self.filename_template = props.get('filename_template')
+        self.required = props.get('required', False)
+        self.regex = re.compile(self.series_description_pattern) if self.series_description_pattern else None
+
+    def run_number(self, series_description):
+        """Run number captured by the (?P<run>...) group of the description pattern, if any."""
+        if self.regex is None:
+            return None
+        match = self.regex.search(series_description or '')
+        if match and 'run' in match.groupdict() and match.group('run') is not None:
+            return int(match.group('run'))
+        return None
+
+    def __repr__(self):
+        return f"SeriesRule({self.sequence_type!r})"
+
+
+class SeriesTable:
+    """Lookup tables compiled from the default_sequences section of scan-config.json."""
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.by_description = {}
+        self.patterns = []
+        self.by_number = {}
+        for rule in rules:
+            if rule.series_description:
+                self.by_description.setdefault(rule.series_description, rule)
+            if rule.regex is not None:
+                self.patterns.append((rule.regex, rule))
+            if not rule.series_description and rule.regex is None:
+                for sn in rule.series_numbers:
+                    self.by_number.setdefault(sn, rule)
+
+    def classify(self, series_description, series_number=None):
+        """
+        Sequence rule for a series, or None if the series is not part of the protocol.
+
+        A description (exact or pattern) match wins; the series number is only
+        used for sequence types that define no description at all.
+        """
+        desc = series_description or ''
+        rule = self.by_description.get(desc)
+        if rule is not None:
+            return rule
+        for regex, rule in self.patterns:
+            if regex.search(desc):
+                return rule
+        if series_number is not None:
+            try:
+                return self.by_number.get(int(series_number))
+            except (TypeError, ValueError):
+                return None
+        return None
+
+    def expected_series_map(self):
+        """SeriesNumber -> expected properties (the shape used by verify_nii_metadata)."""
+        mapping = {}
+        for rule in self.rules:
+            for sn in rule.series_numbers:
+                mapping[sn] = {
+                    "sequence_type": rule.sequence_type,
+                    "description": rule.description,
+                    "series_description_pattern": rule.series_description_pattern,
+                    "filename_template": rule.filename_template,
+                    "series_description": rule.series_description,
+                    "required": rule.required
+                }
+        return mapping
+
+
+def compile_table(config, experiment_type=None):
+    """
+    Compile a parsed scan-config.json into a SeriesTable.
+
+    Args:
+        config: Parsed scan-config.json
+        experiment_type: Optional key of config['experiment_types'] restricting the sequence types
+    """
+    sequences = config["default_sequences"]
+    selected = None
+    if experiment_type:
+        selected = set(config.get("experiment_types", {}).get(experiment_type, sequences))
+    rules = [SeriesRule(seq_type, props) for seq_type, props in sequences.items()
+             if selected is None or seq_type in selected]
+    return SeriesTable(rules)
+
+
+@lru_cache(maxsize=8)
+def _load_table(config_path, mtime_ns, experiment_type):
+    with open(config_path, "r") as f:
+        return compile_table(json.load(f), experiment_type)
+
+
+def load_table(config_path, experiment_type=None):
+    """Compile scan-config.json at config_path, reusing the compiled table until the file changes."""
+    config_path = os.path.abspath(config_path)
+    return _load_table(config_path, os.stat(config_path).st_mtime_ns, experiment_type or None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show or test the compiled scan-config.json series table')
+    parser.add_argument('--config', default='scan-config.json', help='Path to scan-config.json')
+    parser.add_argument('--experiment-type', default=None, help='Restrict to an experiment type (e.g., advanced)')
+    parser.add_argument('descriptions', nargs='*', help='Series descriptions to classify')
+    args = parser.parse_args()
+
+    table = load_table(args.config, args.experiment_type)
+    if not args.descriptions:
+        for rule in table.rules:
+            match = rule.series_description or rule.series_description_pattern or f"series {list(rule.series_numbers)}"
+            print(f"{rule.sequence_type:8s} {match}")
+        return
+    for desc in args.descriptions:
+        rule = table.classify(desc)
+        print(f"{desc!r}: {rule.sequence_type if rule else 'unmatched'}")
+
+
+if __name__ == '__main__':
+    main()
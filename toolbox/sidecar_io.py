@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Atomic, write-if-changed JSON sidecar I/O shared by the pipeline stages
+
+Every JSON the pipeline writes goes through write_json(): the metadata is
+dumped canonically (sorted keys, indent=2), compared with the bytes already
+on disk, and only written if it differs, via a temporary file in the same
+directory that is renamed over the target. Unchanged files therefore keep
+their mtime and inode, so on a parallel filesystem a rerun does not
+invalidate caches or make downstream steps (nifti_index, checksum manifests)
+re-read files whose content is identical, and readers never see a partially
+written sidecar.
+
+    write_json(path, metadata)            write if the canonical dump differs
+    update_json(path, changes, source=)   read source (default: path), apply changes, write_json
+    copy_json(src, dst)                   copy src to dst if their bytes differ
+
+Each returns True if the file was written. An unchanged file given a
+different mode is only chmod-ed.
+"""
+
+import json
+import os
+from pathlib import Path
+
+
+def dumps(metadata, compact=False):
+    """Canonical serialization: sorted keys, 2-space indent (no whitespace if compact), UTF-8."""
+    if compact:
+        return json.dumps(metadata, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return json.dumps(metadata, indent=2, sort_keys=True).encode('utf-8')
+
+
+def read_json(path):
+    with open(path, 'rb') as f:
+        return json.load(f)
+
+
+def _current_bytes(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_bytes_if_changed(path, content, mode=None):
+    """
+    Atomically replace path with content unless it already holds exactly
+    content. mode defaults to the existing file's permissions; an unchanged
+    file whose permissions differ from mode is chmod-ed, not rewritten.
+    """
+    path = Path(path)
+    current = _current_bytes(path)
+    if current == content:
+        if mode is not None and path.stat().st_mode & 0o7777 != mode:
+            os.chmod(path, mode)
+        return False
+
+    if mode is None and current is not None:
+        mode = path.stat().st_mode & 0o7777
+    tmp_path = path.with_name(f'.{path.name}.tmp{os.getpid()}')
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return True
+
+
+def write_json(path, metadata, mode=None, compact=False):
+    """Write metadata to path (canonical dump) unless the file already holds it."""
+    return write_bytes_if_changed(path, dumps(metadata, compact), mode)
+
+
+def update_json(path, changes, source=None, mode=None):
+    """
+    Apply changes on top of source (default: path itself) and write the result
+    to path unless it is already up to date.
+    """
+    metadata = read_json(source if source is not None else path)
+    metadata.update(changes)
+    return write_json(path, metadata, mode)
+
+
+def copy_json(src, dst, mode=None):
+    """Copy src to dst byte-for-byte unless dst already has the same content."""
+    with open(src, 'rb') as f:
+        content = f.read()
+    return write_bytes_if_changed(dst, content, mode)
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+"""
+Sourcedata tarball engine used by tarball_sourcedata.sh
+
+Archives subject sourcedata directories concurrently (--jobs subjects at a
+time). Each archive is written as a stream through tarfile, optionally
+gzip-compressed on a thread pool: the tar stream is cut into fixed-size
+chunks and every chunk is compressed as an independent gzip member, so
+compression scales with --threads and the result is still an ordinary
+.tar.gz that `tar -xzf` reads.
+
+Next to every archive an index (sub-XXX.tar[.gz].index.json) records, for
+each member, its name, type, size and the offsets of its header and data in
+the uncompressed tar stream, plus the (uncompressed, compressed) offset of
+every gzip chunk. A single member can therefore be read by seeking straight
+to it (or to the chunk containing it) instead of scanning the archive.
+
+Archives are written to a .partial file and renamed when complete, so an
+interrupted run never leaves a truncated archive that later runs would skip.
+
+`extract` uses the index to restore part of a subject (e.g. anat/ or a single
+run) by seeking to the selected members, so it reads only those members
+(plus at most one 4 MiB gzip chunk each) regardless of archive size. Plain
+.tar files created before indexes existed can be indexed with `index`.
+
+Usage:
+    python3 sourcedata_tarball.py create --sourcedata-dir DIR --output-dir DIR --subjects 001 002 \
+        [--jobs 4] [--compress gzip --level 6 --threads 4] [--keep-original]
+    python3 sourcedata_tarball.py extract --archive-dir DIR --dest-dir DIR --subjects 001 \
+        --members anat/ 'func/*run-01*'
+    python3 sourcedata_tarball.py index --archive-dir DIR --subjects 001 002
+"""
+
+import argparse
+import bisect
+import fnmatch
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import sidecar_io
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.index.json'
+CHUNK_SIZE = 4 * 1024 * 1024
+
+COLORS = {'INFO': '\033[0;34m', 'SUCCESS': '\033[0;32m', 'WARNING': '\033[1;33m', 'ERROR': '\033[0;31m'}
+NC = '\033[0m'
+
+
+def log_message(level, message):
+    """Same format as log_message in tarball_sourcedata.sh."""
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{COLORS[level]}[{level}]{NC} ({timestamp}) {message}", flush=True)
+
+
+def human_size(nbytes):
+    for unit in ('B', 'K', 'M', 'G', 'T'):
+        if nbytes < 1024 or unit == 'T':
+            return f"{nbytes:.1f}{unit}" if unit != 'B' else f"{nbytes}{unit}"
+        nbytes /= 1024
+
+
+def archive_name(subject_id, compress):
+    return f"sub-{subject_id}.tar" + ('.gz' if compress == 'gzip' else '')
+
+
+def index_path(archive_path):
+    return Path(str(archive_path) + INDEX_SUFFIX)
+
+
+def find_archive(archive_dir, subject_id):
+    for compress in ('none', 'gzip'):
+        path = Path(archive_dir) / archive_name(subject_id, compress)
+        if path.exists():
+            return path
+    raise FileNotFoundError(f"Tar file not found: {Path(archive_dir) / archive_name(subject_id, 'none')}[.gz]")
+
+
+class ChunkedGzipWriter:
+    """
+    Write-only file object that compresses CHUNK_SIZE blocks as independent
+    gzip members on a thread pool (zlib releases the GIL) and writes them in
+    order, recording an (uncompressed offset, compressed offset) checkpoint
+    at the start of every member.
+    """
+
+    def __init__(self, fileobj, level=6, threads=1, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.chunk_size = chunk_size
+        self.pool = ThreadPoolExecutor(max_workers=max(1, threads))
+        self.max_pending = max(2, threads * 2)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.uncompressed_offset = 0
+        self.compressed_offset = 0
+        self.checkpoints = []
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self._submit(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def _submit(self, chunk):
+        self.pending.append((len(chunk), self.pool.submit(gzip.compress, chunk, self.level, mtime=0)))
+        while len(self.pending) > self.max_pending or (self.pending and self.pending[0][1].done()):
+            self._drain_one()
+
+    def _drain_one(self):
+        size, future = self.pending.popleft()
+        compressed = future.result()
+        self.checkpoints.append([self.uncompressed_offset, self.compressed_offset])
+        self.fileobj.write(compressed)
+        self.uncompressed_offset += size
+        self.compressed_offset += len(compressed)
+
+    def close(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self._drain_one()
+        self.pool.shutdown()
+
+
+class PlainWriter:
+    """Write-only file object for uncompressed archives (no checkpoints needed)."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.checkpoints = []
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+    def close(self):
+        pass
+
+
+def member_type(tarinfo):
+    if tarinfo.isdir():
+        return 'dir'
+    if tarinfo.issym():
+        return 'symlink'
+    if tarinfo.islnk():
+        return 'hardlink'
+    return 'file'
+
+
+def write_index(archive_path, compress, tar_size, checkpoints, members, partial_path=None):
+    """
+    Write the index for archive_path (atomically, see sidecar_io). When
+    partial_path is given, the archive is still at partial_path and is renamed
+    into place first.
+    """
+    index = {
+        'version': INDEX_VERSION,
+        'archive': archive_path.name,
+        'compression': compress,
+        'tar_size': tar_size,
+        'chunk_size': CHUNK_SIZE if compress == 'gzip' else None,
+        'checkpoints': checkpoints,
+        'member_fields': ['name', 'type', 'size', 'header_offset', 'data_offset'],
+        'members': members,
+    }
+    if partial_path is not None:
+        os.replace(partial_path, archive_path)
+    # written after the archive: until then load_index sees the old index as stale
+    if not sidecar_io.write_json(index_path(archive_path), index, compact=True):
+        # same index for a rewritten archive; mark it current
+        os.utime(index_path(archive_path))
+
+
+def load_index(archive_path):
+    """Index of archive_path, or None if it has none (or it predates the archive)."""
+    path = index_path(archive_path)
+    if not path.exists() or path.stat().st_mtime < Path(archive_path).stat().st_mtime:
+        return None
+    with open(path) as f:
+        index = json.load(f)
+    if index.get('version') != INDEX_VERSION:
+        return None
+    return index
+
+
+def index_archive(archive_path):
+    """Build the index of an existing uncompressed archive (one sequential read)."""
+    archive_path = Path(archive_path)
+    members = []
+    with tarfile.open(archive_path, mode='r:') as tar:
+        for tarinfo in tar:
+            size = tarinfo.size if tarinfo.isreg() else 0
+            data_offset = tarinfo.offset_data if tarinfo.isreg() else tar.offset
+            members.append([tarinfo.name, member_type(tarinfo), size, tarinfo.offset, data_offset])
+        tar_size = tar.offset
+    write_index(archive_path, 'none', tar_size, [], members)
+    return len(members)
+
+
+class IndexedGzipReader(io.RawIOBase):
+    """
+    Seekable read-only view of the uncompressed stream of a .tar.gz written by
+    ChunkedGzipWriter. A seek restarts decompression at the gzip member
+    containing the target, so at most one chunk is decompressed to reach it.
+    """
+
+    def __init__(self, path, checkpoints, tar_size):
+        self.fileobj = open(path, 'rb')
+        self.starts = [u for u, _ in checkpoints]
+        self.checkpoints = checkpoints
+        self.size = tar_size
+        self.position = 0
+        self.stream_position = None
+        self.decompressor = None
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def _restart(self):
+        i = max(0, bisect.bisect_right(self.starts, self.position) - 1)
+        uncompressed, compressed = self.checkpoints[i]
+        self.fileobj.seek(compressed)
+        self.decompressor = zlib.decompressobj(31)
+        self.stream_position = uncompressed
+        self.pending = b''
+
+    def _decompress_more(self):
+        """Decompress the next block; returns b'' at the end of the archive."""
+        while True:
+            if self.decompressor.eof:
+                unused = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(31)
+                data = self.decompressor.decompress(unused)
+            else:
+                compressed = self.fileobj.read(256 * 1024)
+                if not compressed:
+                    return b''
+                data = self.decompressor.decompress(compressed)
+            if data:
+                return data
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        # Restart at a checkpoint unless the target is just ahead in the current member
+        if (self.stream_position is None or self.position < self.stream_position
+                or self.position - self.stream_position > CHUNK_SIZE):
+            self._restart()
+        while self.stream_position + len(self.pending) <= self.position:
+            self.stream_position += len(self.pending)
+            self.pending = self._decompress_more()
+            if not self.pending:
+                return 0
+        start = self.position - self.stream_position
+        n = min(len(buffer), len(self.pending) - start, self.size - self.position)
+        buffer[:n] = self.pending[start:start + n]
+        self.position += n
+        return n
+
+    def close(self):
+        self.fileobj.close()
+        super().close()
+
+
+def member_matches(name, patterns):
+    """
+    Whether archive member name matches any pattern. Patterns are relative to
+    the subject directory (e.g. 'anat/', 'func/*run-01*'); a directory pattern
+    matches everything beneath it.
+    """
+    relative = name.split('/', 1)[1] if '/' in name else ''
+    for pattern in patterns:
+        prefix = pattern.rstrip('/')
+        if fnmatch.fnmatchcase(relative, prefix) or relative.startswith(prefix + '/'):
+            return True
+    return False
+
+
+def select_members(index, patterns):
+    """Index members matching patterns, in archive order."""
+    return sorted((member for member in index['members'] if member_matches(member[0], patterns)),
+                  key=lambda member: member[3])
+
+
+def extract_members(archive_path, patterns, dest_dir):
+    """
+    Extract the members matching patterns into dest_dir by seeking to each of
+    them through the archive index. Archives without a usable index are read
+    sequentially.
+
+    Returns:
+        (number of members extracted, bytes extracted, whether the index was used)
+    """
+    archive_path = Path(archive_path)
+    index = load_index(archive_path)
+    extract_kwargs = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+
+    if index is None or (index['compression'] == 'gzip' and not index['checkpoints']):
+        count = nbytes = 0
+        with tarfile.open(archive_path, mode='r:*') as tar:
+            for tarinfo in tar:
+                if member_matches(tarinfo.name, patterns):
+                    tar.extract(tarinfo, dest_dir, **extract_kwargs)
+                    count += 1
+                    nbytes += tarinfo.size if tarinfo.isreg() else 0
+        return count, nbytes, False
+
+    selected = select_members(index, patterns)
+    if index['compression'] == 'gzip':
+        fileobj = IndexedGzipReader(archive_path, index['checkpoints'], index['tar_size'])
+    else:
+        fileobj = open(archive_path, 'rb')
+    if index['compression'] == 'gzip':
+        fileobj = io.BufferedReader(fileobj, buffer_size=1024 * 1024)
+    nbytes = 0
+    with fileobj, tarfile.open(fileobj=fileobj, mode='r:') as tar:
+        for name, _, size, header_offset, _ in selected:
+            fileobj.seek(header_offset)
+            tarinfo = tarfile.TarInfo.fromtarfile(tar)
+            if tarinfo.name.rstrip('/') != name:
+                raise tarfile.TarError(f"index does not match archive at offset {header_offset} ({name})")
+            tar.extract(tarinfo, dest_dir, **extract_kwargs)
+            nbytes += size
+    return len(selected), nbytes, True
+
+
+def iter_subject_paths(subject_dir):
+    """Subject directory, then each directory followed by its files, in sorted order."""
+    for root, dirs, files in os.walk(subject_dir):
+        dirs.sort()
+        root = Path(root)
+        yield root
+        for name in sorted(files):
+            yield root / name
+        for name in dirs:
+            if (root / name).is_symlink():
+                yield root / name
+        dirs[:] = [d for d in dirs if not (root / d).is_symlink()]
+
+
+def create_archive(subject_id, sourcedata_dir, output_dir, compress='none', level=6, threads=1,
+                   keep_original=True):
+    """
+    Archive sourcedata_dir/sub-<subject_id> with its index.
+
+    Returns:
+        (subject_id, status, message) with status 'success', 'skipped' or 'failed'
+    """
+    sourcedata_dir = Path(sourcedata_dir)
+    subject_dir = sourcedata_dir / f"sub-{subject_id}"
+    archive_path = Path(output_dir) / archive_name(subject_id, compress)
+    partial_path = archive_path.with_name(archive_path.name + '.partial')
+
+    if not subject_dir.is_dir():
+        return subject_id, 'failed', f"Subject directory not found: {subject_dir}"
+    try:
+        return subject_id, 'skipped', f"Tar file already exists: {find_archive(output_dir, subject_id)} (skipping)"
+    except FileNotFoundError:
+        pass
+
+    start = time.time()
+    members = []
+    try:
+        with open(partial_path, 'wb') as raw:
+            writer = ChunkedGzipWriter(raw, level, threads) if compress == 'gzip' else PlainWriter(raw)
+            with tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                for path in iter_subject_paths(subject_dir):
+                    arcname = str(path.relative_to(sourcedata_dir))
+                    tarinfo = tar.gettarinfo(str(path), arcname)
+                    header_offset = tar.offset
+                    if tarinfo.isreg():
+                        with open(path, 'rb') as f:
+                            tar.addfile(tarinfo, f)
+                    else:
+                        tar.addfile(tarinfo)
+                    size = tarinfo.size if tarinfo.isreg() else 0
+                    padded = -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                    members.append([arcname, member_type(tarinfo), size, header_offset, tar.offset - padded])
+                tar_size = tar.offset
+            writer.close()
+    except (OSError, tarfile.TarError) as e:
+        partial_path.unlink(missing_ok=True)
+        return subject_id, 'failed', f"Failed to create tarball for sub-{subject_id}: {e}"
+
+    write_index(archive_path, compress, tar_size, writer.checkpoints, members, partial_path)
+
+    elapsed = time.time() - start
+    size = archive_path.stat().st_size
+    ratio = f", {100.0 * size / tar_size:.0f}% of {human_size(tar_size)}" if compress == 'gzip' and tar_size else ""
+    message = (f"Created tarball: {archive_path} ({human_size(size)}{ratio}, "
+               f"{len(members)} members, {elapsed:.1f}s)")
+
+    if not keep_original:
+        try:
+            shutil.rmtree(subject_dir)
+            message += f"; removed original directory {subject_dir}"
+        except OSError as e:
+            return subject_id, 'failed', f"{message}; failed to remove directory {subject_dir}: {e}"
+    return subject_id, 'success', message
+
+
+def create_archives(subjects, sourcedata_dir, output_dir, jobs=1, compress='none', level=6, threads=1,
+                    keep_original=True):
+    """Archive subjects with up to jobs at a time; returns {status: count}."""
+    counts = {'success': 0, 'skipped': 0, 'failed': 0}
+    log_message('INFO', f"Starting tarball operation for {len(subjects)} subject(s) "
+                        f"({jobs} at a time, compression: {compress}"
+                        f"{f' level {level} x {threads} threads' if compress == 'gzip' else ''})...")
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = [pool.submit(create_archive, subject, sourcedata_dir, output_dir, compress, level, threads,
+                               keep_original) for subject in subjects]
+        for subject in subjects:
+            log_message('INFO', f"Queued sub-{subject}")
+        for future in as_completed(futures):
+            subject_id, status, message = future.result()
+            counts[status] += 1
+            log_message({'success': 'SUCCESS', 'skipped': 'WARNING', 'failed': 'ERROR'}[status], message)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sourcedata tarball engine (used by tarball_sourcedata.sh)')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    create = sub.add_parser('create', help='Archive subject directories')
+    create.add_argument('--sourcedata-dir', required=True, help='Directory containing sub-* directories')
+    create.add_argument('--output-dir', required=True, help='Directory the archives are written to')
+    create.add_argument('--subjects', nargs='+', required=True, help='Subject IDs (without sub- prefix)')
+    create.add_argument('--jobs', type=int, default=4, help='Subjects archived concurrently (default: 4)')
+    create.add_argument('--compress', choices=['none', 'gzip'], default='none',
+                        help='Compression (default: none, i.e. a plain .tar)')
+    create.add_argument('--level', type=int, default=6, choices=range(1, 10), metavar='1-9',
+                        help='gzip compression level (default: 6)')
+    create.add_argument('--threads', type=int, default=0,
+                        help='Compression threads per archive (default/0: CPUs divided by --jobs)')
+    create.add_argument('--keep-original', action='store_true', help='Keep the subject directories')
+
+    extract = sub.add_parser('extract', help='Extract selected members using the archive index')
+    extract.add_argument('--archive-dir', required=True, help='Directory containing the archives')
+    extract.add_argument('--dest-dir', required=True, help='Directory the sub-* paths are extracted into')
+    extract.add_argument('--subjects', nargs='+', required=True, help='Subject IDs (without sub- prefix)')
+    extract.add_argument('--members', nargs='+', required=True,
+                         help="Paths or glob patterns relative to the subject directory (e.g. anat/ 'func/*run-01*')")
+
+    index = sub.add_parser('index', help='Write the index of existing uncompressed archives')
+    index.add_argument('--archive-dir', required=True, help='Directory containing the archives')
+    index.add_argument('--subjects', nargs='+', required=True, help='Subject IDs (without sub- prefix)')
+
+    args = parser.parse_args()
+    if args.command == 'extract':
+        failed = 0
+        for subject in args.subjects:
+            try:
+                archive_path = find_archive(args.archive_dir, subject)
+                start = time.time()
+                count, nbytes, indexed = extract_members(archive_path, args.members, args.dest_dir)
+            except (OSError, tarfile.TarError, ValueError) as e:
+                log_message('ERROR', f"Failed to extract sub-{subject}: {e}")
+                failed += 1
+                continue
+            if count == 0:
+                log_message('WARNING', f"No members of {archive_path.name} match: {' '.join(args.members)}")
+                continue
+            if not indexed:
+                log_message('WARNING', f"No index for {archive_path.name}; scanned the whole archive")
+            log_message('SUCCESS', f"Extracted {count} member(s) ({human_size(nbytes)}) of {archive_path.name} "
+                                   f"to {args.dest_dir} in {time.time() - start:.1f}s")
+        sys.exit(min(failed, 255))
+    if args.command == 'index':
+        failed = 0
+        for subject in args.subjects:
+            try:
+                archive_path = find_archive(args.archive_dir, subject)
+                if archive_path.suffix == '.gz':
+                    raise ValueError("only uncompressed .tar archives can be indexed after the fact")
+                count = index_archive(archive_path)
+                log_message('SUCCESS', f"Indexed {archive_path.name} ({count} members)")
+            except (OSError, tarfile.TarError, ValueError) as e:
+                log_message('ERROR', f"Failed to index sub-{subject}: {e}")
+                failed += 1
+        sys.exit(min(failed, 255))
+    if args.command == 'create':
+        cpus = int(os.environ.get('SLURM_CPUS_PER_TASK') or os.cpu_count() or 1)
+        threads = args.threads if args.threads > 0 else max(1, cpus // max(1, args.jobs))
+        Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+        counts = create_archives(args.subjects, args.sourcedata_dir, args.output_dir, args.jobs,
+                                 args.compress, args.level, threads, args.keep_original)
+        log_message('INFO', "==========================================")
+        log_message('INFO', "Tarball operation complete!")
+        log_message('INFO', f"Total subjects: {len(args.subjects)}")
+        log_message('SUCCESS', f"Successfully tarballed: {counts['success']}")
+        if counts['skipped']:
+            log_message('WARNING', f"Skipped (already exists): {counts['skipped']}")
+        if counts['failed']:
+            log_message('ERROR', f"Failed: {counts['failed']}")
+        log_message('INFO', "==========================================")
+        sys.exit(min(counts['failed'], 255))
+
+
+if __name__ == '__main__':
+    main()
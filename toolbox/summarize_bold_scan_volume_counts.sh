@@ -17,36 +17,20 @@ mkdir -p "${OUTPUT_DIR}"
 CSV_FILE="${OUTPUT_DIR}/scan_volumes_summary.csv"
 echo "subject_id,scan_type,run_number,file_path,expected_volumes,actual_volumes,status" > "${CSV_FILE}"
 
-# Function to check volumes and append to CSV
+# Checks are collected first (subject,scan_type,run,file,expected per line) and
+# all volume counts are then read by a single nifti_index.py call
+PLAN_FILE=$(mktemp "${TMPDIR:-/tmp}/scan_volumes_plan.XXXXXX")
+trap 'rm -f "${PLAN_FILE}"' EXIT
+
+# Function to queue a volume check
 check_volumes() {
   _file="$1"
   _expected="$2"
   _scan_type="$3"
   _run="$4"
   _subid="$5"
-  
-  # Skip if file doesn't exist
-  if [ ! -f "${_file}" ]; then
-    echo "${_subid},${_scan_type},${_run},${_file},${_expected},FILE_NOT_FOUND,ERROR" >> "${CSV_FILE}"
-    echo "[WARNING] File not found: ${_file}"
-    return 1
-  fi
-  
-  # Get actual volume count
-  _actual=$(fslnvols ${_file})
-  
-  # Determine status
-  if [ "${_actual}" -ne "${_expected}" ]; then
-    _status="ERROR"
-    echo "[ERROR] Volume mismatch in ${_file}: Expected ${_expected}, found ${_actual}"
-  else
-    _status="OK"
-    echo "[INFO] Volume check passed for ${_file}: ${_actual} volumes"
-  fi
-  
-  echo "${_subid},${_scan_type},${_run},${_file},${_expected},${_actual},${_status}" >> "${CSV_FILE}"
-  
-  return 0
+
+  echo "${_subid},${_scan_type},${_run},${_file},${_expected}" >> "${PLAN_FILE}"
 }
 
 # Use the subjects file selected by load_config.sh
@@ -88,7 +72,7 @@ grep -v '^[[:space:]]*#' "${SUBJECTS_FILE}" | grep -v '^[[:space:]]*$' | while r
 
     if [ ${#bold_files[@]} -eq 0 ]; then
       # No matching files found
-      echo "${subject_id},BOLD,${run_bold},${bold_pattern},${EXPECTED_BOLD_VOLS},FILE_NOT_FOUND,ERROR" >> "${CSV_FILE}"
+      check_volumes "${bold_pattern}" "${EXPECTED_BOLD_VOLS}" "BOLD" "${run_bold}" "${subject_id}"
       echo "[WARNING] No BOLD file found for subject ${subject_id}, run ${run_bold}"
     elif [ ${#bold_files[@]} -gt 1 ]; then
       # Multiple matching files found (unusual case)
@@ -122,7 +106,7 @@ grep -v '^[[:space:]]*#' "${SUBJECTS_FILE}" | grep -v '^[[:space:]]*$' | while r
 
     if [ ${#bold_files[@]} -eq 0 ]; then
       # No matching files found
-      echo "${subject_id},BOLD,${run_bold},${bold_pattern},${EXPECTED_BOLD_VOLS_AFTER_TRIMMING},FILE_NOT_FOUND,ERROR" >> "${CSV_FILE}"
+      check_volumes "${bold_pattern}" "${EXPECTED_BOLD_VOLS_AFTER_TRIMMING}" "BOLD" "${run_bold}" "${subject_id}"
       echo "[WARNING] No BOLD file found for subject ${subject_id}, run ${run_bold}"
     elif [ ${#bold_files[@]} -gt 1 ]; then
       # Multiple matching files found (unusual case)
@@ -147,9 +131,57 @@ grep -v '^[[:space:]]*#' "${SUBJECTS_FILE}" | grep -v '^[[:space:]]*$' | while r
     check_volumes "${fieldmap_file}" "${fmap_remain_vols}" "FIELDMAP" "${run_fmap}" "${subject_id}"
   done
 
-  echo "[INFO] Completed volume check for subject ${subject_id}"
+  echo "[INFO] Collected volume checks for subject ${subject_id}"
 done
 
+# Read the volume counts of every existing file in one process (served from the header index when unchanged)
+nvols_files=()
+while IFS=, read -r _subid _scan_type _run _file _expected; do
+  if [ -f "${_file}" ]; then
+    nvols_files+=("${_file}")
+  fi
+done < "${PLAN_FILE}"
+
+nvols_counts=()
+if [ ${#nvols_files[@]} -gt 0 ]; then
+  echo "[INFO] Reading volume counts of ${#nvols_files[@]} files"
+  # one line per file, in argument order (ERROR for unreadable files)
+  while IFS= read -r _count; do
+    nvols_counts+=("${_count}")
+  done < <(python3 "${SCRIPTS_DIR}/toolbox/nifti_index.py" nvols "${nvols_files[@]}")
+fi
+
+# Write the CSV rows in the order the checks were collected
+_i=0
+while IFS=, read -r _subid _scan_type _run _file _expected; do
+  if [ ! -f "${_file}" ]; then
+    # a BOLD run without any matching file was already reported above
+    if [ "${_scan_type}" != "BOLD" ]; then
+      echo "[WARNING] File not found: ${_file}"
+    fi
+    echo "${_subid},${_scan_type},${_run},${_file},${_expected},FILE_NOT_FOUND,ERROR" >> "${CSV_FILE}"
+    continue
+  fi
+
+  _actual="${nvols_counts[${_i}]}"
+  _i=$((_i + 1))
+
+  # Determine status
+  if ! [[ "${_actual}" =~ ^[0-9]+$ ]]; then
+    _actual="UNREADABLE"
+    _status="ERROR"
+    echo "[ERROR] Could not read header of ${_file}"
+  elif [ "${_actual}" -ne "${_expected}" ]; then
+    _status="ERROR"
+    echo "[ERROR] Volume mismatch in ${_file}: Expected ${_expected}, found ${_actual}"
+  else
+    _status="OK"
+    echo "[INFO] Volume check passed for ${_file}: ${_actual} volumes"
+  fi
+
+  echo "${_subid},${_scan_type},${_run},${_file},${_expected},${_actual},${_status}" >> "${CSV_FILE}"
+done < "${PLAN_FILE}"
+
 echo ""
 echo "[INFO] All subjects processed. Generating summary report..."
 
@@ -3,16 +3,34 @@
 Summarize diagnostic results from scan volume checks.
 Generates a pivot table and identifies problematic subjects requiring review.
 
+Reads one scan_volumes_summary.csv (--csv), the latest result of every
+subject from the study diagnostics store (--db, see diagnostics_store.py), or
+a whole cohort of diagnostic CSVs (--aggregate: files, directories or globs,
+streamed through one pass; by default only the newest run of each subject
+found in directories and globs is used, --all-runs keeps every run). Writes diagnostic_summary.txt and a
+machine-readable diagnostic_summary.json.
+
 @Author: Shawn Schwartz - Stanford Memory Lab
 @Date: December 17, 2025
 """
 
 import sys
 import csv
+import re
+import sqlite3
 import argparse
-from collections import defaultdict
+from collections import Counter, defaultdict
+from glob import glob
 from pathlib import Path
 
+import diagnostics_store
+import sidecar_io
+
+
+CSV_NAME = 'scan_volumes_summary.csv'
+REQUIRED_COLUMNS = {'subject_id', 'scan_type', 'run_number', 'status'}
+RUN_DIR_PATTERN = re.compile(r'^(\d{8}_\d{6})_(.+)$')
+
 
 def load_csv(csv_path):
     """Load CSV file and return data as list of dictionaries."""
@@ -25,6 +43,41 @@ def load_csv(csv_path):
         return list(reader)
 
 
+def load_latest(db_path, subject_ids=None):
+    """Latest result rows per subject from the diagnostics store."""
+    db_path = db_path or diagnostics_store.default_store_path()
+    if not db_path or not Path(db_path).exists():
+        print(f"[ERROR] Diagnostics store not found: {db_path}")
+        sys.exit(1)
+    try:
+        with diagnostics_store.open_store(db_path) as store:
+            return store.latest(subject_ids)
+    except (sqlite3.Error, ValueError) as e:
+        print(f"[ERROR] Could not read diagnostics store: {e}")
+        sys.exit(1)
+
+
+def generate_summary_from_store(db_path, output_dir, subject_ids=None):
+    """
+    Generate the summary report from the latest QC run of every subject in
+    the diagnostics store (one indexed query, no CSV globbing). The rows the
+    report is based on are saved next to it as latest_scan_volumes.csv.
+
+    Args:
+        db_path: Diagnostics store path (None = default location)
+        output_dir: Directory to save summary report
+        subject_ids: Optional list of subject IDs to restrict the report to
+    """
+    data = load_latest(db_path, subject_ids)
+    if data:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        with open(Path(output_dir) / 'latest_scan_volumes.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(data[0].keys()), lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(data)
+    write_summary(data, output_dir)
+
+
 def generate_summary(csv_path, output_dir):
     """
     Generate summary report from diagnostic CSV.
@@ -33,12 +86,55 @@ def generate_summary(csv_path, output_dir):
         csv_path: Path to the diagnostic CSV file
         output_dir: Directory to save summary report
     """
-    data = load_csv(csv_path)
-    
-    if not data:
-        print("[WARNING] No data found in CSV file")
-        return
-    
+    write_summary(load_csv(csv_path), output_dir)
+
+
+def iter_csv_rows(csv_paths):
+    """Stream the rows of several diagnostic CSVs, one file open at a time."""
+    for csv_path in csv_paths:
+        with open(csv_path, 'r', newline='') as f:
+            reader = csv.DictReader(f)
+            if not REQUIRED_COLUMNS.issubset(reader.fieldnames or []):
+                print(f"[WARNING] Skipping {csv_path}: not a scan volume diagnostics CSV")
+                continue
+            yield from reader
+
+
+def find_csv_files(sources, all_runs=False):
+    """
+    Resolve files, directories (searched recursively for scan_volumes_summary.csv)
+    and glob patterns to a sorted list of diagnostic CSVs. Of the CSVs found in
+    directories and through globs, only the newest <timestamp>_<subject>
+    directory of each subject is kept unless all_runs is set; CSV files given
+    by name are always used.
+    """
+    named, found = set(), set()
+    for source in sources:
+        if Path(source).is_dir():
+            found.update(str(p) for p in Path(source).rglob(CSV_NAME))
+        elif Path(source).is_file():
+            named.add(source)
+        else:
+            found.update(p for p in glob(source, recursive=True) if Path(p).is_file())
+    if not all_runs:
+        newest = {}
+        for csv_path in sorted(found):
+            match = RUN_DIR_PATTERN.match(Path(csv_path).parent.name)
+            key = match.group(2) if match else csv_path
+            stamp = match.group(1) if match else ''
+            if key not in newest or stamp >= newest[key][0]:
+                newest[key] = (stamp, csv_path)
+        found = {csv_path for _, csv_path in newest.values()}
+    return sorted(named | found)
+
+
+def aggregate_rows(rows):
+    """
+    Single pass over result rows (any iterable, e.g. a stream of CSV rows).
+    Memory grows with subjects, error cells and issues, not with rows read.
+    Returns (subject_stats, issue_types, error_pivot) where error_pivot maps
+    (subject_id, scan_type, run_number) to its number of ERROR rows.
+    """
     # Track statistics by subject
     subject_stats = defaultdict(lambda: {
         'total_checks': 0,
@@ -49,9 +145,10 @@ def generate_summary(csv_path, output_dir):
     
     # Track issues by type
     issue_types = defaultdict(int)
+    error_pivot = Counter()
     
     # Process each row
-    for row in data:
+    for row in rows:
         subject_id = row.get('subject_id', 'UNKNOWN')
         status = row.get('status', 'UNKNOWN')
         scan_type = row.get('scan_type', 'UNKNOWN')
@@ -66,9 +163,86 @@ def generate_summary(csv_path, output_dir):
             issue_detail = f"{scan_type} run-{run_number}: expected {expected_volumes}, got {actual_volumes}"
             subject_stats[subject_id]['issues'].append(issue_detail)
             issue_types[scan_type] += 1
+            error_pivot[(subject_id, scan_type, run_number)] += 1
         elif status == 'OK':
             subject_stats[subject_id]['ok'] += 1
+
+    return subject_stats, issue_types, error_pivot
+
+
+def generate_aggregate_summary(sources, output_dir, all_runs=False):
+    """
+    Generate one report for the whole cohort from many diagnostic CSVs
+    (files, directories or glob patterns), streamed through a single pass.
     
+    Args:
+        sources: CSV files, diagnostics directories or glob patterns
+        output_dir: Directory to save summary report
+        all_runs: Use every diagnostics directory found, not just each
+            subject's newest one (history view)
+    """
+    csv_paths = find_csv_files(sources, all_runs)
+    if not csv_paths:
+        print(f"[ERROR] No diagnostic CSV files found in: {', '.join(sources)}")
+        sys.exit(1)
+    print(f"[INFO] Aggregating {len(csv_paths)} diagnostic CSV file(s)")
+    subject_stats, issue_types, error_pivot = aggregate_rows(iter_csv_rows(csv_paths))
+    write_report(subject_stats, issue_types, error_pivot, output_dir, sources=csv_paths, pivot=True)
+
+
+def write_summary(data, output_dir):
+    """
+    Write diagnostic_summary.txt/.json for a list of result rows (dicts with
+    the scan_volumes_summary.csv columns).
+    """
+    if not data:
+        print("[WARNING] No data found in CSV file")
+        return
+    subject_stats, issue_types, error_pivot = aggregate_rows(data)
+    write_report(subject_stats, issue_types, error_pivot, output_dir)
+
+
+def write_pivot(f, error_pivot):
+    """Error counts as a subject x scan_type/run table (only cells with errors)."""
+    columns = sorted({(scan_type, run) for _, scan_type, run in error_pivot})
+    subjects = sorted({subject_id for subject_id, _, _ in error_pivot})
+    labels = [f"{scan_type} run-{run}" for scan_type, run in columns]
+    width = max([len('Subject')] + [len(s) for s in subjects])
+    f.write("ERROR COUNTS BY SUBJECT / SCAN TYPE / RUN\n")
+    f.write("-" * 80 + "\n")
+    f.write(f"{'Subject':{width}s}  " + "  ".join(labels) + "\n")
+    for subject_id in subjects:
+        cells = [f"{error_pivot.get((subject_id, scan_type, run), 0) or '.':>{len(label)}}"
+                 for (scan_type, run), label in zip(columns, labels)]
+        f.write(f"{subject_id:{width}s}  " + "  ".join(cells) + "\n")
+    f.write("\n")
+
+
+def write_json(output_path, subject_stats, issue_types, error_pivot, sources=None):
+    """Machine-readable counterpart of diagnostic_summary.txt."""
+    total_checks = sum(s['total_checks'] for s in subject_stats.values())
+    total_ok = sum(s['ok'] for s in subject_stats.values())
+    pivot = defaultdict(lambda: defaultdict(dict))
+    for (subject_id, scan_type, run), count in sorted(error_pivot.items()):
+        pivot[subject_id][scan_type][run] = count
+    summary = {
+        'total_subjects': len(subject_stats),
+        'total_checks': total_checks,
+        'checks_ok': total_ok,
+        'checks_error': sum(s['errors'] for s in subject_stats.values()),
+        'success_rate': round(total_ok / total_checks * 100, 1) if total_checks else None,
+        'errors_by_scan_type': dict(sorted(issue_types.items())),
+        'problematic_subjects': sorted(sid for sid, s in subject_stats.items() if s['errors'] > 0),
+        'subjects': {sid: subject_stats[sid] for sid in sorted(subject_stats)},
+        'error_pivot': pivot,
+    }
+    if sources is not None:
+        summary['sources'] = list(sources)
+    sidecar_io.write_json(output_path, summary)
+
+
+def write_report(subject_stats, issue_types, error_pivot, output_dir, sources=None, pivot=False):
+    """Write diagnostic_summary.txt and diagnostic_summary.json and print a short summary."""
     # Generate summary report
     output_path = Path(output_dir) / 'diagnostic_summary.txt'
     
@@ -108,6 +282,9 @@ def generate_summary(csv_path, output_dir):
                 f.write(f"{scan_type:20s}: {count} errors\n")
             f.write("\n")
         
+        if pivot and error_pivot:
+            write_pivot(f, error_pivot)
+        
         # Problematic subjects
         problematic_subjects = {
             sid: stats for sid, stats in subject_stats.items() 
@@ -149,10 +326,14 @@ def generate_summary(csv_path, output_dir):
         f.write("END OF SUMMARY REPORT\n")
         f.write("=" * 80 + "\n")
     
+    json_path = Path(output_dir) / 'diagnostic_summary.json'
+    write_json(json_path, subject_stats, issue_types, error_pivot, sources)
+    
     print(f"\n{'=' * 80}")
     print("SUMMARY REPORT GENERATED")
     print(f"{'=' * 80}")
     print(f"Report saved to: {output_path}")
+    print(f"JSON saved to:   {json_path}")
     print(f"\nQuick Summary:")
     print(f"  - {len(problematic_subjects)} subject(s) need review")
     print(f"  - {len(clean_subjects)} subject(s) passed all checks")
@@ -165,11 +346,35 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Generate summary report from diagnostic scan volume checks"
     )
-    parser.add_argument(
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
         "--csv",
-        required=True,
         help="Path to the diagnostic CSV file"
     )
+    source.add_argument(
+        "--db",
+        nargs="?",
+        const="",
+        help="Report the latest result per subject from the diagnostics store "
+             "(default location: $DIAGNOSTICS_DB or $SLURM_LOG_DIR/diagnostics/diagnostics.sqlite)"
+    )
+    source.add_argument(
+        "--aggregate",
+        nargs="+",
+        metavar="SOURCE",
+        help="Summarize many diagnostic CSVs at once: CSV files, diagnostics directories "
+             "(searched for scan_volumes_summary.csv) or glob patterns"
+    )
+    parser.add_argument(
+        "--all-runs",
+        action="store_true",
+        help="With --aggregate, use every <timestamp>_<subject> directory found instead of only "
+             "the newest one of each subject (history of all runs)"
+    )
+    parser.add_argument(
+        "--subjects",
+        help="Comma-separated subject IDs to include (with --db; default: all)"
+    )
     parser.add_argument(
         "--output-dir",
         required=True,
@@ -178,4 +383,10 @@ if __name__ == "__main__":
     
     args = parser.parse_args()
     
-    generate_summary(args.csv, args.output_dir)
+    if args.csv:
+        generate_summary(args.csv, args.output_dir)
+    elif args.aggregate:
+        generate_aggregate_summary(args.aggregate, args.output_dir, args.all_runs)
+    else:
+        subject_ids = [s.strip() for s in args.subjects.split(",")] if args.subjects else None
+        generate_summary_from_store(args.db or None, args.output_dir, subject_ids)
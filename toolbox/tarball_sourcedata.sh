@@ -13,6 +13,12 @@
 # Primary goal: Reduce inode utilization on headless supercompute environments
 # by archiving sourcedata directories into single tar files.
 #
+# Archives are created by sourcedata_tarball.py, which tars several subjects
+# at once (--jobs), can gzip-compress on multiple threads (--compress gzip,
+# --level, --threads), and writes a sub-XXX.tar[.gz].index.json next to each
+# archive with the offset and size of every member. --extract-subjects uses
+# that index to restore only selected members (--members) by seeking to them.
+#
 # ============================================================================
 # USAGE
 # ============================================================================
@@ -23,15 +29,22 @@
 # Untar operations:
 #   ./tarball_sourcedata.sh --untar-all [--sourcedata-dir PATH]
 #   ./tarball_sourcedata.sh --untar-subjects SUBJECT_LIST [--sourcedata-dir PATH]
+#   ./tarball_sourcedata.sh --extract-subjects SUBJECT_LIST --members PATTERNS [--sourcedata-dir PATH]
 #
 # Arguments:
 #   --tar-all              Tarball all subject directories found in sourcedata
 #   --tar-subjects LIST    Tarball specific subjects (comma-separated or file path)
 #   --untar-all            Extract all tar files found in sourcedata
 #   --untar-subjects LIST  Extract specific subject tar files (comma-separated or file path)
+#   --extract-subjects LIST  Extract only --members of specific subjects' tar files
+#   --members PATTERNS     Comma-separated paths/globs relative to sub-XXX/ (e.g. "anat/,func/*run-01*")
 #   --sourcedata-dir PATH  Path to sourcedata directory (default: current directory)
 #   --output-dir PATH      Path to store tar files (default: sourcedata directory)
 #   --keep-original        Keep original directory after tarballing (default: remove)
+#   --jobs N               Subjects tarballed concurrently (default: 4)
+#   --compress TYPE        none (sub-XXX.tar) or gzip (sub-XXX.tar.gz) (default: none)
+#   --level N              gzip compression level 1-9 (default: 6)
+#   --threads N            Compression threads per archive (default: CPUs / jobs)
 #   --help, -h             Show this help message
 #
 # Examples:
@@ -45,6 +58,9 @@
 #   # Tarball subjects with custom sourcedata directory
 #   ./tarball_sourcedata.sh --tar-all --sourcedata-dir /path/to/project/sourcedata
 #
+#   # Tarball 8 subjects at a time with multithreaded gzip compression
+#   ./tarball_sourcedata.sh --tar-all --jobs 8 --compress gzip --level 3
+#
 #   # Untar all subjects
 #   ./tarball_sourcedata.sh --untar-all
 #
@@ -52,6 +68,9 @@
 #   ./tarball_sourcedata.sh --untar-subjects "001,002"
 #   ./tarball_sourcedata.sh --untar-subjects subjects.txt
 #
+#   # Restore only the anatomicals and run 1 of two subjects
+#   ./tarball_sourcedata.sh --extract-subjects "001,002" --members "anat/,func/*run-01*"
+#
 # ============================================================================
 
 # Color codes for output
@@ -67,6 +86,13 @@ OUTPUT_DIR=""
 KEEP_ORIGINAL=false
 OPERATION=""
 SUBJECT_LIST=""
+MEMBERS=""
+JOBS=4
+COMPRESS="none"
+LEVEL=6
+THREADS=0
+
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 
 # ============================================================================
 # FUNCTION: print_usage
@@ -88,15 +114,23 @@ USAGE:
   Untar operations:
     $0 --untar-all [OPTIONS]
     $0 --untar-subjects SUBJECT_LIST [OPTIONS]
+    $0 --extract-subjects SUBJECT_LIST --members PATTERNS [OPTIONS]
 
 ARGUMENTS:
   --tar-all              Tarball all subject directories in sourcedata
   --tar-subjects LIST    Tarball specific subjects (comma-separated or file path)
   --untar-all            Extract all tar files in sourcedata
   --untar-subjects LIST  Extract specific subject tar files (comma-separated or file path)
+  --extract-subjects LIST  Extract only --members of specific subjects' tar files, using the
+                         archive index to seek to them instead of reading the whole archive
+  --members PATTERNS     Comma-separated paths/globs relative to sub-XXX/ (e.g. "anat/,func/*run-01*")
   --sourcedata-dir PATH  Path to sourcedata directory (default: current directory)
   --output-dir PATH      Path to store tar files (default: sourcedata directory)
   --keep-original        Keep original directory after tarballing (default: remove)
+  --jobs N               Subjects tarballed concurrently (default: 4)
+  --compress TYPE        none (sub-XXX.tar) or gzip (sub-XXX.tar.gz) (default: none)
+  --level N              gzip compression level 1-9 (default: 6)
+  --threads N            Compression threads per archive (default: CPUs / jobs)
   --help, -h             Show this help message
 
 EXAMPLES:
@@ -115,12 +149,18 @@ EXAMPLES:
   # Tarball but keep original directories
   $0 --tar-all --keep-original
 
+  # Tarball 8 subjects at a time with multithreaded gzip compression
+  $0 --tar-all --jobs 8 --compress gzip --level 3
+
   # Untar all subjects
   $0 --untar-all
 
   # Untar specific subjects
   $0 --untar-subjects "001,002"
 
+  # Restore only the anatomicals and run 1 of two subjects
+  $0 --extract-subjects "001,002" --members "anat/,func/*run-01*"
+
 EOF
 }
 
@@ -198,59 +238,20 @@ get_all_subjects() {
 }
 
 # ============================================================================
-# FUNCTION: tarball_subject
+# FUNCTION: find_tar_file
 # ============================================================================
-tarball_subject() {
+find_tar_file() {
   local subject_id=$1
-  local sourcedata_dir=$2
-  local output_dir=$3
-  local keep_original=$4
-  
-  local subject_dir="${sourcedata_dir}/sub-${subject_id}"
-  local tar_file="${output_dir}/sub-${subject_id}.tar"
-  
-  # Check if subject directory exists
-  if [ ! -d "$subject_dir" ]; then
-    log_message "ERROR" "Subject directory not found: $subject_dir"
-    return 1
-  fi
-  
-  # Check if tar file already exists
-  if [ -f "$tar_file" ]; then
-    log_message "WARNING" "Tar file already exists: $tar_file (skipping)"
-    return 0
-  fi
-  
-  log_message "INFO" "Creating tarball for sub-${subject_id}..."
-  
-  # Create tar file
-  # Use -C to change directory so tar doesn't include full path
-  local tar_stderr=$(mktemp)
-  if tar -cf "$tar_file" -C "$sourcedata_dir" "sub-${subject_id}" 2>"$tar_stderr"; then
-    rm -f "$tar_stderr"
-    local tar_size=$(du -h "$tar_file" | cut -f1)
-    log_message "SUCCESS" "Created tarball: $tar_file (${tar_size})"
-    
-    # Remove original directory if requested
-    if [ "$keep_original" = false ]; then
-      log_message "INFO" "Removing original directory: $subject_dir"
-      if rm -rf "$subject_dir"; then
-        log_message "SUCCESS" "Removed original directory: $subject_dir"
-      else
-        log_message "ERROR" "Failed to remove directory: $subject_dir"
-        return 1
-      fi
-    fi
-    
-    return 0
-  else
-    log_message "ERROR" "Failed to create tarball for sub-${subject_id}"
-    if [ -s "$tar_stderr" ]; then
-      log_message "ERROR" "Tar error: $(cat "$tar_stderr")"
+  local tar_dir=$2
+
+  # Plain archives from earlier runs, or gzip archives from --compress gzip
+  for candidate in "${tar_dir}/sub-${subject_id}.tar" "${tar_dir}/sub-${subject_id}.tar.gz"; do
+    if [ -f "$candidate" ]; then
+      echo "$candidate"
+      return 0
     fi
-    rm -f "$tar_stderr"
-    return 1
-  fi
+  done
+  return 1
 }
 
 # ============================================================================
@@ -262,11 +263,11 @@ untar_subject() {
   local tar_dir=$3
   
   local subject_dir="${sourcedata_dir}/sub-${subject_id}"
-  local tar_file="${tar_dir}/sub-${subject_id}.tar"
+  local tar_file
   
   # Check if tar file exists
-  if [ ! -f "$tar_file" ]; then
-    log_message "ERROR" "Tar file not found: $tar_file"
+  if ! tar_file=$(find_tar_file "$subject_id" "$tar_dir"); then
+    log_message "ERROR" "Tar file not found: ${tar_dir}/sub-${subject_id}.tar[.gz]"
     return 1
   fi
   
@@ -308,35 +309,20 @@ untar_subject() {
 # ============================================================================
 tarball_subjects() {
   local subjects=("$@")
-  local total=${#subjects[@]}
-  local success=0
-  local failed=0
-  local skipped=0
-  
-  log_message "INFO" "Starting tarball operation for ${total} subject(s)..."
-  
-  for subject in "${subjects[@]}"; do
-    if tarball_subject "$subject" "$SOURCEDATA_DIR" "$OUTPUT_DIR" "$KEEP_ORIGINAL"; then
-      ((success++))
-    else
-      # Check if it was skipped (tar already exists)
-      if [ -f "${OUTPUT_DIR}/sub-${subject}.tar" ]; then
-        ((skipped++))
-      else
-        ((failed++))
-      fi
-    fi
-  done
-  
-  log_message "INFO" "=========================================="
-  log_message "INFO" "Tarball operation complete!"
-  log_message "INFO" "Total subjects: ${total}"
-  log_message "SUCCESS" "Successfully tarballed: ${success}"
-  [ $skipped -gt 0 ] && log_message "WARNING" "Skipped (already exists): ${skipped}"
-  [ $failed -gt 0 ] && log_message "ERROR" "Failed: ${failed}"
-  log_message "INFO" "=========================================="
-  
-  return $failed
+  local keep_flag=""
+  [ "$KEEP_ORIGINAL" = true ] && keep_flag="--keep-original"
+
+  # sourcedata_tarball.py logs each subject and the summary in the same format,
+  # and exits with the number of failed subjects
+  python3 "${SCRIPT_DIR}/sourcedata_tarball.py" create \
+    --sourcedata-dir "$SOURCEDATA_DIR" \
+    --output-dir "$OUTPUT_DIR" \
+    --subjects "${subjects[@]}" \
+    --jobs "$JOBS" \
+    --compress "$COMPRESS" \
+    --level "$LEVEL" \
+    --threads "$THREADS" \
+    $keep_flag
 }
 
 # ============================================================================
@@ -375,6 +361,22 @@ untar_subjects() {
   return $failed
 }
 
+# ============================================================================
+# FUNCTION: extract_subjects
+# ============================================================================
+extract_subjects() {
+  local subjects=("$@")
+  local members=()
+  IFS=',' read -ra members <<< "$MEMBERS"
+
+  log_message "INFO" "Extracting ${MEMBERS} for ${#subjects[@]} subject(s)..."
+  python3 "${SCRIPT_DIR}/sourcedata_tarball.py" extract \
+    --archive-dir "$OUTPUT_DIR" \
+    --dest-dir "$SOURCEDATA_DIR" \
+    --subjects "${subjects[@]}" \
+    --members "${members[@]}"
+}
+
 # ============================================================================
 # MAIN SCRIPT
 # ============================================================================
@@ -400,6 +402,15 @@ while [[ $# -gt 0 ]]; do
       SUBJECT_LIST="$2"
       shift 2
       ;;
+    --extract-subjects)
+      OPERATION="extract-subjects"
+      SUBJECT_LIST="$2"
+      shift 2
+      ;;
+    --members)
+      MEMBERS="$2"
+      shift 2
+      ;;
     --sourcedata-dir)
       SOURCEDATA_DIR="$2"
       shift 2
@@ -412,6 +423,22 @@ while [[ $# -gt 0 ]]; do
       KEEP_ORIGINAL=true
       shift
       ;;
+    --jobs)
+      JOBS="$2"
+      shift 2
+      ;;
+    --compress)
+      COMPRESS="$2"
+      shift 2
+      ;;
+    --level)
+      LEVEL="$2"
+      shift 2
+      ;;
+    --threads)
+      THREADS="$2"
+      shift 2
+      ;;
     --help|-h)
       print_usage
       exit 0
@@ -426,7 +453,7 @@ done
 
 # Validate operation is specified
 if [ -z "$OPERATION" ]; then
-  log_message "ERROR" "No operation specified. Use --tar-all, --tar-subjects, --untar-all, or --untar-subjects"
+  log_message "ERROR" "No operation specified. Use --tar-all, --tar-subjects, --untar-all, --untar-subjects, or --extract-subjects"
   print_usage
   exit 1
 fi
@@ -486,10 +513,10 @@ case $OPERATION in
   untar-all)
     # Find all tar files in output directory
     subjects=()
-    for tar_file in "$OUTPUT_DIR"/sub-*.tar; do
+    for tar_file in "$OUTPUT_DIR"/sub-*.tar "$OUTPUT_DIR"/sub-*.tar.gz; do
       if [ -f "$tar_file" ]; then
         # Extract subject ID from tar filename
-        subj=$(basename "$tar_file" .tar | sed 's/^sub-//')
+        subj=$(basename "$tar_file" | sed 's/\.tar\(\.gz\)\?$//;s/^sub-//')
         subjects+=("$subj")
       fi
     done
@@ -516,4 +543,18 @@ case $OPERATION in
     untar_subjects "${subjects[@]}"
     exit $?
     ;;
+  
+  extract-subjects)
+    if [ -z "$SUBJECT_LIST" ] || [ -z "$MEMBERS" ]; then
+      log_message "ERROR" "--extract-subjects requires a subject list and --members"
+      exit 1
+    fi
+    subjects=($(parse_subject_list "$SUBJECT_LIST"))
+    if [ ${#subjects[@]} -eq 0 ]; then
+      log_message "ERROR" "No subjects found in list: $SUBJECT_LIST"
+      exit 1
+    fi
+    extract_subjects "${subjects[@]}"
+    exit $?
+    ;;
 esac
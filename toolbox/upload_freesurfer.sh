@@ -14,6 +14,7 @@ NC='\033[0m' # No Color
 # Source configuration
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 SKIP_SUBJECTS_PROMPT=true source "${SCRIPT_DIR}/../load_config.sh"
+source "${SCRIPT_DIR}/freesurfer_sync.sh"
 
 echo -e "${BLUE}╔═══════════════════════════════════════════════════════════════╗${NC}"
 echo -e "${BLUE}║     Freesurfer Edited Output Upload Utility                   ║${NC}"
@@ -30,6 +31,7 @@ LOCAL_FREESURFER_DIR="${LOCAL_FREESURFER_DIR/#\~/$HOME}"
 SUBJECTS_LIST="${FREESURFER_EDITING_SUBJECTS_LIST:-}"
 UPLOAD_ALL="${FREESURFER_EDITING_UPLOAD_ALL:-false}"
 BACKUP_ORIGINALS="${FREESURFER_EDITING_BACKUP_ORIGINALS:-true}"
+FS_SYNC_JOBS="${FREESURFER_EDITING_SYNC_JOBS:-4}"
 
 # Parse command line arguments
 while [[ $# -gt 0 ]]; do
@@ -54,6 +56,10 @@ while [[ $# -gt 0 ]]; do
             SUBJECTS_LIST="$2"
             shift 2
             ;;
+        --jobs)
+            FS_SYNC_JOBS="$2"
+            shift 2
+            ;;
         --all)
             UPLOAD_ALL=true
             shift
@@ -72,7 +78,8 @@ while [[ $# -gt 0 ]]; do
             echo "  --local-dir <path>         Local directory with edited Freesurfer outputs (default: ~/freesurfer_edits)"
             echo "  --subjects <file|list>     Subject list file or comma-separated subject IDs"
             echo "  --all                      Upload all subjects in local directory"
-            echo "  --no-backup                Don't create backup of original Freesurfer outputs on server"
+            echo "  --no-backup                Don't back up the server files that the upload overwrites"
+            echo "  --jobs <n>                 Subjects uploaded in parallel (default: 4)"
             echo "  -h, --help                 Show this help message"
             echo ""
             echo "Interactive mode (no arguments):"
@@ -130,10 +137,18 @@ REMOTE_FREESURFER_DIR="${REMOTE_BASE_DIR}/freesurfer"
 # Escape path for safe use in remote shell
 ESCAPED_REMOTE_FREESURFER_DIR=$(printf '%q' "$REMOTE_FREESURFER_DIR")
 
-# Check if remote directory exists
+# Open the shared SSH connection (used by every ssh/rsync call below)
 echo ""
+echo -e "${BLUE}Connecting to ${REMOTE_SERVER}...${NC}"
+if ! fs_sync_connect "${REMOTE_USER}@${REMOTE_SERVER}"; then
+    echo -e "${RED}Error: Could not connect to ${REMOTE_USER}@${REMOTE_SERVER}${NC}"
+    exit 1
+fi
+trap 'fs_sync_disconnect "${REMOTE_USER}@${REMOTE_SERVER}"' EXIT
+
+# Check if remote directory exists
 echo -e "${BLUE}Checking remote Freesurfer directory...${NC}"
-if ! ssh "${REMOTE_USER}@${REMOTE_SERVER}" "[ -d '${ESCAPED_REMOTE_FREESURFER_DIR}' ]"; then
+if ! ssh ${FS_SSH_OPTS} "${REMOTE_USER}@${REMOTE_SERVER}" "[ -d '${ESCAPED_REMOTE_FREESURFER_DIR}' ]"; then
     echo -e "${RED}Error: Remote Freesurfer directory does not exist: ${REMOTE_FREESURFER_DIR}${NC}"
     exit 1
 fi
@@ -217,8 +232,8 @@ SUBJECTS="$VERIFIED_SUBJECTS"
 # Backup confirmation
 echo ""
 if [ "$BACKUP_ORIGINALS" = true ]; then
-    echo -e "${YELLOW}Original Freesurfer outputs will be backed up on the server${NC}"
-    echo -e "${BLUE}Backups will be created as: {subject}.backup.$(date +%Y%m%d_%H%M%S)${NC}"
+    echo -e "${YELLOW}Server files overwritten by the upload will be backed up on the server${NC}"
+    echo -e "${BLUE}Backups will be created as: {subject}.backup.$(date +%Y%m%d_%H%M%S) (only the overwritten files)${NC}"
 else
     echo -e "${RED}Warning: --no-backup flag set - originals will be overwritten without backup${NC}"
     read -p "Are you sure you want to proceed without backups? (y/N) " -n 1 -r
@@ -237,7 +252,7 @@ echo -e "${YELLOW}════════════════════
 echo ""
 echo -e "  Local source:  ${LOCAL_FREESURFER_DIR}"
 echo -e "  Remote target: ${REMOTE_USER}@${REMOTE_SERVER}:${REMOTE_FREESURFER_DIR}"
-echo -e "  Subjects:      $(echo $SUBJECTS | wc -w) subjects"
+echo -e "  Subjects:      $(echo $SUBJECTS | wc -w) subjects (${FS_SYNC_JOBS} at a time)"
 echo -e "  Backup:        $([[ "$BACKUP_ORIGINALS" = true ]] && echo 'Yes' || echo 'No')"
 echo ""
 echo -e "${RED}This will replace existing Freesurfer outputs on the server!${NC}"
@@ -255,50 +270,31 @@ echo ""
 echo -e "${GREEN}Starting upload...${NC}"
 echo ""
 
-SUCCESS_COUNT=0
-FAIL_COUNT=0
-FAILED_SUBJECTS=""
 BACKUP_TIMESTAMP=$(date +%Y%m%d_%H%M%S)
 
-for subject in $SUBJECTS; do
-    echo -e "${BLUE}Uploading ${subject}...${NC}"
-
-    # Create backup on server if requested
+# rsync's --backup-dir receives only the files this upload overwrites (with their
+# relative paths), so unchanged files are never copied
+upload_subject() {
+    local subject=$1
+    local backup_opts=()
     if [ "$BACKUP_ORIGINALS" = true ]; then
-        echo "  Creating backup of original..."
-        # Escape variables for safe remote execution
-        ESCAPED_REMOTE_DIR=$(printf '%q' "$REMOTE_FREESURFER_DIR")
-        ESCAPED_SUBJECT=$(printf '%q' "$subject")
-        ESCAPED_TIMESTAMP=$(printf '%q' "$BACKUP_TIMESTAMP")
-        if ssh "${REMOTE_USER}@${REMOTE_SERVER}" "
-            if [ -d ${ESCAPED_REMOTE_DIR}/${ESCAPED_SUBJECT} ]; then
-                cp -r ${ESCAPED_REMOTE_DIR}/${ESCAPED_SUBJECT} ${ESCAPED_REMOTE_DIR}/${ESCAPED_SUBJECT}.backup.${ESCAPED_TIMESTAMP}
-                echo '  ✓ Backup created'
-            else
-                echo '  ℹ No existing directory to backup'
-            fi
-        "; then
-            echo -e "${GREEN}  ✓ Backup completed${NC}"
-        else
-            echo -e "${YELLOW}  ! Backup failed, but continuing...${NC}"
-        fi
+        backup_opts=(--backup "--backup-dir=$(fs_sync_remote_path "${REMOTE_FREESURFER_DIR}/${subject}.backup.${BACKUP_TIMESTAMP}")")
     fi
-
-    # Upload edited Freesurfer directory using rsync
-    echo "  Uploading edited surfaces..."
-    if rsync -avz --progress \
+    fs_sync_subject "$subject" \
         "${LOCAL_FREESURFER_DIR}/${subject}/" \
-        "${REMOTE_USER}@${REMOTE_SERVER}:'${REMOTE_FREESURFER_DIR}/${subject}/'"; then
+        "${REMOTE_USER}@${REMOTE_SERVER}:$(fs_sync_remote_path "${REMOTE_FREESURFER_DIR}/${subject}/")" \
+        ${backup_opts[@]+"${backup_opts[@]}"}
+}
 
-        echo -e "${GREEN}✓ ${subject} uploaded successfully${NC}"
-        ((SUCCESS_COUNT++))
-    else
-        echo -e "${RED}✗ Failed to upload ${subject}${NC}"
-        FAILED_SUBJECTS="${FAILED_SUBJECTS}\n  - ${subject}"
-        ((FAIL_COUNT++))
-    fi
-    echo ""
+fs_sync_parallel upload_subject $SUBJECTS
+echo ""
+fs_sync_report "overwritten files backed up" $SUBJECTS
+for subject in $SUBJECTS; do
+    fs_sync_added "$subject"
 done
+SUCCESS_COUNT=$FS_SYNC_SUCCESS
+FAIL_COUNT=$FS_SYNC_FAILED
+FAILED_SUBJECTS=$FS_SYNC_FAILED_SUBJECTS
 
 # Summary
 echo ""
@@ -313,8 +309,8 @@ if [ $FAIL_COUNT -gt 0 ]; then
 fi
 echo ""
 if [ "$BACKUP_ORIGINALS" = true ]; then
-    echo -e "${BLUE}Original Freesurfer outputs backed up on server as:${NC}"
-    echo -e "  {subject}.backup.${BACKUP_TIMESTAMP}"
+    echo -e "${BLUE}Overwritten server files backed up as:${NC}"
+    echo -e "  {subject}.backup.${BACKUP_TIMESTAMP} (subjects with no overwritten files have no backup)"
     echo ""
 fi
 echo -e "${YELLOW}Next steps:${NC}"
@@ -325,10 +321,15 @@ echo "2. fMRIPrep will automatically use the edited Freesurfer outputs"
 echo "   instead of rerunning Freesurfer reconstruction"
 echo ""
 echo -e "${BLUE}Note: To revert to original surfaces (if backups were created):${NC}"
+echo "  Restoring a backup only puts back the files this upload overwrote; files it added"
+echo "  (listed per subject in ${FS_SYNC_LOG_DIR}/{subject}.added) must be removed as well."
 shown_count=0
 for subject in $SUBJECTS; do
     if [ "$BACKUP_ORIGINALS" = true ]; then
-        echo "  ssh ${REMOTE_USER}@${REMOTE_SERVER} \"rm -rf ${REMOTE_FREESURFER_DIR}/${subject} && mv ${REMOTE_FREESURFER_DIR}/${subject}.backup.${BACKUP_TIMESTAMP} ${REMOTE_FREESURFER_DIR}/${subject}\""
+        echo "  ssh ${REMOTE_USER}@${REMOTE_SERVER} \"cp -a '${REMOTE_FREESURFER_DIR}/${subject}.backup.${BACKUP_TIMESTAMP}/.' '${REMOTE_FREESURFER_DIR}/${subject}/'\""
+        if [ -s "${FS_SYNC_LOG_DIR}/${subject}.added" ]; then
+            echo "  tr '\\n' '\\0' < ${FS_SYNC_LOG_DIR}/${subject}.added | ssh ${REMOTE_USER}@${REMOTE_SERVER} \"cd '${REMOTE_FREESURFER_DIR}/${subject}' && xargs -0 rm -f --\""
+        fi
         shown_count=$((shown_count + 1))
         if [ "$shown_count" -ge 3 ]; then
             break
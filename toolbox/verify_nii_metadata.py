@@ -7,6 +7,9 @@ from glob import glob
 import argparse
 import yaml
 
+import nifti_index
+import series_table
+
 def load_config(config_path):
     """Load scan config JSON file."""
     with open(config_path, "r") as f:
@@ -18,18 +21,8 @@ def load_project_config(config_path):
         return yaml.safe_load(f)
 
 def get_expected_series_map(config):
-    mapping = {}
-    for seq_type, props in config["default_sequences"].items():
-        for sn in props["series_numbers"]:
-            mapping[sn] = {
-                "sequence_type": seq_type,
-                "description": props.get("description", ""),
-                "series_description_pattern": props.get("series_description_pattern"),
-                "filename_template": props.get("filename_template"),
-                "series_description": props.get("series_description"),
-                "required": props.get("required", False)
-            }
-    return mapping
+    """SeriesNumber -> expected properties, from the compiled scan-config.json series table."""
+    return series_table.compile_table(config).expected_series_map()
 
 def collect_bids_files(subject_dir, task_name, bids_dir_type):
     files = []
@@ -60,101 +53,121 @@ def collect_bids_files(subject_dir, task_name, bids_dir_type):
 
     return files
 
-def run_qc(subject_dir, task_name, config_path, output_csv, bids_dir_type, subid):
-    config = load_config(config_path)
-    expected_by_series_number = get_expected_series_map(config)
+def run_qc(subject_dir, task_name, config_path, output_csv, bids_dir_type, subid, index=None,
+           expected_by_series_number=None):
+    """
+    Check every BOLD/fieldmap sidecar of one subject directory against the
+    scan config and write output_csv. expected_by_series_number can be passed
+    in when checking many subjects, so the scan config is compiled once.
+    Returns the rows written.
+    """
+    owns_index = index is None
+    if owns_index:
+        index = nifti_index.open_index()
+    if expected_by_series_number is None:
+        expected_by_series_number = get_expected_series_map(load_config(config_path))
     records = []
 
-    bids_files = collect_bids_files(subject_dir, task_name, bids_dir_type)
-
-    for nii_path in bids_files:
-        base = os.path.basename(nii_path).replace(".nii.gz", "")
-        json_path = os.path.join(os.path.dirname(nii_path), base + ".json")
-
-        row = {
-            "SubjectId": subid,
-            "BidsDirType": bids_dir_type,
-            "RootPath": subject_dir,
-            "Filename": base,
-            "SeriesNumber": None,
-            "SeriesDescription": None,
-            "MatchedSequence": "FAIL",
-            "SequenceType": "",
-            "ExpectedSeriesNumber": "",
-            "ExpectedSeriesDescription": "",
-            "Match": "FAIL",
-            "RunFromDescription": "",
-            "RunMatchToFilename": "N/A"
-        }
-
-        if not os.path.exists(json_path):
-            row["SeriesDescription"] = "Missing JSON"
-            records.append(row)
-            continue
+    try:
+        bids_files = collect_bids_files(subject_dir, task_name, bids_dir_type)
+
+        for nii_path in bids_files:
+            base = os.path.basename(nii_path).replace(".nii.gz", "")
+            json_path = os.path.join(os.path.dirname(nii_path), base + ".json")
+
+            row = {
+                "SubjectId": subid,
+                "BidsDirType": bids_dir_type,
+                "RootPath": subject_dir,
+                "Filename": base,
+                "SeriesNumber": None,
+                "SeriesDescription": None,
+                "MatchedSequence": "FAIL",
+                "SequenceType": "",
+                "ExpectedSeriesNumber": "",
+                "ExpectedSeriesDescription": "",
+                "Match": "FAIL",
+                "RunFromDescription": "",
+                "RunMatchToFilename": "N/A"
+            }
 
-        with open(json_path, "r") as f:
-            metadata = json.load(f)
+            if not os.path.exists(json_path):
+                row["SeriesDescription"] = "Missing JSON"
+                records.append(row)
+                continue
 
-        series_number = metadata.get("SeriesNumber")
-        desc = metadata.get("SeriesDescription")
+            try:
+                metadata = index.sidecar(json_path)
+            except (OSError, ValueError) as e:
+                # a truncated or unreadable sidecar fails this file, not the whole run
+                print(f"⚠️  Could not read {json_path}: {e}")
+                row["SeriesDescription"] = "Invalid JSON"
+                records.append(row)
+                continue
 
-        row["SeriesNumber"] = series_number
-        row["SeriesDescription"] = desc
+            series_number = metadata.get("SeriesNumber")
+            desc = metadata.get("SeriesDescription")
 
-        expected = expected_by_series_number.get(series_number)
+            row["SeriesNumber"] = series_number
+            row["SeriesDescription"] = desc
 
-        if expected:
-            row["MatchedSequence"] = "PASS"
-            row["SequenceType"] = expected["sequence_type"]
-            row["ExpectedSeriesNumber"] = series_number
-            row["ExpectedSeriesDescription"] = expected.get("series_description", "")
+            expected = expected_by_series_number.get(series_number)
 
-            pattern = expected.get("series_description_pattern")
-            template = expected.get("filename_template")
+            if expected:
+                row["MatchedSequence"] = "PASS"
+                row["SequenceType"] = expected["sequence_type"]
+                row["ExpectedSeriesNumber"] = series_number
+                row["ExpectedSeriesDescription"] = expected.get("series_description", "")
 
-            if pattern:
-                match = re.search(pattern, desc or "")
-            else:
-                # fallback to filename-based run extraction for fmap files
-                match = re.search(r"run-(?P<run>\d{2})", base)
-            
-            if match and "run" in match.groupdict():
-                run_num = int(match.group("run"))
-                run_str = f"run-{run_num:02d}"
-                row["RunFromDescription"] = run_str
-
-                if template:
-                    expected_fragment = template.format(run=run_num)
-                    row["RunMatchToFilename"] = "PASS" if expected_fragment in base else "FAIL"
-                    if row["RunMatchToFilename"] == "PASS":
-                        row["Match"] = "PASS"
+                pattern = expected.get("series_description_pattern")
+                template = expected.get("filename_template")
+
+                if pattern:
+                    match = re.search(pattern, desc or "")
                 else:
-                    if bids_dir_type == "bids":
-                        row["Match"] = "PASS"
-                    elif bids_dir_type == "bids_trimmed": 
-                        # fallback case: directly compare extracted run_str to filename
-                        row["RunMatchToFilename"] = "PASS" if run_str in base else "FAIL"
+                    # fallback to filename-based run extraction for fmap files
+                    match = re.search(r"run-(?P<run>\d{2})", base)
+            
+                if match and "run" in match.groupdict():
+                    run_num = int(match.group("run"))
+                    run_str = f"run-{run_num:02d}"
+                    row["RunFromDescription"] = run_str
+
+                    if template:
+                        expected_fragment = template.format(run=run_num)
+                        row["RunMatchToFilename"] = "PASS" if expected_fragment in base else "FAIL"
                         if row["RunMatchToFilename"] == "PASS":
                             row["Match"] = "PASS"
-            else:
-                row["RunMatchToFilename"] = "FAIL"
-                row["Match"] = "FAIL"
-        else:
-            if expected is not None:
-                expected_desc = expected.get("series_description")
-                if expected_desc:
-                    row["Match"] = "PASS" if desc == expected_desc else "FAIL"
+                    else:
+                        if bids_dir_type == "bids":
+                            row["Match"] = "PASS"
+                        elif bids_dir_type == "bids_trimmed": 
+                            # fallback case: directly compare extracted run_str to filename
+                            row["RunMatchToFilename"] = "PASS" if run_str in base else "FAIL"
+                            if row["RunMatchToFilename"] == "PASS":
+                                row["Match"] = "PASS"
                 else:
-                    row["Match"] = "PASS"
+                    row["RunMatchToFilename"] = "FAIL"
+                    row["Match"] = "FAIL"
             else:
-                row["Match"] = None
+                if expected is not None:
+                    expected_desc = expected.get("series_description")
+                    if expected_desc:
+                        row["Match"] = "PASS" if desc == expected_desc else "FAIL"
+                    else:
+                        row["Match"] = "PASS"
+                else:
+                    row["Match"] = None
 
-        records.append(row)
+            records.append(row)
+    finally:
+        if owns_index:
+            index.close()
 
     if not records:
         print(f"⚠️  No BIDS files found for sub-{subid} in {bids_dir_type} directory: {subject_dir}")
         print(f"   Skipping CSV generation for: {output_csv}")
-        return
+        return records
 
     with open(output_csv, "w", newline="") as f:
         writer = csv.DictWriter(f, fieldnames=records[0].keys())
@@ -162,6 +175,7 @@ def run_qc(subject_dir, task_name, config_path, output_csv, bids_dir_type, subid
         writer.writerows(records)
 
     print(f"✅ QC summary written to: {output_csv}")
+    return records
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run metadata QC for converted NIfTI files")
@@ -193,6 +207,9 @@ if __name__ == "__main__":
         "bids_trimmed": trim_dir
     }
 
+    # shared header/sidecar index so reruns only re-read files that changed
+    index = nifti_index.open_index()
+
     bids_dir_types = ["bids", "bids_trimmed"]
     task_id_names = [args.task_id, args.new_task_id]
 
@@ -208,5 +225,7 @@ if __name__ == "__main__":
         elif dir_type == "bids_trimmed":
             current_task = task_id_names[1]
 
-        run_qc(subject_dir=subject_dir, task_name=current_task, config_path=args.config_path, output_csv=output_csv, bids_dir_type=dir_type, subid=args.subid)
+        run_qc(subject_dir=subject_dir, task_name=current_task, config_path=args.config_path, output_csv=output_csv, bids_dir_type=dir_type, subid=args.subid, index=index)
+
+    index.close()
     
\ No newline at end of file